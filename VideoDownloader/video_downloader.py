@@ -1,24 +1,1966 @@
-import tkinter as tk
-from tkinter import filedialog
-from yt_dlp import YoutubeDL
 import os
-import glob
+import argparse
 import logging
-from collections import defaultdict
+from collections import defaultdict, deque
 import subprocess
 import time
 import shutil
+import signal
 import errno
+import json
+import sqlite3
+import hashlib
+import threading
+import queue
+import itertools
+import functools
+import math
+import contextlib
+import concurrent.futures
+import html
+import xml.etree.ElementTree as ElementTree
+import random
+import re
+import urllib.parse
+from datetime import datetime
 # from yt_dlp.networking.impersonate import ImpersonateTarget
 
 # basic log
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# yt-dlp is slow to import: load it when the first URL is processed, not at startup.
+def YoutubeDL(params=None):
+    from yt_dlp import YoutubeDL as _YoutubeDL
+    return _YoutubeDL(params)
+
+class DownloadCancelled(Exception):
+    "Raised from the progress hooks of a job cancelled while it downloads."
+
+
+class DownloadJob:
+    "State of a single playlist entry handled by the PlaylistScheduler."
+
+    def __init__(self, index, url, priority=1.0, max_height=None):
+        self.index = index
+        self.url = url
+        self.priority = priority  # bandwidth share weight, see BandwidthLimiter
+        self.max_height = max_height  # overrides the quality of the pipeline for this job (0 = best)
+        self.info = None  # future of the metadata resolved ahead, see MetadataPrefetcher
+        self.cancel_requested = False
+        self.title = None
+        self.state = 'pending'  # pending -> <stage name> -> done / failed / skipped / cancelled
+        self.error = None
+        self.context = None  # download context shared by the stages (see VideoDownloader.prepare_download)
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'skipped', 'cancelled')
+
+    # A queued job is dropped before its next stage, a download in progress is aborted by progress_hook.
+    def cancel(self):
+        self.cancel_requested = True
+
+    def progress_hook(self, d):
+        if self.cancel_requested:
+            raise DownloadCancelled(f"job {self.index} cancelled")
+
+
+class PipelineStage:
+    "One step of the download pipeline with its own queue, worker threads and busy-time counters."
+
+    def __init__(self, name, func, workers=1, queue_size=0):
+        self.name = name
+        self.func = func  # callable(job) -> truthy to continue, False / 'failed' / 'skipped' to stop the job
+        self.workers = max(1, int(workers))
+        self.queue = queue.Queue(maxsize=queue_size)  # bounded queues apply back-pressure on the previous stage
+        self.busy_time = 0.0
+        self.processed = 0
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self.queue.qsize(),
+                'active': self.active,
+                'processed': self.processed,
+                'busy_s': round(self.busy_time, 1),
+            }
+
+
+class PlaylistScheduler:
+    "Move playlist jobs through the pipeline stages concurrently and report the results in playlist order."
+
+    def __init__(self, stages, on_failed=None, stats_interval=30, on_finished=None):
+        self.stages = stages
+        self.on_failed = on_failed  # callable(job), e.g. to clean up leftovers of a failed or cancelled job
+        self.on_finished = on_finished  # callable(job) once the job reached its final state
+        self.stats_interval = stats_interval
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._next_report = 0
+        self._finished_count = 0
+        self._feeding = False  # the URL iterable is still producing jobs
+        self._all_finished = threading.Event()
+        self._cancelled = threading.Event()
+
+    # urls: any iterable, e.g. a playlist listed page by page; the first jobs start while it is still producing.
+    # It may also produce DownloadJob objects, numbered in their order of arrival.
+    # priorities: optional {url: weight} for the bandwidth sharing between jobs, read when the job is created.
+    def run(self, urls, priorities=None):
+        priorities = priorities if priorities is not None else {}
+        self.jobs = []
+        self._next_report = 0
+        self._finished_count = 0
+        self._feeding = True
+        self._all_finished.clear()
+        self._cancelled.clear()
+
+        threads = []
+        for position, stage in enumerate(self.stages):
+            for worker_idx in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._stage_worker, args=(position,),
+                    name=f"{stage.name}-{worker_idx}", daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        feeder = threading.Thread(target=self._feed, args=(urls, priorities), name='feeder', daemon=True)
+        feeder.start()
+
+        try:
+            while not self._all_finished.wait(self.stats_interval):
+                self.log_stats()
+        except KeyboardInterrupt:
+            # Queued jobs are dropped by the workers, running stages end with the (daemon) threads
+            self._cancelled.set()
+            raise
+
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.queue.put(None)
+        for thread in threads:
+            thread.join()
+        return self.jobs
+
+    # Create the jobs as the URLs arrive, in their order.
+    def _feed(self, urls, priorities):
+        try:
+            for url in urls:
+                if self._cancelled.is_set():
+                    break
+                with self._lock:
+                    if isinstance(url, DownloadJob):
+                        job = url
+                        job.index = len(self.jobs) + 1
+                    else:
+                        job = DownloadJob(len(self.jobs) + 1, url, priorities.get(url, 1.0))
+                    self.jobs.append(job)
+                self.stages[0].queue.put(job)
+        except Exception as e:
+            logging.error(f"Error listing the videos, the listed ones are still downloaded: {str(e)}")
+        finally:
+            with self._lock:
+                self._feeding = False
+                if self._finished_count == len(self.jobs):
+                    self._all_finished.set()
+
+    def _stage_worker(self, position):
+        stage = self.stages[position]
+        while True:
+            job = stage.queue.get()
+            if job is None:
+                break
+            if self._cancelled.is_set() or job.cancel_requested:
+                self._finish(job, 'cancelled')
+                continue
+
+            if job.started_at is None:
+                job.started_at = time.time()
+            job.state = stage.name
+            with stage._lock:
+                stage.active += 1
+            started = time.perf_counter()
+            try:
+                result = stage.func(job)
+            except Exception as e:
+                result = 'failed'
+                job.error = str(e)
+            with stage._lock:
+                stage.active -= 1
+                stage.processed += 1
+                stage.busy_time += time.perf_counter() - started
+
+            if result in (False, None, 'failed'):
+                self._finish(job, 'cancelled' if job.cancel_requested else 'failed')
+            elif result == 'skipped':
+                self._finish(job, 'skipped')
+            elif position + 1 < len(self.stages):
+                self.stages[position + 1].queue.put(job)
+            else:
+                self._finish(job, 'done')
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        if state in ('failed', 'cancelled') and self.on_failed:
+            try:
+                self.on_failed(job)
+            except Exception as e:
+                logging.error(f"Error cleaning up failed job {job.index}: {str(e)}")
+        if self.on_finished:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                logging.error(f"Error reporting job {job.index}: {str(e)}")
+        with self._lock:
+            self._finished_count += 1
+            if not self._feeding and self._finished_count == len(self.jobs):
+                self._all_finished.set()
+        self._report_finished()
+
+    # Report every finished job whose predecessors are finished too, so the log keeps the playlist order.
+    def _report_finished(self):
+        with self._lock:
+            while self._next_report < len(self.jobs):
+                job = self.jobs[self._next_report]
+                if not job.finished:
+                    break
+                label = job.title or job.url
+                total = f"{len(self.jobs)}{'+' if self._feeding else ''}"  # still listing
+                if job.state == 'failed':
+                    logging.error(f"[{job.index}/{total}] failed: {label} {job.error or ''}".rstrip())
+                else:
+                    logging.info(f"[{job.index}/{total}] {job.state}: {label} ({job.duration:.1f}s)")
+                self._next_report += 1
+
+    # Queue depth, active workers, processed jobs and busy time of every stage.
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self):
+        parts = [
+            f"{name}: {st['queued']} queued, {st['active']} active, {st['processed']} done, {st['busy_s']}s busy"
+            for name, st in self.stats().items()
+        ]
+        logging.info("Pipeline | " + " | ".join(parts))
+
+    def summary(self):
+        counts = defaultdict(int)
+        for job in self.jobs:
+            counts[job.state] += 1
+        return dict(counts)
+
+
+class MetadataPrefetcher:
+    "Resolves the metadata of the next entries of a playlist ahead of the downloads, with bounded concurrency per host."
+
+    # prefetch() passes the entries through, each with a future of its info dict, keeping at most `lookahead`
+    # entries resolved or in progress that the consumer has not taken yet: the listing, the extractions and the
+    # downloads overlap, and an entry reaching the download already has its metadata.
+    def __init__(self, workers=4, lookahead=8, per_host=2):
+        self.workers = max(1, workers)
+        self.lookahead = max(1, lookahead)
+        self.per_host = max(1, per_host)
+        self._pool = None
+        self._hosts = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._pending = {}  # future -> window semaphore of its prefetch() call, until taken or discarded
+        self._lock = threading.Lock()
+
+    # entries: URLs or DownloadJob objects, iterated by a feeder thread so that the extractions run ahead even of a
+    # consumer busy with a download. extract: callable(url) -> info dict (None = nothing to prefetch).
+    # Yields (entry, future); every future must be given back to take() or discard(). An error of the entries
+    # iterable is raised after the entries produced before it.
+    def prefetch(self, entries, extract):
+        window = threading.Semaphore(self.lookahead)
+        ready = queue.Queue()
+        stopped = threading.Event()
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='prefetch')
+            pool = self._pool
+
+        def feed():
+            try:
+                for entry in entries:
+                    window.acquire()  # Wait until the consumer catches up
+                    if stopped.is_set():
+                        break
+                    url = entry.url if isinstance(entry, DownloadJob) else entry
+                    future = pool.submit(self._extract, extract, url)
+                    with self._lock:
+                        self._pending[future] = window
+                    ready.put((entry, future))
+            except Exception as e:
+                ready.put(e)
+            finally:
+                ready.put(None)
+
+        threading.Thread(target=feed, name='prefetch-feeder', daemon=True).start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            window.release()  # Wakes the feeder if it waits for a slot
+            while True:  # Entries prefetched but never handed to the consumer
+                try:
+                    item = ready.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, tuple):
+                    item[1].cancel()
+                    self.discard(item[1])
+
+    def _extract(self, extract, url):
+        with self._lock:
+            host = self._hosts[RetryScheduler.host_key(url)]
+        with host:
+            return extract(url)
+
+    # Info dict of a prefetched entry, waiting for its extraction if needed (raises its error).
+    def take(self, future):
+        try:
+            return future.result()
+        finally:
+            self.discard(future)
+
+    # Give back the window slot of an entry whose metadata is not needed (e.g. a cancelled job).
+    def discard(self, future):
+        with self._lock:
+            window = self._pending.pop(future, None)
+        if window is not None:
+            window.release()
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._pending.clear()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class DownloadManifest:
+    "Append-only JSONL index of the finished downloads of a directory, keyed by extractor and video ID."
+
+    FILENAME = '.download_manifest.jsonl'
+
+    def __init__(self, save_dir):
+        self.path = os.path.join(save_dir, self.FILENAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    # Same key layout as the yt-dlp download archive: "<extractor> <video id>".
+    @staticmethod
+    def make_key(extractor_key, video_id):
+        if not video_id:
+            return None
+        return f"{(extractor_key or 'generic').lower()} {video_id}"
+
+    # Key of a video URL without extracting it: the video ID comes from the URL pattern of its yt-dlp extractor.
+    # None for the URLs only the generic extractor handles, their ID is only known after the extraction.
+    # Memoized: a URL is looked up by the listing, the prefetcher and the extraction stage, and a generic URL
+    # goes through the whole extractor list.
+    _extractors = None
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def key_from_url(cls, url):
+        if cls._extractors is None:
+            from yt_dlp.extractor import gen_extractor_classes
+            cls._extractors = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+        for ie in cls._extractors:
+            if ie.suitable(url):
+                return cls.make_key(ie.ie_key(), ie.get_temp_id(url))
+        return None
+
+    # Replay the index, the last record of a key wins.
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Truncated line left by an interrupted write
+                if entry.get('key'):
+                    self.entries[entry['key']] = entry
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    # Names of the .mp4 files of the directory no entry points to: files downloaded before the manifest existed,
+    # only recognized by their title once the video is extracted.
+    def untracked_files(self):
+        save_dir = os.path.dirname(self.path)
+        with self._lock:
+            tracked = {os.path.basename(entry['path']) for entry in self.entries.values() if entry.get('path')}
+        return {f for f in os.listdir(save_dir) if f.endswith('.mp4') and f not in tracked}
+
+    # Only trust a completed entry whose file is still in place with the recorded size.
+    # The integrity verification of the download is not repeated, the recorded result is trusted.
+    def is_complete(self, key):
+        entry = self.entries.get(key)
+        if not entry or entry.get('state') != 'complete' or not os.path.exists(entry.get('path', '')):
+            return False
+        return entry.get('size') is None or os.path.getsize(entry['path']) == entry['size']
+
+    # integrity: result of VideoDownloader.verify_media (sizes, probe, content hash).
+    def record(self, key, state, path=None, size=None, format_id=None, title=None, integrity=None):
+        if not key:
+            return
+        entry = {
+            'key': key,
+            'state': state,
+            'path': path,
+            'size': size,
+            'format': format_id,
+            'title': title,
+            'integrity': integrity,
+            'updated_at': time.time(),
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.entries[key] = entry
+
+
+class JobJournal:
+    "Write-ahead JSONL journal of the last pipeline stage reached by every video of a directory, keyed by URL."
+
+    FILENAME = '.download_journal.jsonl'
+    STAGES = ('extracted', 'downloaded', 'merged', 'finalized')
+    FSYNC_INTERVAL = 1.0  # seconds; the records of all the jobs are synced together at most once per interval
+
+    def __init__(self, save_dir):
+        self.path = os.path.join(save_dir, self.FILENAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._dirty = False
+        self._sync_thread = None
+        self.load()
+
+    # Replay the journal, each record updates the entry of its URL.
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Truncated line left by a crash
+                if record.get('url'):
+                    self.entries.setdefault(record['url'], {}).update(record)
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    # Entries stopped before 'finalized' by a crash or a failure.
+    def pending(self):
+        return [entry for entry in self.entries.values() if entry.get('stage') != 'finalized']
+
+    # Append a stage transition. The line reaches the OS at once, fsync is batched by the sync thread.
+    def record(self, url, stage, **data):
+        record = {'url': url, 'stage': stage, **data, 'updated_at': time.time()}
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+            self._dirty = True
+            self.entries.setdefault(url, {}).update(record)
+            if self._sync_thread is None:
+                self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+                self._sync_thread.start()
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.FSYNC_INTERVAL)
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty and self._file is not None:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    # Rewrite the journal with the unfinished entries only, the finished ones live in the manifest.
+    def compact(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.entries = {url: entry for url, entry in self.entries.items() if entry.get('stage') != 'finalized'}
+            if not self.entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+
+class PlaylistSyncState:
+    "Entries of each synced playlist already downloaded in a directory, so the next sync only lists the new ones."
+
+    FILENAME = '.playlist_sync.json'
+
+    def __init__(self, save_dir):
+        self.path = os.path.join(save_dir, self.FILENAME)
+        self.state = {}  # playlist URL -> {'seen': [manifest keys], 'synced_at': timestamp}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable playlist sync file {self.path}: {e}")
+
+    def known(self, playlist_url):
+        return set(self.state.get(playlist_url, {}).get('seen', []))
+
+    def add(self, playlist_url, keys):
+        entry = self.state.setdefault(playlist_url, {'seen': []})
+        entry['seen'] = sorted(set(entry['seen']) | set(keys))
+        entry['synced_at'] = time.time()
+
+    def save(self):
+        try:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save the playlist sync state to {self.path}: {e}")
+
+
+class JobQueue:
+    "Persistent priority queue of the daemon jobs (SQLite), shared by the API threads and the pipeline."
+
+    FILENAME = '.download_queue.sqlite3'
+    FINAL_STATES = ('done', 'failed', 'skipped', 'cancelled')
+
+    # A job is a video, or a playlist whose entries become video jobs with its priority and quality once listed.
+    # States: queued -> running (listing, then running for a playlist) -> done / failed / skipped / cancelled.
+    # A playlist is done when its last entry is. Videos and listings interrupted by a stop are queued again.
+    def __init__(self, save_dir):
+        self.path = os.path.join(save_dir, self.FILENAME)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # A submit is a small append, not a full fsync
+        with self._lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                parent INTEGER REFERENCES jobs (id),
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                priority REAL NOT NULL DEFAULT 1.0,
+                max_height INTEGER,
+                state TEXT NOT NULL DEFAULT 'queued',
+                title TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                UNIQUE (parent, url)
+            )''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS jobs_by_priority ON jobs (state, kind, priority DESC, id)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS jobs_by_parent ON jobs (parent, state)')
+            recovered = self.db.execute(
+                "UPDATE jobs SET state = 'queued', started = NULL "
+                "WHERE (kind = 'video' AND state = 'running') OR state = 'listing'").rowcount
+        if recovered:
+            logging.info(f"{recovered} jobs interrupted by the last stop are queued again.")
+
+    def submit(self, url, priority=1.0, max_height=None):
+        kind = 'playlist' if 'list=' in url else 'video'
+        with self._lock, self.db:
+            cursor = self.db.execute(
+                'INSERT INTO jobs (kind, url, priority, max_height, created) VALUES (?, ?, ?, ?, ?)',
+                (kind, url, priority, max_height, time.time()))
+        return cursor.lastrowid
+
+    # Queue a listed entry of a playlist, once per URL. Returns False when the playlist was cancelled.
+    def add_entry(self, parent, url):
+        with self._lock, self.db:
+            row = self.db.execute('SELECT priority, max_height, state FROM jobs WHERE id = ?', (parent,)).fetchone()
+            if row is None or row['state'] in self.FINAL_STATES:
+                return False
+            self.db.execute(
+                "INSERT OR IGNORE INTO jobs (parent, kind, url, priority, max_height, created) VALUES (?, 'video', ?, ?, ?, ?)",
+                (parent, url, row['priority'], row['max_height'], time.time()))
+        return True
+
+    # Highest priority queued job of a kind ('video' or 'playlist'), marked as started. None when there is none.
+    def claim(self, kind):
+        state = 'listing' if kind == 'playlist' else 'running'
+        with self._lock, self.db:
+            row = self.db.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' AND kind = ? ORDER BY priority DESC, id LIMIT 1",
+                (kind,)).fetchone()
+            if row is None:
+                return None
+            job = {**dict(row), 'state': state, 'started': time.time()}
+            self.db.execute('UPDATE jobs SET state = ?, started = ? WHERE id = ?', (state, job['started'], job['id']))
+        return job
+
+    # End of the listing of a playlist. Returns its id if it is already complete (no new entry to download).
+    def listed(self, job_id, error=None):
+        with self._lock, self.db:
+            self.db.execute("UPDATE jobs SET state = 'running', error = ? WHERE id = ? AND state = 'listing'",
+                            (error, job_id))
+            return self._complete_playlist(job_id)
+
+    # Final state of a job. Returns the id of its playlist when this was the last entry to finish.
+    def finish(self, job_id, state, title=None, error=None):
+        with self._lock, self.db:
+            self.db.execute(
+                f"UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ? "
+                f"AND state NOT IN ({', '.join('?' * len(self.FINAL_STATES))})",
+                (state, error, time.time(), job_id, *self.FINAL_STATES))
+            self.db.execute('UPDATE jobs SET title = COALESCE(?, title) WHERE id = ?', (title, job_id))
+            row = self.db.execute('SELECT parent FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return self._complete_playlist(row['parent']) if row and row['parent'] else None
+
+    def _complete_playlist(self, job_id):
+        row = self.db.execute('SELECT state, error FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or row['state'] != 'running':
+            return None  # Still listing, or cancelled
+        counts = self._entry_counts(job_id)
+        if counts.get('queued') or counts.get('running'):
+            return None
+        failed = counts.get('failed') or (row['error'] and not counts)
+        self.db.execute('UPDATE jobs SET state = ?, finished = ? WHERE id = ?',
+                        ('failed' if failed else 'done', time.time(), job_id))
+        return job_id
+
+    def _entry_counts(self, job_id):
+        rows = self.db.execute('SELECT state, COUNT(*) FROM jobs WHERE parent = ? GROUP BY state', (job_id,))
+        return {state: count for state, count in rows}
+
+    # Cancel a job and the entries of a playlist. Returns the ids of the cancelled videos that were running (their
+    # download has to be stopped), or None when the job does not exist or is already finished.
+    def cancel(self, job_id):
+        with self._lock, self.db:
+            row = self.db.execute('SELECT kind, state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row['state'] in self.FINAL_STATES:
+                return None
+            running = [r['id'] for r in self.db.execute(
+                "SELECT id FROM jobs WHERE (id = ? OR parent = ?) AND kind = 'video' AND state = 'running'",
+                (job_id, job_id))]
+            self.db.execute(
+                "UPDATE jobs SET state = 'cancelled', finished = ? "
+                "WHERE (id = ? OR parent = ?) AND state IN ('queued', 'listing', 'running')",
+                (time.time(), job_id, job_id))
+        return running
+
+    # A job as a dict, with the number of entries in each state for a playlist. None when it does not exist.
+    def get(self, job_id):
+        with self._lock:
+            row = self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return self._describe(row) if row else None
+
+    # Submitted jobs (not the playlist entries), newest first.
+    def list(self, state=None, limit=100):
+        with self._lock:
+            if state:
+                rows = self.db.execute('SELECT * FROM jobs WHERE parent IS NULL AND state = ? ORDER BY id DESC LIMIT ?',
+                                       (state, limit)).fetchall()
+            else:
+                rows = self.db.execute('SELECT * FROM jobs WHERE parent IS NULL ORDER BY id DESC LIMIT ?',
+                                       (limit,)).fetchall()
+            return [self._describe(row) for row in rows]
+
+    # Number of video jobs in each state.
+    def counts(self):
+        with self._lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM jobs WHERE kind = 'video' GROUP BY state")
+            return {state: count for state, count in rows}
+
+    def _describe(self, row):
+        job = dict(row)
+        if job['kind'] == 'playlist':
+            job['entries'] = self._entry_counts(job['id'])
+        return job
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class YdlLogger:
+    "yt-dlp logger printing messages like yt-dlp itself would, and passing every message to the observers."
+
+    def __init__(self, quiet=False, observers=None):
+        self.quiet = quiet
+        self.observers = list(observers or [])  # callables(level, message)
+
+    def _notify(self, level, msg):
+        for observer in self.observers:
+            observer(level, msg)
+
+    def debug(self, msg):
+        self._notify('debug', msg)
+        if not self.quiet and not msg.startswith('[debug] '):
+            print(msg)
+
+    def info(self, msg):
+        self.debug(msg)
+
+    def warning(self, msg):
+        self._notify('warning', msg)
+        logging.warning(msg)
+
+    def error(self, msg):
+        self._notify('error', msg)
+        logging.error(msg)
+
+
+class YdlSession:
+    "YoutubeDL instances kept for a whole run, one per thread and profile, with per-call option overrides."
+
+    # Keeping the instance keeps its HTTP connection pool, its cookie jar and its initialized extractors.
+    # Almost every option is read from ydl.params when it is used, so a call only swaps the options it overrides
+    # and restores them afterwards. 'format' and the progress hooks are compiled by YoutubeDL.__init__, the session
+    # rebuilds the format selector and dispatches the progress to the hooks of the current call.
+    # Options only read at creation (postprocessors) go in a profile: profile name -> options.
+    _UNSET = object()
+
+    def __init__(self, base_opts, profiles=None, reuse=True):
+        self.base_opts = base_opts
+        self.profiles = profiles or {}
+        self.reuse = reuse  # False: a new YoutubeDL for every call (previous behaviour, see the benchmark)
+        self.created = 0
+        self._local = threading.local()
+        self._instances = []
+        self._lock = threading.Lock()
+
+    def _instance(self, profile):
+        instances = self._local.__dict__.setdefault('instances', {})
+        if profile not in instances:
+            hooks = []
+            ydl = YoutubeDL({**self.base_opts, **self.profiles.get(profile, {})})
+            ydl.add_progress_hook(lambda d: [hook(d) for hook in hooks])
+            instances[profile] = (ydl, hooks)
+            with self._lock:
+                self.created += 1
+                self._instances.append(ydl)
+        return instances[profile]
+
+    # with session.use(format=..., outtmpl=..., progress_hooks=[...]) as ydl: ydl.process_ie_result(...)
+    @contextlib.contextmanager
+    def use(self, profile='default', **overrides):
+        if not self.reuse:
+            with self._lock:
+                self.created += 1
+            with YoutubeDL({**self.base_opts, **self.profiles.get(profile, {}), **overrides}) as ydl:
+                yield ydl
+            return
+        
+        ydl, hooks = self._instance(profile)
+        hooks[:] = overrides.pop('progress_hooks', [])
+        saved = {key: ydl.params.get(key, self._UNSET) for key in overrides}
+        format_selector = ydl.format_selector
+        try:
+            for key, value in overrides.items():
+                ydl.params[key] = {'default': value} if key == 'outtmpl' and isinstance(value, str) else value
+            if overrides.get('format'):
+                ydl.format_selector = ydl.build_format_selector(overrides['format'])
+            yield ydl
+        finally:
+            for key, value in saved.items():
+                if value is self._UNSET:
+                    ydl.params.pop(key, None)
+                else:
+                    ydl.params[key] = value
+            ydl.format_selector = format_selector
+            hooks.clear()
+
+    # Close every instance (connection pools, cookie jars) at the end of a run.
+    def close(self):
+        with self._lock:
+            instances, self._instances = self._instances, []
+            self._local = threading.local()
+        for ydl in instances:
+            try:
+                ydl.close()
+            except Exception as e:
+                logging.warning(f"Error closing a yt-dlp session: {str(e)}")
+
+
+class StreamingHasher:
+    "Content hash of a file computed while another process appends to it, so the finished file is not read back."
+
+    # SHA-256 of the concatenated SHA-256 digests of every 1 MiB block. Blocks are hashed as soon as they are
+    # complete on disk (still in the page cache), and a block rewritten by the writer can be hashed again.
+    ALGORITHM = 'sha256-1MiB-blocks'
+    BLOCK_SIZE = 1024 * 1024
+
+    # rewrites_head: the writer seeks back to patch the first block when it finishes (ffmpeg's mp4 muxer).
+    def __init__(self, path=None, rewrites_head=False):
+        self.path = path
+        self.rewrites_head = rewrites_head
+        self.offset = 0
+        self.digests = []
+        self.identity = None
+        self._lock = threading.Lock()
+
+    def reset(self, path=None):
+        self.path = path
+        self.offset = 0
+        self.digests = []
+        self.identity = None
+
+    # Hash the blocks appended since the last call (all the remaining bytes when final).
+    # limit: bytes of the file known to be written, for a file preallocated then filled out of order.
+    def update(self, final=False, limit=None):
+        if not self.path:
+            return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return  # Not created yet
+        identity = (st.st_dev, st.st_ino)
+        if (self.identity is not None and identity != self.identity) or st.st_size < self.offset:
+            self.reset(self.path)  # Replaced or truncated by the writer, start over
+        self.identity = identity
+
+        end = st.st_size if final else st.st_size - st.st_size % self.BLOCK_SIZE
+        if limit is not None and not final:
+            end = min(end, limit - limit % self.BLOCK_SIZE)
+        if end <= self.offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while self.offset < end:
+                block = f.read(min(self.BLOCK_SIZE, end - self.offset))
+                if not block:
+                    break
+                self.digests.append(hashlib.sha256(block).digest())
+                self.offset += len(block)
+
+    # yt-dlp progress hook: follow the file being downloaded, through its rename from '.part'.
+    def hook(self, d):
+        if d['status'] == 'downloading':
+            path = d.get('tmpfilename') or d.get('filename')
+            if path != self.path:
+                self.reset(path)  # Next file (another stream or a subtitle)
+            written = d.get('contiguous_bytes', d.get('downloaded_bytes')) or 0  # see RangeDownloader
+            # Only look at the file once a new block may be complete. With hooks called from several download
+            # threads, a call coming while another one hashes leaves the new blocks to the next call.
+            if written >= self.offset + self.BLOCK_SIZE and self._lock.acquire(blocking=False):
+                try:
+                    self.update(limit=d.get('contiguous_bytes'))
+                finally:
+                    self._lock.release()
+        elif d['status'] == 'finished' and d.get('filename'):
+            self.path = d['filename']  # Renamed from '.part'; update() starts over if it is not the same file
+
+    # Hash of the finished file at path (which may be the tracked file after a rename).
+    def hexdigest(self, path=None):
+        if path and path != self.path:
+            self.path = path
+        self.update(final=True)
+        if self.rewrites_head and self.digests:
+            with open(self.path, 'rb') as f:
+                self.digests[0] = hashlib.sha256(f.read(self.BLOCK_SIZE)).digest()
+        return hashlib.sha256(b''.join(self.digests)).hexdigest()
+
+    # Hash of an existing file with the same algorithm, to check a file against its recorded hash.
+    @classmethod
+    def hash_file(cls, path):
+        return cls(path).hexdigest()
+
+
+class RangeDownloader:
+    "Download of a progressive (single file) format over several HTTP connections, one byte range per request."
+
+    # The ranges are written in place into a preallocated sparse '.ranges.part' file, so there is no reassembly copy.
+    # The finished ranges are listed in a '.ranges.json' sidecar and an interrupted download only fetches the others.
+    # Progress goes to yt-dlp style hooks; 'contiguous_bytes' is the prefix of the file already complete.
+    READ_SIZE = 64 * 1024
+    RANGE_ATTEMPTS = 3  # a range cut short by the server is requested again
+    STATE_SAVE_INTERVAL = 2.0  # seconds between two writes of the sidecar, and once more when the download stops
+
+    def __init__(self, urlopen, url, path, size, connections=4, chunk_size=8 * 1024 * 1024, headers=None,
+                 progress_hooks=None, retry=None):
+        self.urlopen = urlopen  # YoutubeDL.urlopen: connection pool, cookies and proxy of the session
+        self.url = url
+        self.path = path
+        self.size = size
+        self.connections = connections
+        self.headers = headers or {}
+        self.progress_hooks = progress_hooks or []
+        self.retry = retry  # RetryScheduler, backs off the host on HTTP 429 / 5xx
+        self.part_path = path + '.ranges.part'
+        self.state_path = path + '.ranges.json'
+        self.ranges = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+        self.done = set()
+        self.downloaded = 0
+        self.contiguous = 0
+        self.started = None
+        self.state_saved = 0.0
+        self._lock = threading.Lock()
+
+    # Total size of the resource if the server honours range requests, None otherwise.
+    @staticmethod
+    def probe_size(urlopen, url, headers=None):
+        from yt_dlp.networking import Request
+        response = urlopen(Request(url, headers={**(headers or {}), 'Range': 'bytes=0-0'}))
+        try:
+            match = re.match(r'bytes 0-0/(\d+)', response.headers.get('Content-Range') or '')
+            return int(match.group(1)) if response.status == 206 and match else None
+        finally:
+            response.close()
+
+    def request(self, start, end):
+        from yt_dlp.networking import Request
+        request = Request(self.url, headers={**self.headers, 'Range': f'bytes={start}-{end}'})
+        response = self.retry.call(self.url, self.urlopen, request) if self.retry else self.urlopen(request)
+        if response.status != 206 or not (response.headers.get('Content-Range') or '').startswith(f'bytes {start}-'):
+            response.close()
+            raise IOError(f"range {start}-{end} not honoured (HTTP {response.status})")
+        return response
+
+    # Resume from the sidecar when it matches the partial file, otherwise preallocate a new sparse file.
+    def prepare(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('size') == self.size and os.path.getsize(self.part_path) == self.size:
+                self.done = {idx for idx in state.get('done', []) if idx < len(self.ranges)}
+                self.downloaded = sum(self.ranges[idx][1] - self.ranges[idx][0] + 1 for idx in self.done)
+                logging.info(f"Resuming {os.path.basename(self.path)}: {len(self.done)}/{len(self.ranges)} ranges already done.")
+                return
+        except (OSError, ValueError):
+            pass
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.size)  # Sparse: no zeros written, the space is only used as the ranges arrive
+        self.done = set()
+
+    def save_state(self):
+        with self._lock:
+            done = sorted(self.done)
+            self.state_saved = time.monotonic()
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'size': self.size, 'done': done}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def report(self, status, nbytes=0, range_done=None):
+        with self._lock:
+            self.downloaded += nbytes
+            if range_done is not None:
+                self.done.add(range_done)
+            while self.contiguous < self.size:
+                idx = self.contiguous // (self.ranges[0][1] + 1)
+                if idx not in self.done:
+                    break
+                self.contiguous = self.ranges[idx][1] + 1
+            now = time.monotonic()
+            save = range_done is not None and now - self.state_saved >= self.STATE_SAVE_INTERVAL
+            if save:
+                self.state_saved = now  # Claimed here so the other connections do not write it too
+            elapsed = now - self.started
+            d = {
+                'status': status,
+                'filename': self.path,
+                'tmpfilename': self.part_path if status == 'downloading' else self.path,
+                'downloaded_bytes': self.downloaded,
+                'total_bytes': self.size,
+                'contiguous_bytes': self.contiguous,
+                'elapsed': elapsed,
+                'speed': self.downloaded / elapsed if elapsed > 0 else None,
+            }
+        if save:
+            self.save_state()
+        # Outside the lock: a hook may sleep (BandwidthLimiter) and the other connections keep counting.
+        # Like the concurrent fragment downloads of yt-dlp, the hooks can be called from several threads at once.
+        for hook in self.progress_hooks:
+            hook(d)
+
+    def fetch(self, idx):
+        start, end = self.ranges[idx]
+        for attempt in range(1, self.RANGE_ATTEMPTS + 1):
+            received = 0
+            response = self.request(start, end)
+            try:
+                with open(self.part_path, 'r+b') as f:
+                    f.seek(start)
+                    while received < end - start + 1:
+                        data = response.read(min(self.READ_SIZE, end - start + 1 - received))
+                        if not data:
+                            break
+                        f.write(data)
+                        received += len(data)
+                        self.report('downloading', len(data))
+            finally:
+                response.close()
+            if received == end - start + 1:
+                self.report('downloading', range_done=idx)
+                return
+            self.report('downloading', -received)  # Requested again from its start
+            logging.warning(f"Range {start}-{end} cut after {received} bytes (attempt {attempt}/{self.RANGE_ATTEMPTS})")
+        raise IOError(f"range {start}-{end} incomplete after {self.RANGE_ATTEMPTS} attempts")
+
+    def download(self):
+        self.started = time.monotonic()
+        self.prepare()
+        pending = queue.Queue()
+        for idx in range(len(self.ranges)):
+            if idx not in self.done:
+                pending.put(idx)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    idx = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.fetch(idx)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(self.connections, pending.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            self.save_state()  # The sidecar keeps the finished ranges for the next attempt
+            raise errors[0]
+
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.report('finished')
+
+
+class SubtitleConverter:
+    "In-memory conversion of the subtitle formats served by the sites (WebVTT, SRT, TTML, YouTube srv1/srv2/srv3, json3)."
+
+    # Cues are (start seconds, end seconds, text) with '\n' line breaks and only the <b>/<i>/<u> tags, which the
+    # SRT demuxer of ffmpeg turns into mov_text styles.
+    FORMATS = 'srt/json3/srv3/vtt/srv2/srv1'  # preference given to yt-dlp, the first ones need the least cleanup
+    TIMESTAMP = re.compile(r'(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{1,3})')
+    CUE_TIMING = re.compile(r'^\s*(\S+)\s+-->\s+(\S+)')
+    KEPT_TAGS = re.compile(r'</?[biu]>')
+    TAG = re.compile(r'<[^>]*>')
+    TTML_CLOCK = re.compile(r'(\d+):(\d{2}):(\d{2})(?:([.:])(\d+))?')  # HH:MM:SS.fraction or HH:MM:SS:frames
+    TTML_OFFSET = re.compile(r'(\d+(?:\.\d+)?)(h|ms|m|s|f|t)')
+
+    @classmethod
+    def parse(cls, data, ext, rolling=False):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8-sig', 'replace')
+        if ext in ('vtt', 'srt'):
+            cues = cls.parse_text_cues(data)
+        elif ext == 'json3':
+            cues = cls.parse_json3(data)
+        elif ext in ('srv1', 'srv2', 'srv3', 'ttml', 'dfxp', 'tt', 'xml'):
+            cues = cls.parse_timedtext(data)
+        else:
+            raise ValueError(f"unsupported subtitle format: {ext}")
+        cues = [(start, end, text) for start, end, text in cues if text.strip() and end > start]
+        return cls.merge_rolling(cues) if rolling else cues
+
+    @classmethod
+    def timestamp(cls, value):
+        match = cls.TIMESTAMP.fullmatch(value.strip())
+        if not match:
+            raise ValueError(f"bad timestamp: {value}")
+        hours, minutes, seconds, fraction = match.groups()
+        return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(fraction.ljust(3, '0')) / 1000
+
+    @classmethod
+    def clean_text(cls, text):
+        # Keep the basic styles, drop the voice/class/karaoke-timestamp tags of WebVTT
+        text = cls.TAG.sub(lambda m: m.group(0) if cls.KEPT_TAGS.fullmatch(m.group(0)) else '', text)
+        return html.unescape(text).replace('\xa0', ' ').strip()
+
+    # WebVTT and SRT: blocks separated by blank lines, the timing line followed by the text.
+    @classmethod
+    def parse_text_cues(cls, data):
+        cues = []
+        for block in re.split(r'\n\s*\n', data.replace('\r\n', '\n').replace('\r', '\n')):
+            lines = block.strip('\n').split('\n')
+            for idx, line in enumerate(lines):
+                match = cls.CUE_TIMING.match(line)
+                if match:
+                    text = '\n'.join(filter(None, (cls.clean_text(l) for l in lines[idx + 1:])))
+                    cues.append((cls.timestamp(match.group(1)), cls.timestamp(match.group(2)), text))
+                    break
+        return cues
+
+    # YouTube json3: events in milliseconds with text segments.
+    @staticmethod
+    def parse_json3(data):
+        cues = []
+        for event in json.loads(data).get('events', []):
+            text = ''.join(seg.get('utf8', '') for seg in event.get('segs') or [])
+            if 'tStartMs' in event and text.strip():
+                start = event['tStartMs'] / 1000
+                cues.append((start, start + event.get('dDurationMs', 0) / 1000, text.strip()))
+        return cues
+
+    # TTML time expression: clock time (frames at the document frame rate) or offset time ("1.5s", "40t"...).
+    @classmethod
+    def ttml_time(cls, value, frame_rate=30.0, tick_rate=1.0):
+        value = value.strip()
+        match = cls.TTML_CLOCK.fullmatch(value)
+        if match:
+            hours, minutes, seconds, separator, fraction = match.groups()
+            seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+            if fraction:
+                seconds += int(fraction) / frame_rate if separator == ':' else float(f'0.{fraction}')
+            return seconds
+        match = cls.TTML_OFFSET.fullmatch(value)
+        if not match:
+            raise ValueError(f"bad TTML time: {value}")
+        number, unit = float(match.group(1)), match.group(2)
+        return number * {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001, 'f': 1 / frame_rate, 't': 1 / tick_rate}[unit]
+
+    # Text of a cue element, with the <br/> of TTML as line breaks.
+    @classmethod
+    def element_text(cls, element):
+        parts = [element.text or '']
+        for child in element:
+            parts.append('\n' if child.tag.rsplit('}', 1)[-1] == 'br' else cls.element_text(child))
+            parts.append(child.tail or '')
+        return ''.join(parts)
+
+    # Timed text XML: YouTube <text start="s" dur="s"> (srv1) or <p t="ms" d="ms"> (srv2/srv3),
+    # TTML/DFXP <p begin="..." end="..."> (or dur="...").
+    @classmethod
+    def parse_timedtext(cls, data):
+        cues = []
+        root = ElementTree.fromstring(data.encode('utf-8'))
+        rates = {name.rsplit('}', 1)[-1]: float(value) for name, value in root.attrib.items()
+                 if name.rsplit('}', 1)[-1] in ('frameRate', 'tickRate')}
+        frame_rate, tick_rate = rates.get('frameRate', 30.0), rates.get('tickRate', 1.0)
+        for element in root.iter():
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'text' and 'start' in element.attrib:
+                start = float(element.get('start'))
+                end = start + float(element.get('dur', 0))
+            elif tag == 'p' and 't' in element.attrib:
+                start = int(element.get('t')) / 1000
+                end = start + int(element.get('d', 0)) / 1000
+            elif tag == 'p' and 'begin' in element.attrib:
+                start = cls.ttml_time(element.get('begin'), frame_rate, tick_rate)
+                if 'end' in element.attrib:
+                    end = cls.ttml_time(element.get('end'), frame_rate, tick_rate)
+                else:
+                    end = start + cls.ttml_time(element.get('dur', '0s'), frame_rate, tick_rate)
+            else:
+                continue
+            text = '\n'.join(line.strip() for line in cls.element_text(element).split('\n'))
+            cues.append((start, end, html.unescape(cls.clean_text(text))))  # srv1 text is escaped twice
+        return cues
+
+    # Automatic captions repeat the previous line in every cue (roll-up): keep only the new lines of each cue.
+    @staticmethod
+    def merge_rolling(cues):
+        merged = []
+        previous_lines = []
+        for start, end, text in cues:
+            lines = [line for line in text.split('\n') if line.strip()]
+            new_lines = [line for line in lines if line not in previous_lines]
+            previous_lines = lines
+            if not new_lines:
+                if merged:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end), merged[-1][2])
+                continue
+            merged.append((start, end, '\n'.join(new_lines)))
+        return merged
+
+    @staticmethod
+    def to_srt(cues):
+        def ts(seconds):
+            ms = round(seconds * 1000)
+            return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+        return ''.join(f"{idx}\n{ts(start)} --> {ts(end)}\n{text}\n\n" for idx, (start, end, text) in enumerate(cues, 1))
+
+    @staticmethod
+    def to_ass(cues):
+        def ts(seconds):
+            cs = round(seconds * 100)
+            return f"{cs // 360000}:{cs // 6000 % 60:02d}:{cs // 100 % 60:02d}.{cs % 100:02d}"
+        def style(text):
+            for tag in 'biu':
+                text = text.replace(f'<{tag}>', f'{{\\{tag}1}}').replace(f'</{tag}>', f'{{\\{tag}0}}')
+            return text.replace('\n', '\\N')
+        header = (
+            "[Script Info]\nScriptType: v4.00+\nPlayResX: 384\nPlayResY: 288\n\n"
+            "[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+            "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+            "Alignment, MarginL, MarginR, MarginV, Encoding\n"
+            "Style: Default,Arial,16,&Hffffff,&Hffffff,&H0,&H0,0,0,0,0,100,100,0,0,1,1,0,2,10,10,10,0\n\n"
+            "[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+        )
+        return header + ''.join(
+            f"Dialogue: 0,{ts(start)},{ts(end)},Default,,0,0,0,,{style(text)}\n" for start, end, text in cues)
+
+
+class FragmentProbe:
+    "Measures the fragment throughput, retries and HTTP 429 of one download for the FragmentTuner."
+
+    def __init__(self, host, concurrency):
+        self.host = host  # None until the formats are selected, see FragmentTuner.tune
+        self.concurrency = concurrency
+        self.fragmented = False
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.fragments = 0
+        self.retries = 0
+        self.throttled = 0
+
+    # yt-dlp progress hook: only fragmented downloads use 'concurrent_fragment_downloads'.
+    def hook(self, d):
+        if 'fragment_index' in d or 'fragment_count' in d:
+            self.fragmented = True
+        if d['status'] == 'finished' and self.fragmented:
+            self.bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            self.elapsed += d.get('elapsed') or 0.0
+            self.fragments += d.get('fragment_count') or 0
+
+    # YdlLogger observer: fragment retries are only reported as messages.
+    def observe(self, level, msg):
+        if 'HTTP Error 429' in msg or 'Too Many Requests' in msg:
+            self.throttled += 1
+        if 'Retrying fragment' in msg or 'Got error' in msg:
+            self.retries += 1
+
+    @property
+    def speed(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class FragmentTuner:
+    "Ramps 'concurrent_fragment_downloads' up or down per media host and remembers the choice across runs."
+
+    MAX_ERROR_RATE = 0.05         # retries per fragment above which the concurrency is halved
+    THROTTLE_COOLDOWN = 3600      # seconds during which a throttled concurrency is not tried again
+    SPEED_SMOOTHING = 0.3         # weight of the newest measurement in the per-level average speed
+
+    def __init__(self, path, limits, default_limits=(1, 8), start=2):
+        self.path = path
+        self.limits = limits  # {host: (min, max)}, hosts as grouped by RetryScheduler.host_key
+        self.default_limits = default_limits
+        self.start = start
+        self.state = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable fragment tuning file {self.path}: {e}")
+
+    def get_limits(self, host):
+        return self.limits.get(host, self.default_limits)
+
+    def _entry(self, host):
+        low, high = self.get_limits(host)
+        return self.state.setdefault(host, {
+            'concurrency': min(max(self.start, low), high),
+            'speeds': {},
+            'ceiling': high,
+            'throttled_at': 0,
+        })
+
+    def get(self, host):
+        with self._lock:
+            return self._entry(host)['concurrency']
+
+    # Concurrency of a download whose formats are selected: the media host is only known from the format URLs.
+    # fragment_base_url for DASH, the media playlist for HLS.
+    def tune(self, probe, formats):
+        url = next((f.get('fragment_base_url') or f.get('url') for f in formats if f.get('fragments') or
+                    f.get('protocol', '').startswith(('m3u8', 'http_dash'))), None) or formats[0].get('url')
+        probe.host = RetryScheduler.host_key(url) or 'generic'
+        probe.concurrency = self.get(probe.host)
+        return probe.concurrency
+
+    # Hill climbing on the average speed of each concurrency level, halving on errors or HTTP 429.
+    def report(self, probe):
+        if probe.host is None or not probe.fragmented or (probe.elapsed <= 0 and not probe.throttled):
+            return  # Nothing measured (progressive format or failed before any fragment)
+        with self._lock:
+            low, high = self.get_limits(probe.host)
+            entry = self._entry(probe.host)
+            level = probe.concurrency
+            if time.time() - entry['throttled_at'] > self.THROTTLE_COOLDOWN:
+                entry['ceiling'] = high
+
+            if probe.throttled or probe.retries > self.MAX_ERROR_RATE * max(probe.fragments, 1):
+                entry['ceiling'] = max(low, level - 1)
+                entry['throttled_at'] = time.time()
+                entry['concurrency'] = max(low, level // 2)
+                reason = f"{probe.retries} retries, {probe.throttled} HTTP 429"
+            else:
+                speeds = entry['speeds']
+                previous = speeds.get(str(level))
+                speeds[str(level)] = probe.speed if previous is None else (
+                    (1 - self.SPEED_SMOOTHING) * previous + self.SPEED_SMOOTHING * probe.speed)
+                best = int(max(speeds, key=speeds.get))
+                ceiling = min(high, entry['ceiling'])
+                if best == level and level < ceiling and str(level + 1) not in speeds:
+                    entry['concurrency'] = level + 1  # Try one more connection
+                else:
+                    entry['concurrency'] = min(max(best, low), ceiling)
+                reason = f"{probe.speed / 1024 / 1024:.2f}MB/s"
+
+            if entry['concurrency'] != level:
+                logging.info(f"Fragment concurrency for {probe.host}: {level} -> {entry['concurrency']} ({reason})")
+            self.save()
+
+    def save(self):
+        try:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save fragment tuning to {self.path}: {e}")
+
+
+class BandwidthLimiter:
+    "Token bucket shared by all the downloads of the process, split between the active jobs by priority weight."
+
+    BURST_SECONDS = 1.0  # bytes a job may send ahead of its share, in seconds of that share
+
+    # rate in bytes/s (0 = unlimited), windows: [('HH:MM', 'HH:MM', rate), ...] overriding the rate during the day.
+    def __init__(self, rate=0, windows=None):
+        self.rate = rate
+        self.windows = [
+            (datetime.strptime(start, '%H:%M').time(), datetime.strptime(end, '%H:%M').time(), window_rate)
+            for start, end, window_rate in (windows or [])
+        ]
+        self.jobs = {}  # key -> {'weight', 'tokens', 'updated', 'downloaded': {filename: bytes}}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or any(window_rate > 0 for _, _, window_rate in self.windows)
+
+    def current_rate(self):
+        now = datetime.now().time()
+        for start, end, window_rate in self.windows:
+            inside = start <= now < end if start <= end else (now >= start or now < end)  # overnight windows
+            if inside:
+                return window_rate
+        return self.rate
+
+    # Highest rate a single download may ever get, None if some period is unlimited.
+    def max_rate(self):
+        rates = [self.rate] + [window_rate for _, _, window_rate in self.windows]
+        return None if any(rate <= 0 for rate in rates) else max(rates)
+
+    def register(self, key, weight=1.0):
+        with self._lock:
+            self.jobs[key] = {'weight': max(weight, 0.01), 'tokens': 0.0, 'updated': time.monotonic(), 'downloaded': {}}
+
+    def unregister(self, key):
+        with self._lock:
+            self.jobs.pop(key, None)
+
+    # yt-dlp progress hook charging the bytes received since the previous call to the job.
+    def progress_hook(self, key):
+        def hook(d):
+            if d['status'] != 'downloading' or not d.get('downloaded_bytes'):
+                return
+            filename = d.get('tmpfilename') or d.get('filename')
+            with self._lock:
+                if key not in self.jobs:
+                    return
+                downloaded = self.jobs[key]['downloaded']
+                delta = d['downloaded_bytes'] - downloaded.get(filename, 0)
+                downloaded[filename] = d['downloaded_bytes']
+            if delta > 0:
+                self.throttle(key, delta)
+        return hook
+
+    # Take nbytes from the job bucket, sleeping the download thread while the bucket is in debt.
+    def throttle(self, key, nbytes):
+        rate = self.current_rate()
+        if rate <= 0:
+            return
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return
+            share = rate * job['weight'] / sum(j['weight'] for j in self.jobs.values())
+            now = time.monotonic()
+            job['tokens'] = min(share * self.BURST_SECONDS, job['tokens'] + (now - job['updated']) * share)
+            job['updated'] = now
+            job['tokens'] -= nbytes
+            wait = -job['tokens'] / share if job['tokens'] < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RetryScheduler:
+    "Per-host exponential backoff with jitter shared by every worker: a host backing off is paused for all of them."
+
+    MAX_ATTEMPTS = 5
+    BASE_DELAYS = {'rate_limit': 5.0, 'server': 2.0, 'timeout': 1.0}  # seconds before the first retry
+    MAX_DELAY = 120.0
+    # Second-level labels registered under a country code (www.bbc.co.uk, foo.com.au): the site is one label deeper.
+    COUNTRY_SECOND_LEVELS = {'ac', 'co', 'com', 'edu', 'gob', 'go', 'gov', 'ltd', 'mil', 'ne', 'net', 'or', 'org', 'plc', 'sch'}
+
+    def __init__(self):
+        self.hosts = {}  # host -> {'failures': consecutive failures, 'paused_until': monotonic time}
+        self._lock = threading.Lock()
+
+    # Hosts are grouped by registered domain: the media of one site is served by many numbered servers
+    # (rr3---sn-abc.googlevideo.com -> googlevideo.com), but unrelated sites under a public suffix such as
+    # co.uk or com.au stay apart (www.bbc.co.uk -> bbc.co.uk).
+    @classmethod
+    def host_key(cls, url):
+        host = urllib.parse.urlparse(url or '').hostname or ''
+        if not host or host.replace('.', '').isdigit() or ':' in host:
+            return host  # IP address
+        labels = host.split('.')
+        depth = 3 if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in cls.COUNTRY_SECOND_LEVELS else 2
+        return '.'.join(labels[-depth:])
+
+    # 'rate_limit', 'server' or 'timeout' for a transient error (exception or message), None otherwise.
+    @staticmethod
+    def classify(error):
+        message = str(error)
+        if 'HTTP Error 429' in message or 'Too Many Requests' in message:
+            return 'rate_limit'
+        if re.search(r'HTTP Error 5\d\d', message):
+            return 'server'
+        if isinstance(error, TimeoutError) or 'timed out' in message.lower():
+            return 'timeout'
+        return None
+
+    def backoff_delay(self, kind, failures):
+        delay = min(self.MAX_DELAY, self.BASE_DELAYS[kind] * 2 ** failures)
+        return delay / 2 + random.uniform(0, delay / 2)  # jitter keeps the workers from retrying in step
+
+    # Block while the host is paused by a failure of any worker.
+    def wait(self, host):
+        while True:
+            with self._lock:
+                state = self.hosts.get(host)
+                remaining = state['paused_until'] - time.monotonic() if state else 0
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def failure(self, host, kind):
+        with self._lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'paused_until': 0.0})
+            delay = self.backoff_delay(kind, state['failures'])
+            state['failures'] += 1
+            state['paused_until'] = max(state['paused_until'], time.monotonic() + delay)
+        logging.warning(f"{kind.replace('_', ' ')} error from {host}, pausing it for {delay:.1f}s")
+        return delay
+
+    def success(self, host):
+        with self._lock:
+            state = self.hosts.get(host)
+            if state:
+                state['failures'] //= 2  # Recover progressively, the limit may still be close
+
+    # Run func() for a request to url, retrying transient errors after the host backoff.
+    def call(self, url, func, *args, **kwargs):
+        host = self.host_key(url)
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            self.wait(host)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                kind = self.classify(e)
+                if kind is None or attempt == self.MAX_ATTEMPTS:
+                    raise
+                self.failure(host, kind)
+                logging.info(f"Retrying {url} (attempt {attempt + 1}/{self.MAX_ATTEMPTS})")
+                continue
+            self.success(host)
+            return result
+
+    # Progress hook and YdlLogger observer of a media download, whose retries yt-dlp runs itself:
+    # the errors it reports pause the media host, and every download from a paused host waits in the hook.
+    def watch_download(self):
+        current = {'host': None, 'url': None, 'fragment': None}
+
+        def hook(d):
+            url = (d.get('info_dict') or {}).get('url')
+            if url != current['url']:
+                current['url'], current['host'] = url, self.host_key(url)
+            if not current['host']:
+                return
+            self.wait(current['host'])
+            # A fragment or a file went through: the host is accepting requests again
+            if d['status'] == 'finished' or d.get('fragment_index') != current['fragment']:
+                current['fragment'] = d.get('fragment_index')
+                self.success(current['host'])
+
+        def observe(level, msg):
+            if level in ('warning', 'error') or 'Got error' in msg:
+                kind = self.classify(msg)
+                if kind and current['host']:
+                    self.failure(current['host'], kind)
+
+        return hook, observe
+
+
+class DiskSpacePlanner:
+    "Admit downloads only when the filesystems they write to have room for them, next to the downloads in progress."
+
+    # A reservation is the peak usage of a download (streams + merged copy) from its admission to its final move.
+    # The bytes already written by a running download are counted twice (in its reservation and missing from the
+    # free space), which only makes the admission conservative.
+    def __init__(self, margin=0, poll_interval=5.0):
+        self.margin = margin  # bytes always left free on every filesystem
+        self.poll_interval = poll_interval
+        self.reservations = {}  # key -> {device: (directory, bytes)}
+        self._cond = threading.Condition()
+
+    # Filesystem of a directory, which may not exist yet.
+    @staticmethod
+    def device(path):
+        path = os.path.abspath(path)
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev
+
+    # needs: {directory: bytes}. Directories on the same filesystem share their space: the largest need is kept,
+    # e.g. the final move of a file staged on the same filesystem is a rename.
+    def by_device(self, needs):
+        devices = {}
+        for directory, nbytes in needs.items():
+            device = self.device(directory)
+            if device not in devices or nbytes > devices[device][1]:
+                devices[device] = (directory, nbytes)
+        return devices
+
+    # Bytes missing on each filesystem to admit the needs now, {} when they fit.
+    def shortfall(self, devices):
+        missing = {}
+        for device, (directory, nbytes) in devices.items():
+            reserved = sum(r[device][1] for r in self.reservations.values() if device in r)
+            path = directory
+            while not os.path.exists(path):
+                path = os.path.dirname(path)
+            available = shutil.disk_usage(path).free - self.margin - reserved
+            if nbytes > available:
+                missing[directory] = nbytes - max(0, available)
+        return missing
+
+    # Wait until the needs fit next to the other reservations. Returns False when they would not fit even
+    # without any other download in progress.
+    def reserve(self, key, needs, label=None):
+        devices = self.by_device(needs)
+        logged = False
+        with self._cond:
+            while True:
+                missing = self.shortfall(devices)
+                if not missing:
+                    self.reservations[key] = devices
+                    return True
+                details = ', '.join(f"{nbytes / 1024 / 1024:.0f}MB more in {d}" for d, nbytes in missing.items())
+                if not self.reservations:
+                    logging.error(f"Not enough disk space for '{label or key}': {details}")
+                    return False
+                if not logged:
+                    logging.info(f"Waiting for disk space for '{label or key}' ({details}, {len(self.reservations)} downloads in progress)")
+                    logged = True
+                self._cond.wait(self.poll_interval)  # Also picks up space freed outside of the downloader
+
+    def release(self, key):
+        with self._cond:
+            if self.reservations.pop(key, None) is not None:
+                self._cond.notify_all()
+
+
+class TranscodePool:
+    "CPU budget of the ffmpeg encodes: at most `jobs` encodes run at the same time, each with its share of the cores."
+
+    def __init__(self, cores=0, jobs=1):
+        self.cores = cores or os.cpu_count() or 1
+        self.jobs = max(1, min(jobs, self.cores))
+        self.threads = max(1, self.cores // self.jobs)  # '-threads' of every encode, the total never exceeds the budget
+        self.active = 0
+        self._slots = threading.BoundedSemaphore(self.jobs)
+        self._lock = threading.Lock()
+
+    # with pool.slot() as threads: run one ffmpeg encode with `threads` threads
+    @contextlib.contextmanager
+    def slot(self):
+        self._slots.acquire()
+        with self._lock:
+            self.active += 1
+        try:
+            yield self.threads
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
+
+
+class QualityPolicy:
+    "Picks the highest resolution whose download fits a share of the remaining time and byte budgets of the run."
+
+    # The time budget is converted to bytes with the link throughput: measured on the progress snapshots of the
+    # downloads, remembered across runs in a small JSON file, or assumed until then. Each video gets an equal share
+    # of what is left once the downloads in progress are accounted for, so a video cheaper than its share leaves
+    # more room to the next ones. Only the videos listed so far count, a playlist still being paged through gets
+    # bigger shares at first.
+    THROUGHPUT_WINDOW = 60.0        # seconds of measurements averaged in the throughput estimate
+    THROUGHPUT_MAX_AGE = 7 * 86400  # a remembered throughput older than this is not trusted
+
+    def __init__(self, time_budget=0, byte_budget=0, throughput=0, path=None):
+        self.deadline = time.time() + time_budget if time_budget > 0 else None
+        self.byte_budget = byte_budget
+        self.assumed = throughput  # bytes/s used until a throughput is measured
+        self.path = path
+        self.measured = None
+        self.measured_at = 0.0
+        self.expected = 0  # videos listed so far
+        self.chosen = 0
+        self.used = 0
+        self.reserved = {}    # key -> estimated bytes of a download in progress
+        self.downloaded = {}  # key -> bytes already received by that download
+        self.heights = defaultdict(int)
+        self._last_sample = None
+        self._lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if time.time() - state.get('measured_at', 0) < self.THROUGHPUT_MAX_AGE:
+                    self.measured, self.measured_at = state['throughput'], state['measured_at']
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable throughput file {self.path}: {e}")
+
+    @property
+    def enabled(self):
+        return self.deadline is not None or self.byte_budget > 0
+
+    # Pass the entries of a run through to count the videos sharing the budget.
+    def track(self, entries):
+        for entry in entries:
+            with self._lock:
+                self.expected += 1
+            yield entry
+
+    # ProgressAggregator listener: time-weighted average of the combined speed while downloads are active.
+    def observe(self, snapshot):
+        now = time.monotonic()
+        with self._lock:
+            for job in snapshot['jobs']:
+                if job['key'] in self.reserved:
+                    self.downloaded[job['key']] = job['downloaded']
+            if not snapshot['active'] or not snapshot['speed']:
+                self._last_sample = None
+                return
+            if self._last_sample is None or self.measured is None:
+                weight = 1.0 if self.measured is None else 0.1
+            else:
+                weight = 1 - math.exp(-(now - self._last_sample) / self.THROUGHPUT_WINDOW)
+            self.measured = snapshot['speed'] if self.measured is None else (
+                (1 - weight) * self.measured + weight * snapshot['speed'])
+            self.measured_at = time.time()
+            self._last_sample = now
+
+    # Throughput for the time budget, never above the bandwidth cap in force (0 = no cap).
+    def throughput(self, rate_cap=0):
+        rate = self.measured or self.assumed
+        if rate_cap > 0:
+            rate = min(rate, rate_cap) if rate else rate_cap
+        return rate
+
+    # Bytes each remaining video may use, None when the time budget cannot be converted yet (no throughput).
+    def share(self, rate_cap=0):
+        budgets = []
+        if self.byte_budget > 0:
+            budgets.append(self.byte_budget - self.used - sum(self.reserved.values()))
+        if self.deadline is not None:
+            rate = self.throughput(rate_cap)
+            if not rate:
+                return None
+            in_flight = sum(max(0, size - self.downloaded.get(key, 0)) for key, size in self.reserved.items())
+            budgets.append((self.deadline - time.time()) * rate - in_flight)
+        return max(0, min(budgets)) / max(1, self.expected - self.chosen)
+
+    # sizes: {height: estimated download size}. Returns the height for the format selection (0 = best) and
+    # reserves its size under key until settle().
+    def choose(self, key, sizes, max_height=0, rate_cap=0, label=None):
+        heights = sorted((h for h in sizes if not max_height or h <= max_height), reverse=True)
+        with self._lock:
+            share = self.share(rate_cap)
+            pending = max(1, self.expected - self.chosen)
+            self.chosen += 1
+            self.reserved[key] = 0  # The actual bytes are counted at settle()
+            if not heights:
+                logging.info(f"Quality policy: no size estimate for '{label or key}', "
+                             f"{f'{max_height}p' if max_height else 'best quality'} kept.")
+                return max_height
+            if share is None:
+                height, reason = heights[-1], "no throughput measured yet"
+            else:
+                height = next((h for h in heights if sizes[h] <= share), heights[-1])
+                reason = f"{share / 1024 / 1024:.1f}MB per video for {pending} videos"
+                if sizes[height] > share:
+                    reason += ", over budget"
+            self.reserved[key] = sizes[height]
+            self.heights[height] += 1
+        logging.info(f"Quality policy: {height}p for '{label or key}' ({sizes[height] / 1024 / 1024:.1f}MB, {reason}).")
+        return height
+
+    # The download of key ended after receiving nbytes (None = as last seen in the progress).
+    def settle(self, key, nbytes=None):
+        with self._lock:
+            if self.reserved.pop(key, None) is None:
+                return
+            received = self.downloaded.pop(key, 0)
+            self.used += nbytes if nbytes is not None else received
+        self.save()
+
+    def save(self):
+        if not self.path or self.measured is None:
+            return
+        try:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'throughput': self.measured, 'measured_at': self.measured_at}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save the measured throughput to {self.path}: {e}")
+
+    def summary(self):
+        return {
+            'heights': {f'{h}p': count for h, count in sorted(self.heights.items(), reverse=True)},
+            'bytes_used': self.used,
+            'throughput_bytes_per_s': int(self.measured or self.assumed or 0),
+            'seconds_left': round(self.deadline - time.time(), 1) if self.deadline is not None else None,
+        }
+
+
+class ProgressAggregator:
+    "Collects the yt-dlp progress of every active download and publishes a combined snapshot at a limited rate."
+
+    # rate: snapshots per second at most. Listeners are callables(snapshot), see snapshot() for the layout.
+    def __init__(self, rate=4.0):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.jobs = {}  # key -> {'label', 'files': {filename: [downloaded, total, speed]}}
+        self.listeners = []
+        self._next_publish = 0.0
+        self._publish_lock = threading.Lock()
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def register(self, key, label):
+        self.jobs[key] = {'label': label, 'files': {}}
+
+    # The last snapshot of a job is published at once, with the job marked as finished.
+    def unregister(self, key):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            self.publish(finished=[job['label']])
+
+    # yt-dlp progress hook of a job. Called for every block or fragment: it only stores the numbers,
+    # the formatting and the listeners run at most once per interval.
+    def progress_hook(self, key):
+        def hook(d):
+            job = self.jobs.get(key)
+            if job is None or d['status'] not in ('downloading', 'finished'):
+                return
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or (downloaded if d['status'] == 'finished' else 0)
+            job['files'][d.get('filename')] = [downloaded, total, d.get('speed') if d['status'] == 'downloading' else 0]
+            if time.monotonic() >= self._next_publish:
+                self.publish()
+        return hook
+
+    # Totals of every active job. ETAs are None while the speed or the size is unknown.
+    def snapshot(self):
+        jobs = []
+        for key, job in list(self.jobs.items()):
+            files = list(job['files'].values())
+            downloaded = sum(f[0] for f in files)
+            total = sum(f[1] for f in files)
+            speed = sum(f[2] or 0 for f in files)
+            jobs.append({
+                'key': key,
+                'label': job['label'],
+                'downloaded': downloaded,
+                'total': total or None,
+                'percent': downloaded / total * 100 if total else None,
+                'speed': speed,
+                'eta': (total - downloaded) / speed if total and speed else None,
+            })
+        downloaded = sum(j['downloaded'] for j in jobs)
+        remaining = sum(j['total'] - j['downloaded'] for j in jobs if j['total'])
+        speed = sum(j['speed'] for j in jobs)
+        return {
+            'time': time.time(),
+            'active': len(jobs),
+            'downloaded': downloaded,
+            'speed': speed,
+            'eta': remaining / speed if speed and all(j['total'] for j in jobs) else None,
+            'jobs': jobs,
+            'finished': [],
+        }
+
+    # Send a snapshot to the listeners. Hooks of other threads skip it instead of waiting, but the snapshot
+    # announcing a finished job waits for the lock so it is never lost.
+    def publish(self, finished=None):
+        if not self._publish_lock.acquire(blocking=bool(finished)):
+            return
+        try:
+            self._next_publish = time.monotonic() + self.interval
+            snapshot = self.snapshot()
+            snapshot['finished'] = finished or []
+            for listener in self.listeners:
+                try:
+                    listener(snapshot)
+                except Exception as e:
+                    logging.error(f"Progress listener failed: {str(e)}")
+        finally:
+            self._publish_lock.release()
+
+
+class StageTimer:
+    "Times one stage of one video for StageMetrics. Set .bytes, and .ok = False for a failure without exception."
+
+    __slots__ = ('metrics', 'name', 'url', 'title', 'bytes', 'ok', 'started')
+
+    def __init__(self, metrics, name, url=None, title=None):
+        self.metrics = metrics
+        self.name = name
+        self.url = url
+        self.title = title
+        self.bytes = 0
+        self.ok = True
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        self.metrics.record(self.name, duration, self.bytes, self.ok and exc_type is None, self.url, self.title)
+        return False
+
+
+class StageMetrics:
+    "Duration and bytes of every download stage, exported as JSON-lines events and a Prometheus textfile."
+
+    PREFIX = 'video_downloader'
+
+    # events_path: JSON-lines file receiving one event per stage run (appended).
+    # textfile_path: Prometheus textfile-collector file (*.prom) with the totals, rewritten on flush().
+    def __init__(self, events_path=None, textfile_path=None):
+        self.events_path = events_path
+        self.textfile_path = textfile_path
+        self.totals = defaultdict(lambda: {'seconds': 0.0, 'bytes': 0, 'ok': 0, 'failed': 0})
+        self._events = None
+        self._lock = threading.Lock()
+
+    # with metrics.stage('download', url, title) as timer: ...; timer.bytes = n
+    def stage(self, name, url=None, title=None):
+        return StageTimer(self, name, url, title)
+
+    def record(self, name, duration, nbytes=0, ok=True, url=None, title=None):
+        with self._lock:
+            totals = self.totals[name]
+            totals['seconds'] += duration
+            totals['bytes'] += nbytes or 0
+            totals['ok' if ok else 'failed'] += 1
+            if self.events_path:
+                if self._events is None:
+                    self._events = open(self.events_path, 'a', encoding='utf-8')
+                self._events.write(json.dumps({
+                    'ts': round(time.time(), 3),
+                    'event': 'stage',
+                    'stage': name,
+                    'url': url,
+                    'title': title,
+                    'duration_s': round(duration, 4),
+                    'bytes': nbytes or 0,
+                    'ok': ok,
+                }, ensure_ascii=False) + '\n')
+
+    # Make the events visible to readers and rewrite the textfile. Called after every video, not every stage.
+    def flush(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.flush()
+            if self.textfile_path:
+                self._write_textfile()
+
+    def _write_textfile(self):
+        metrics = [
+            ('stage_seconds_total', 'counter', "Time spent in each download stage.", 'seconds'),
+            ('stage_bytes_total', 'counter', "Bytes handled by each download stage.", 'bytes'),
+        ]
+        lines = []
+        for name, kind, help_text, field in metrics:
+            lines += [f"# HELP {self.PREFIX}_{name} {help_text}", f"# TYPE {self.PREFIX}_{name} {kind}"]
+            lines += [f'{self.PREFIX}_{name}{{stage="{stage}"}} {totals[field]}' for stage, totals in self.totals.items()]
+        lines += [f"# HELP {self.PREFIX}_stage_runs_total Runs of each download stage by result.",
+                  f"# TYPE {self.PREFIX}_stage_runs_total counter"]
+        for stage, totals in self.totals.items():
+            for result in ('ok', 'failed'):
+                lines.append(f'{self.PREFIX}_stage_runs_total{{stage="{stage}",result="{result}"}} {totals[result]}')
+        lines += [f"# HELP {self.PREFIX}_last_update_timestamp_seconds Time of the last metrics update.",
+                  f"# TYPE {self.PREFIX}_last_update_timestamp_seconds gauge",
+                  f"{self.PREFIX}_last_update_timestamp_seconds {time.time():.3f}"]
+
+        # The collector must never read a half-written file
+        temp_path = self.textfile_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.textfile_path)
+
+    # One line per stage for the logs, e.g. "download 52.1s 1.2GB (3 ok)".
+    def summary(self):
+        return " | ".join(
+            f"{stage} {totals['seconds']:.1f}s {totals['bytes'] / 1024 / 1024:.1f}MB ({totals['ok']} ok"
+            + (f", {totals['failed']} failed)" if totals['failed'] else ")")
+            for stage, totals in self.totals.items()
+        )
+
+
 class VideoDownloader:
     # SETTINGS, can be configure freely
     
     # Defaults
-    # Controls whether subtitle files leftover after embedding are kept.
+    # Controls whether the embedded subtitles are also saved next to the video (.ass files).
     GET_SUBTITLE_LEFTOVER = False  # Set True/False
 
     # Optional cookies file (not required by default).
@@ -28,10 +1970,132 @@ class VideoDownloader:
     # Controls whether the downloader requests subtitles via yt-dlp.
     # If True, yt-dlp will attempt to download subtitles (may trigger HTTP 429).
     DOWNLOAD_SUBTITLES = True      # Set True/False
+
+    # Number of playlist videos downloaded at the same time (1 = one after another with a quality prompt per video).
+    # Independent from 'concurrent_fragment_downloads', which splits a single video into parallel fragments.
+    MAX_CONCURRENT_DOWNLOADS = 3
+
+    # Workers of the other playlist pipeline stages (extraction -> download -> merge/embed -> finalize).
+    EXTRACT_WORKERS = 2  # download preparation (format selection) running ahead of the downloads
+    MERGE_WORKERS = 1    # ffmpeg merge/subtitle embedding passes
+
+    # Metadata of the next playlist entries resolved ahead of the downloads, while the playlist is still listed:
+    # at most PREFETCH_AHEAD entries ahead, PREFETCH_WORKERS extractions at a time, PREFETCH_PER_HOST per site.
+    PREFETCH_AHEAD = 8
+    PREFETCH_WORKERS = 4
+    PREFETCH_PER_HOST = 2
     
-    def __init__(self):
-        self.root = tk.Tk()
-        self.root.withdraw()
+    # Adaptive fragment concurrency: 'concurrent_fragment_downloads' is tuned per media host from the measured
+    # throughput and errors, within the limits below, and remembered in FRAGMENT_TUNING_FILE for the next run.
+    # Be cautious of server limit if increasing the maximum. False = fixed FRAGMENT_CONCURRENCY.
+    ADAPTIVE_FRAGMENTS = True
+    FRAGMENT_CONCURRENCY = 2
+    FRAGMENT_CONCURRENCY_LIMITS = {'default': (1, 8)}  # per host, e.g. {'googlevideo.com': (1, 4), 'default': (1, 8)}
+    FRAGMENT_TUNING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fragment_tuning.json')
+
+    # Progressive (single file) formats are downloaded over several connections, one byte range each, per host:
+    # host -> (connections, range size in bytes). Files smaller than two ranges, and connections = 1, use yt-dlp.
+    RANGE_DOWNLOADS = {'default': (4, 8 * 1024 * 1024)}  # e.g. {'googlevideo.com': (1, 0), 'default': (4, 8 * 1024 * 1024)}
+
+    # Global bandwidth budget shared by every download of this process, in bytes/s (0 = unlimited).
+    # Time-of-day windows override it, e.g. [('09:00', '18:00', 2 * 1024 * 1024)] for 2MB/s during business hours.
+    BANDWIDTH_LIMIT = 0
+    BANDWIDTH_WINDOWS = []
+
+    # Integrity verification of every download before it gets its final name: received bytes against the announced
+    # filesize, ffprobe check of the duration and the streams, content hash. The result is kept in the manifest.
+    VERIFY_INTEGRITY = True
+    APPROX_SIZE_TOLERANCE = 0.5  # 'filesize_approx' is an estimate, only a warning beyond this relative difference
+    DURATION_TOLERANCE = 2.0     # seconds (or 1% of the duration if larger)
+
+    # Sync mode for playlists downloaded again and again (channels): only the entries that are new since the
+    # previous sync of the same directory are processed. Optionally, the listing stops after this many already
+    # downloaded entries in a row; only for newest-first lists (channel uploads), a regular playlist adds its new
+    # videos at the end and they would never be reached. 0 = always list the whole playlist.
+    SYNC_PLAYLISTS = False
+    SYNC_STOP_AFTER_KNOWN = 0
+
+    # Optional transcode of the video stream during the merge pass, e.g. to normalize everything to H.264 720p for
+    # low-power players. None = the video stream is copied. Sources already in the target codec within the maximum
+    # height are copied too. The encodes share TRANSCODE_CPU_CORES (0 = all cores) between TRANSCODE_JOBS ffmpeg.
+    TRANSCODE_CODEC = None        # 'h264' or 'hevc'
+    TRANSCODE_MAX_HEIGHT = 0      # e.g. 720, 0 = keep the resolution
+    TRANSCODE_CRF = 23            # quality, lower is better (x264 default 23, x265 default 28)
+    TRANSCODE_PRESET = 'medium'   # x264/x265 speed preset: ultrafast ... veryslow
+    TRANSCODE_CPU_CORES = 0
+    TRANSCODE_JOBS = 1
+    # codec -> (ffmpeg encoder, codec names of a matching source in yt-dlp formats / ffprobe, extra output options)
+    TRANSCODE_CODECS = {
+        'h264': ('libx264', ('avc1', 'h264'), []),
+        'hevc': ('libx265', ('hev1', 'hvc1', 'hevc', 'h265'), ['-tag:v', 'hvc1']),  # hvc1 tag for Apple players
+    }
+    
+    # Disk space planning: a download starts only when the selected formats fit on disk next to the downloads in
+    # progress (streams + merged copy), from their 'filesize' estimates. DISK_SPACE_MARGIN bytes are always left free.
+    CHECK_DISK_SPACE = True
+    DISK_SPACE_MARGIN = 512 * 1024 * 1024
+    
+    # Optional fast scratch directory (tmpfs, local NVMe) for the streams, subtitles and merge output of the
+    # downloads. Each finished video is then moved once to the output directory. None = work in the output directory.
+    SCRATCH_DIR = None
+
+    # Quality policy for unattended runs: instead of a fixed height or the prompt, every video gets the highest
+    # resolution whose download fits its share of a time and/or byte budget of the run, from the 'filesize' estimates
+    # of its formats and the measured link throughput (remembered in QUALITY_THROUGHPUT_FILE). 0 = no budget.
+    QUALITY_TIME_BUDGET = 0   # seconds of downloading for the whole run, e.g. 6 * 3600 for a nightly window
+    QUALITY_BYTE_BUDGET = 0   # bytes for the whole run, e.g. 50 * 1024 ** 3 for a data cap
+    QUALITY_THROUGHPUT = 0    # assumed throughput in bytes/s until one is measured (0 = lowest quality until then)
+    QUALITY_THROUGHPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'throughput.json')
+
+    # Daemon mode (--daemon): address of the job API, 'host:port' on localhost or 'unix:/path/to/socket'.
+    DAEMON_ADDRESS = '127.0.0.1:8750'
+
+    # Keep the yt-dlp instances (connections, cookies, extractors) for all the videos of a run.
+    REUSE_YDL_SESSION = True
+
+    # Refreshes per second of the progress display, whatever the number of downloads.
+    PROGRESS_RATE = 4
+
+    # Stage timings (extract, subtitles, download, remux or transcode, verify, rename) are always measured and logged.
+    # They can also be exported as JSON-lines events and as a Prometheus textfile-collector file (None = disabled).
+    METRICS_EVENTS_FILE = None        # e.g. 'downloader_events.jsonl'
+    PROMETHEUS_TEXTFILE = None        # e.g. '/var/lib/node_exporter/textfile_collector/video_downloader.prom'
+
+    # Preferred video codecs for the automatic format selection, in order. Any mp4 video is the fallback.
+    CODEC_PREFERENCE = ('hevc', 'avc1')  # HEVC (H.265) format: 313, AVC (H.264) format: 137 or 299
+
+    # interactive=False (batch mode) never imports tkinter and never prompts.
+    def __init__(self, interactive=True):
+        self.interactive = interactive
+        self.codec_preference = list(self.CODEC_PREFERENCE)
+        self.manifests = {}
+        self.journals = {}
+        self.sync_states = {}
+        self._manifest_lock = threading.Lock()
+        self.fragment_tuner = FragmentTuner(
+            self.FRAGMENT_TUNING_FILE,
+            self.FRAGMENT_CONCURRENCY_LIMITS,
+            default_limits=self.FRAGMENT_CONCURRENCY_LIMITS.get('default', (1, 8)),
+            start=self.FRAGMENT_CONCURRENCY,
+        )
+        self.bandwidth = BandwidthLimiter(self.BANDWIDTH_LIMIT, self.BANDWIDTH_WINDOWS)
+        self.retry = RetryScheduler()
+        self.prefetcher = MetadataPrefetcher(self.PREFETCH_WORKERS, self.PREFETCH_AHEAD, self.PREFETCH_PER_HOST)
+        self._bandwidth_keys = itertools.count(1)  # also identify the download in the progress display
+        self.progress = ProgressAggregator(self.PROGRESS_RATE)
+        self.metrics = StageMetrics(self.METRICS_EVENTS_FILE, self.PROMETHEUS_TEXTFILE)
+        self.disk_planner = DiskSpacePlanner(self.DISK_SPACE_MARGIN)
+        self.transcode_pool = TranscodePool(self.TRANSCODE_CPU_CORES, self.TRANSCODE_JOBS)
+        self.quality_policy = QualityPolicy(self.QUALITY_TIME_BUDGET, self.QUALITY_BYTE_BUDGET,
+                                            self.QUALITY_THROUGHPUT, self.QUALITY_THROUGHPUT_FILE)
+        self.progress.add_listener(lambda snapshot: self.quality_policy.observe(snapshot))
+        self._progress_width = 0
+        self.root = None
+        if self.interactive:
+            import tkinter as tk  # Only the interactive mode needs a (hidden) Tk root for the dialogs
+            self.root = tk.Tk()
+            self.root.withdraw()
+            self.progress.add_listener(self.print_progress)  # Batch mode keeps stdout for the summary
         # Attempt to Check for the user-set environment variable or Search the system's PATH
         self.ffmpeg_path = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg")
 
@@ -42,102 +2106,324 @@ class VideoDownloader:
         # Verify FFmpeg installation
         if not os.path.exists(self.ffmpeg_path):
             logging.error(f"FFmpeg not found at {self.ffmpeg_path}")
-            self.ffmpeg_path = filedialog.askopenfilename(title="Locate ffmpeg.exe")
+            if self.interactive:
+                from tkinter import filedialog
+                self.ffmpeg_path = filedialog.askopenfilename(title="Locate ffmpeg.exe")
             if not os.path.exists(self.ffmpeg_path):
+                if not self.interactive:
+                    # Batch mode: reported as a fatal error with the JSON output of the run
+                    raise FileNotFoundError(f"FFmpeg not found at {self.ffmpeg_path}, set FFMPEG_PATH or add it to PATH")
                 logging.error("FFmpeg is still not found. Exiting.")
                 exit(1)
         else:
             logging.info(f"Found FFmpeg at: {self.ffmpeg_path}")
+        
+        # ffprobe (integrity probe) ships next to ffmpeg; without it the probe is skipped
+        ffprobe_name = 'ffprobe.exe' if self.ffmpeg_path.lower().endswith('.exe') else 'ffprobe'
+        ffprobe_path = os.path.join(os.path.dirname(self.ffmpeg_path), ffprobe_name)
+        self.ffprobe_path = ffprobe_path if os.path.exists(ffprobe_path) else shutil.which('ffprobe')
+        if self.VERIFY_INTEGRITY and not self.ffprobe_path:
+            logging.warning("ffprobe not found, downloads are verified without the container probe.")
+        
+        self.session = YdlSession(
+            {**self.get_base_ydl_opts(), 'ffmpeg_location': self.ffmpeg_path},
+            reuse=self.REUSE_YDL_SESSION,
+        )
 
-    # Print download progress.
-    def print_progress(self, d):
+    # Print the combined download progress (ProgressAggregator listener) on a single refreshed line.
+    def print_progress(self, snapshot):
         
-        if d['status'] == 'downloading':
-            try:
-                if 'total_bytes' in d:
-                    percentage = d['downloaded_bytes'] / d['total_bytes'] * 100
-                    downloaded_mb = d['downloaded_bytes'] / 1024 / 1024
-                    total_mb = d['total_bytes'] / 1024 / 1024
-                    print(f"\rProgress: {percentage:.1f}% ({downloaded_mb:.1f}MB of {total_mb:.1f}MB)", end='')
-                elif 'downloaded_bytes' in d:
-                    downloaded_mb = d['downloaded_bytes'] / 1024 / 1024
-                    print(f"\rDownloaded: {downloaded_mb:.1f}MB", end='')
-            except:
-                print(f"\rDownloading...", end='')
-        elif d['status'] == 'finished':
-            print("\nDownload completed!")
-
-    # Get available video formats.
-    def get_video_formats(self, url):
+        for label in snapshot['finished']:
+            print(f"\r{'':<{self._progress_width}}\rDownload completed: {label}")
+        if not snapshot['jobs']:
+            self._progress_width = 0
+            return
         
-        ydl_opts = {
-            'ffmpeg_location': self.ffmpeg_path,
-            'quiet': False,
-        }
+        def mb(size):
+            return f"{size / 1024 / 1024:.1f}MB"
         
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            # Group formats by resolution
-            formats_by_res = defaultdict(list)
-            video_formats = []
+        def eta(seconds):
+            return f"{int(seconds // 60)}:{int(seconds % 60):02d}" if seconds is not None else '--:--'
+        
+        if len(snapshot['jobs']) == 1:
+            job = snapshot['jobs'][0]
+            if job['total']:
+                line = f"Progress: {job['percent']:.1f}% ({mb(job['downloaded'])} of {mb(job['total'])})"
+            else:
+                line = f"Downloaded: {mb(job['downloaded'])}"
+            line += f" {mb(job['speed'])}/s ETA {eta(job['eta'])}"
+        else:
+            parts = [f"{snapshot['active']} downloads {mb(snapshot['speed'])}/s ETA {eta(snapshot['eta'])}"]
+            for job in snapshot['jobs']:
+                done = f"{job['percent']:.0f}%" if job['percent'] is not None else mb(job['downloaded'])
+                parts.append(f"{job['label'][:20]} {done} {mb(job['speed'])}/s {eta(job['eta'])}")
+            line = ' | '.join(parts)
+        
+        print(f"\r{line:<{self._progress_width}}", end='', flush=True)
+        self._progress_width = len(line)
+
+    # Extract the video metadata once; the returned info dict is reused for the whole download.
+    def extract_video_info(self, url):
+        
+        with self.metrics.stage('extract', url), self.session.use(quiet=True) as ydl:
+            return self.retry.call(url, ydl.extract_info, url, download=False)
+
+    # Get available video formats. An already extracted info dict avoids a new network round-trip.
+    def get_video_formats(self, url, info=None):
+        
+        if info is None:
+            info = self.extract_video_info(url)
             
-            for f in info['formats']:
-                # Skip audio-only formats
-                if f.get('vcodec') == 'none': 
-                    continue
-                    
-                # Get resolution
-                res = f.get('resolution', 'unknown')
-                height = f.get('height', 0)
-                
-                # Create format info
-                format_info = {
-                    'format_id': f['format_id'],
-                    'ext': f['ext'],
-                    'resolution': res,
-                    'filesize': f.get('filesize', 0),
-                    'vcodec': f.get('vcodec', 'unknown'),
-                    'acodec': f.get('acodec', 'unknown'),
-                    'height': height,
-                }
+        # Group formats by resolution
+        formats_by_res = defaultdict(list)
+        video_formats = []
+        
+        for f in info['formats']:
+            # Skip audio-only formats
+            if f.get('vcodec') == 'none': 
+                continue
                 
-                formats_by_res[height].append(format_info)
-                video_formats.append(format_info)
+            # Get resolution
+            res = f.get('resolution', 'unknown')
+            height = f.get('height', 0)
             
-            return info, formats_by_res, video_formats
+            # Create format info
+            format_info = {
+                'format_id': f['format_id'],
+                'ext': f['ext'],
+                'resolution': res,
+                'filesize': f.get('filesize', 0),
+                'size_estimate': self.estimate_format_size(f, info.get('duration')),
+                'vcodec': f.get('vcodec', 'unknown'),
+                'acodec': f.get('acodec', 'unknown'),
+                'height': height,
+            }
+            
+            formats_by_res[height].append(format_info)
+            video_formats.append(format_info)
+        
+        return info, formats_by_res, video_formats
 
-    # Returns the base ydl options for all requests to avoid rate limiting
-    def get_base_ydl_opts(self):
+    # Bytes of a format from the site's exact or approximate filesize, or its bitrate and the duration. None when unknown.
+    @staticmethod
+    def estimate_format_size(f, duration=None):
+        nbytes = f.get('filesize') or f.get('filesize_approx')
+        if not nbytes and f.get('tbr') and duration:
+            nbytes = f['tbr'] * 1000 / 8 * duration  # tbr is in kbit/s
+        return int(nbytes) if nbytes else None
+
+    # Estimated download size of each height for the quality policy: the largest video format of the height (the
+    # selector may pick a smaller one), plus the largest audio-only format when the video has no audio.
+    def estimate_height_sizes(self, info, formats_by_res):
+        audio_sizes = [
+            self.estimate_format_size(f, info.get('duration')) or 0
+            for f in info.get('formats') or [] if f.get('vcodec') == 'none' and f.get('acodec') != 'none'
+        ]
+        audio_size = max(audio_sizes, default=0)
+        sizes = {}
+        for height, formats in formats_by_res.items():
+            estimates = [
+                f['size_estimate'] + (audio_size if f['acodec'] == 'none' else 0)
+                for f in formats if f['size_estimate']
+            ]
+            if height and estimates:
+                sizes[height] = max(estimates)
+        return sizes
+
+    # Download manifest of a save directory, loaded once and shared by every job.
+    def get_manifest(self, save_dir):
+        save_dir = os.path.abspath(save_dir)
+        with self._manifest_lock:
+            if save_dir not in self.manifests:
+                self.manifests[save_dir] = DownloadManifest(save_dir)
+            return self.manifests[save_dir]
+
+    # Job journal of a save directory, shared by every job like the manifest.
+    def get_journal(self, save_dir):
+        save_dir = os.path.abspath(save_dir)
+        with self._manifest_lock:
+            if save_dir not in self.journals:
+                self.journals[save_dir] = JobJournal(save_dir)
+            return self.journals[save_dir]
+
+    # Directory receiving the temp files of the downloads to a save directory: its own folder in SCRATCH_DIR,
+    # or the save directory itself.
+    def get_work_dir(self, save_dir):
+        if not self.SCRATCH_DIR:
+            return save_dir
+        name = hashlib.sha1(os.path.abspath(save_dir).encode('utf-8')).hexdigest()[:12]
+        work_dir = os.path.join(self.SCRATCH_DIR, name)
+        os.makedirs(work_dir, exist_ok=True)
+        return work_dir
+
+    # Crash recovery of a save directory before a run: delete the temp files the journal knows are leftovers
+    # (streams already merged, half-written merge outputs, files of finalized videos) and compact the journal.
+    # The '.part' files and the outputs of unfinished stages are kept so the next run resumes from them.
+    def recover_journal(self, save_dir):
+        journal = self.get_journal(save_dir)
+        kept = {os.path.abspath(entry['path']) for entry in self.get_manifest(save_dir).entries.values() if entry.get('path')}
+        
+        for entry in journal.entries.values():
+            stage = entry.get('stage')
+            leftovers = []
+            if stage == 'finalized':
+                leftovers += entry.get('stream_files', []) + [entry.get('temp_output_file')]
+            elif stage == 'merged':
+                leftovers += entry.get('stream_files', [])
+            elif stage == 'downloaded':
+                leftovers.append(entry.get('temp_output_file'))  # The merge is redone from the streams
+            
+            for path in leftovers:
+                if path and os.path.exists(path) and os.path.abspath(path) not in kept:
+                    try:
+                        os.remove(path)
+                        logging.info(f"Deleted leftover temp file: {path}")
+                    except OSError as e:
+                        logging.error(f"Error deleting leftover temp file {path}: {e}")
+        
+        journal.compact()
+        if journal.entries:
+            logging.info(f"{len(journal.entries)} interrupted downloads found in the journal, resuming them.")
+        return journal
+
+    # Download context of a video interrupted after its download or merge stage, rebuilt from the journal
+    # without any network call. Returns None when the video must go through the normal stages
+    # (an interrupted download restarts from its '.part' files).
+    def resume_context(self, url, save_path, priority=1.0):
+        entry = self.get_journal(save_path).get(url)
+        if not entry or entry.get('stage') not in ('downloaded', 'merged'):
+            return None
+        
+        if entry['stage'] == 'merged':
+            needed = [entry['temp_output_file']]
+        else:
+            needed = entry.get('stream_files') or [None]
+        if not all(path and os.path.exists(path) for path in needed):
+            return None
+        
+        logging.info(f"Resuming '{entry['video_title']}' after the {entry['stage']} stage.")
         return {
+            'url': url,
+            'info': {'id': entry.get('id'), 'extractor_key': entry.get('extractor_key'), 'title': entry['video_title']},
+            'save_path': save_path,
+            'work_dir': os.path.dirname(entry['temp_output_file']),
+            'video_title': entry['video_title'],
+            'sanitized_title': entry['sanitized_title'],
+            'ydl_opts': None,
+            'fragment_probe': None,
+            'content_hasher': None,
+            'bandwidth_key': None,
+            'priority': priority,
+            'downloaded_info': {'format_id': entry.get('format_id')},
+            'stream_files': entry.get('stream_files', []),
+            'stream_sizes': entry.get('stream_sizes', []),
+            'subtitles': self.load_journal_subtitles(entry),
+            'temp_output_file': entry['temp_output_file'],
+            'completed_stage': entry['stage'],
+        }
+
+    # Subtitles of a video resumed before its mux.
+    @staticmethod
+    def load_journal_subtitles(entry):
+        if entry.get('stage') != 'downloaded' or not entry.get('subtitles_file'):
+            return {}
+        try:
+            with open(entry['subtitles_file'], 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Subtitles of '{entry['video_title']}' lost ({str(e)}), merged without them.")
+            return {}
+
+    # Returns the base ydl options for all requests to avoid rate limiting
+    # bandwidth_key puts a media download under the shared bandwidth budget (see BandwidthLimiter).
+    def get_base_ydl_opts(self, bandwidth_key=None):
+        ydl_opts = {
             'socket_timeout': 15,
-            # 'retries': 10, # not needed until issues appear
-            # 'fragment_retries': 10,
-            # 'sleep_interval': 2, 
-            # 'max_sleep_interval': 6,
-            # 'sleep_subtitles': 5, 
+            # Metadata and subtitle requests are retried by self.retry (per-host backoff shared by the workers).
+            # Media downloads are retried by yt-dlp with the same jittered exponential delays.
+            'retries': 10,
+            'fragment_retries': 10,
+            'retry_sleep_functions': {
+                'http': lambda n: self.retry.backoff_delay('server', n),
+                'fragment': lambda n: self.retry.backoff_delay('server', n),
+            },
+            'skip_unavailable_fragments': False,  # A video with holes fails instead of passing as complete
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
             },
         }
+        if bandwidth_key is not None and self.bandwidth.enabled:
+            # yt-dlp caps each download at the whole budget, the shared hook splits it between the active jobs
+            ydl_opts['ratelimit'] = self.bandwidth.max_rate()
+            ydl_opts['progress_hooks'] = [self.bandwidth.progress_hook(bandwidth_key)]
+        return ydl_opts
     
-    # Extract video URLs from a playlist.
-    def get_playlist_videos(self, url):
-        
-        ydl_opts = self.get_base_ydl_opts()
-        ydl_opts['extract_flat'] = 'in_playlist'
-        ydl_opts['quiet'] = True
-        
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if 'entries' in info:
-                # Extract video URLs from playlist
-                logging.info(f"Found {len(info['entries'])} videos in the playlist.")
-                video_urls = {entry['url'] for entry in info['entries']}
-                return video_urls
-            else:
+    # Yield the (video URL, manifest key) entries of a playlist while the extractor pages through it, in playlist
+    # order and once per video ID.
+    # known: manifest keys of the entries downloaded by the previous syncs (sync mode). They are left out, and
+    # with SYNC_STOP_AFTER_KNOWN the listing stops after that many known entries in a row, for newest-first lists
+    # where the remaining pages only hold older entries.
+    def iter_playlist_entries(self, url, known=None):
+        # The playlist has its own yt-dlp instance: the downloads may run in this thread between two pages
+        with self.session.use('playlist', extract_flat='in_playlist', quiet=True) as ydl:
+            info = self.retry.call(url, ydl.extract_info, url, download=False, process=False)
+            while info.get('_type') in ('url', 'url_transparent'):  # e.g. a channel URL redirecting to its videos tab
+                info = ydl.extract_info(info['url'], download=False, ie_key=info.get('ie_key'), process=False)
+            if 'entries' not in info:
                 logging.error("Not a valid playlist URL or no videos found.")
-                return set()
+                return
+            
+            seen = set()
+            listed = new = known_streak = 0
+            for entry in info['entries']:  # Lazy: the next page is only fetched when the iteration reaches it
+                if not entry or not entry.get('url'):
+                    continue
+                listed += 1
+                key = DownloadManifest.make_key(entry.get('ie_key'), entry.get('id'))
+                if (key or entry['url']) in seen:
+                    continue  # Same video listed twice (e.g. channel pages shifting while they are fetched)
+                seen.add(key or entry['url'])
+                if known is not None and key in known:
+                    known_streak += 1
+                    if self.SYNC_STOP_AFTER_KNOWN and known_streak >= self.SYNC_STOP_AFTER_KNOWN:
+                        break
+                    continue
+                known_streak = 0
+                new += 1
+                yield entry['url'], key
+        
+        if known is not None:
+            logging.info(f"Playlist sync: {new} new videos ({listed} entries listed, {len(known)} known).")
+        else:
+            logging.info(f"Found {new} videos in the playlist.")
+
+    # Sync state of a save directory, shared like the manifest.
+    def get_sync_state(self, save_dir):
+        save_dir = os.path.abspath(save_dir)
+        with self._manifest_lock:
+            if save_dir not in self.sync_states:
+                self.sync_states[save_dir] = PlaylistSyncState(save_dir)
+            return self.sync_states[save_dir]
+
+    # Entries of a playlist to process, as they are listed: all of them, or only the new ones since the last sync
+    # (SYNC_PLAYLISTS). listed: optional dict receiving the {video URL: manifest key} entries for update_sync_state.
+    def list_playlist(self, url, save_dir, listed=None):
+        known = self.get_sync_state(save_dir).known(url) if self.SYNC_PLAYLISTS else None
+        for entry_url, key in self.iter_playlist_entries(url, known):
+            if listed is not None:
+                listed[entry_url] = key
+            yield entry_url, key
+
+    # After a run, remember the listed entries that are now downloaded. The failed ones stay new for the next sync.
+    # playlists: {playlist URL: {video URL: manifest key}} as listed by list_playlist.
+    def update_sync_state(self, save_dir, playlists):
+        if not self.SYNC_PLAYLISTS or not playlists:
+            return
+        manifest = self.get_manifest(save_dir)
+        state = self.get_sync_state(save_dir)
+        for playlist_url, entries in playlists.items():
+            state.add(playlist_url, [key for key in entries.values() if key and manifest.is_complete(key)])
+        state.save()
 
     # Display available video formats.
     def display_formats(self, formats_by_res):
@@ -162,12 +2448,33 @@ class VideoDownloader:
         return sorted_heights
 
     # Verify if the downloaded file is complete.
-    def verify_file_integrity(self, file_path, expected_size):
+    # Compare a received byte count with the announced size, exactly or within a relative tolerance.
+    def verify_file_integrity(self, actual_size, expected_size, tolerance=0.0):
         
-        if os.path.exists(file_path):
-            actual_size = os.path.getsize(file_path)
-            return actual_size == expected_size
-        return False
+        if not expected_size:
+            return True  # Nothing announced, nothing to compare
+        return abs(actual_size - expected_size) <= expected_size * tolerance
+
+    # Container probe of a media file with ffprobe: duration and streams. None when ffprobe is not available.
+    def probe_media(self, file_path):
+        if not self.ffprobe_path:
+            return None
+        result = subprocess.run(
+            [self.ffprobe_path, '-v', 'error', '-show_entries', 'format=duration:stream=codec_type,codec_name,height',
+             '-of', 'json', file_path],
+            capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60,
+        )
+        if result.returncode != 0:
+            return {'error': result.stderr.strip() or f"ffprobe exited with {result.returncode}"}
+        data = json.loads(result.stdout or '{}')
+        duration = data.get('format', {}).get('duration')
+        video = next((stream for stream in data.get('streams', []) if stream.get('codec_type') == 'video'), {})
+        return {
+            'duration': float(duration) if duration not in (None, 'N/A') else None,
+            'streams': [stream.get('codec_type') for stream in data.get('streams', [])],
+            'video_codec': video.get('codec_name'),
+            'height': video.get('height'),
+        }
     
     
     # Replace invalid characters in case if file name is invalid
@@ -178,39 +2485,56 @@ class VideoDownloader:
             filename = filename.replace(char, '_')
         return filename
 
-    def reencode_video(self, input_path, output_path, subtitle_paths=None):
+    # Merge the downloaded streams (video, audio) and the subtitles into one mp4 in a single ffmpeg pass.
+    # subtitles: {language: SRT text}, fed to ffmpeg through pipes (temp .srt files on Windows).
+    # hasher: optional StreamingHasher fed with the output while ffmpeg writes it.
+    # video_args: encoder options of the video stream (see transcode_args), the video is copied by default.
+    def reencode_video(self, input_paths, output_path, subtitles=None, hasher=None, video_args=None):
+        if isinstance(input_paths, str):
+            input_paths = [input_paths]
+        subtitles = subtitles or {}
+        pipes = []       # (write end, SRT bytes) of every subtitle input
+        temp_files = []
         try:    
-            logging.info(f"Re-encoding video: {input_path} -> {output_path}")
-            if subtitle_paths:
-                logging.info(f"Subtitles to merge: {subtitle_paths}")
+            logging.info(f"Re-encoding video: {input_paths} -> {output_path}")
+            if subtitles:
+                logging.info(f"Subtitles to merge: {list(subtitles)}")
             
-            command = [
-                self.ffmpeg_path,
-                '-i', input_path,  # Input video file
-            ]
+            command = [self.ffmpeg_path, '-y', '-hide_banner', '-loglevel', 'error']  # Only the errors on stderr
+            for input_path in input_paths:
+                command.extend(['-i', input_path])  # Input video / audio file
 
             # Add subtitle inputs if available
-            if subtitle_paths:
-                for sub_path in subtitle_paths:
-                    command.extend(['-i', sub_path])
+            for lang, srt in subtitles.items():
+                if os.name == 'posix':
+                    read_fd, write_fd = os.pipe()
+                    pipes.append((read_fd, write_fd, srt.encode('utf-8')))
+                    command.extend(['-f', 'srt', '-i', f'pipe:{read_fd}'])  # ffmpeg reads the inherited descriptor
+                else:
+                    sub_path = f"{os.path.splitext(output_path)[0]}.{lang}.srt"
+                    with open(sub_path, 'w', encoding='utf-8') as f:
+                        f.write(srt)
+                    temp_files.append(sub_path)
+                    command.extend(['-f', 'srt', '-i', sub_path])
 
+            command.extend(video_args or ['-c:v', 'copy'])  # Copy video stream (no re-encoding) unless transcoding
+            command.extend(['-c:a', 'copy'])  # Copy audio stream (no re-encoding)
+            for idx in range(len(input_paths)):
+                command.extend([
+                    '-map', f'{idx}:v?',  # Map video stream from input idx (if any)
+                    '-map', f'{idx}:a?',  # Map audio stream from input idx (if any)
+                ])
             command.extend([
-                '-c:v', 'copy',  # Copy video stream (no re-encoding)
-                '-c:a', 'copy',  # Copy audio stream (no re-encoding)
-                '-map', '0:v',   # Map video stream from input 0
-                '-map', '0:a',   # Map audio stream from input 0
-                '-threads', '2',  # Limit threads to reduce CPU load
-                '-preset', 'medium ',  # Use the (x) preset
                 '-map_metadata', '0',  # writing metadata: title,creation_date,etc..
             ])
 
             # Map subtitles if available
-            if subtitle_paths:
-                for idx, sub_path in enumerate(subtitle_paths, start=1):
+            if subtitles:
+                for idx, lang in enumerate(subtitles, start=1):
                     command.extend([
-                        '-map', f'{idx}:s',  # Map subtitle stream from input idx
-                        f'-metadata:s:s:{idx-1}', f'language={sub_path[-6:-4]}',  # Set subtitle language
-                        f'-metadata:s:s:{idx-1}', f'title=subtitle.{sub_path[-6:-4]}',  # Set subtitle track title
+                        '-map', f'{len(input_paths) + idx - 1}:s',  # Map subtitle stream from its input
+                        f'-metadata:s:s:{idx-1}', f'language={lang}',  # Set subtitle language
+                        f'-metadata:s:s:{idx-1}', f'title=subtitle.{lang}',  # Set subtitle track title
                     ])
                 command.extend(['-c:s', 'mov_text'])  # Embed subtitles as mov_text format
 
@@ -219,149 +2543,621 @@ class VideoDownloader:
             
             logging.info(f"Running FFmpeg command: {' '.join(command)}")
 
-            # Run the command and capture output
-            _ = subprocess.run(
+            # Run the command, hashing the output as it grows
+            if os.path.exists(output_path):
+                os.remove(output_path)  # The hasher must not read a previous output
+            process = subprocess.Popen(
                 command, 
                 stdout=subprocess.DEVNULL,  # Discard stdout
-                stderr=subprocess.DEVNULL,  # Discard stderr
-                text=True, 
-                encoding="utf-8", 
-                errors='replace', 
-                check=True
+                stderr=subprocess.PIPE,  # Kept for the error message
+                **({'pass_fds': [read_fd for read_fd, _, _ in pipes]} if pipes else {}),
             )
+            # Drained by a thread so ffmpeg never blocks on a full pipe while the output is hashed
+            errors = deque(maxlen=50)
+            stderr_reader = threading.Thread(
+                target=lambda: errors.extend(line.decode('utf-8', 'replace') for line in process.stderr), daemon=True)
+            stderr_reader.start()
+            for read_fd, _, _ in pipes:
+                os.close(read_fd)
+            if pipes:
+                # ffmpeg reads every subtitle input to its end while opening it, in the order of the inputs
+                threading.Thread(target=self.write_subtitle_pipes, args=([(w, data) for _, w, data in pipes],),
+                                 daemon=True).start()
+                pipes = []
+            while process.poll() is None:
+                time.sleep(0.2)
+                if hasher is not None:
+                    hasher.update()
+            stderr_reader.join()
+            process.stderr.close()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=''.join(errors))
             
             logging.info("Re-encoding completed successfully.")
             return True
 
         except subprocess.CalledProcessError as e:
             logging.error(f"FFmpeg re-encoding failed: {str(e)}")
-            logging.error(f"FFmpeg output:\n{e.stdout}")
-            logging.error(f"FFmpeg errors:\n{e.stderr}")
+            logging.error(f"FFmpeg errors:\n{e.stderr.strip()}")
             return False
+        finally:
+            for read_fd, write_fd, _ in pipes:  # ffmpeg never started
+                os.close(read_fd)
+                os.close(write_fd)
+            for sub_path in temp_files:
+                if os.path.exists(sub_path):
+                    os.remove(sub_path)
+
+    @staticmethod
+    def write_subtitle_pipes(pipes):
+        for write_fd, data in pipes:
+            try:
+                with os.fdopen(write_fd, 'wb') as pipe:
+                    pipe.write(data)
+            except (BrokenPipeError, OSError):
+                pass  # ffmpeg stopped early, its exit code reports the failure
 
     
+    # Fetch the requested subtitles into memory and convert them to SRT for the mux, without any file or ffmpeg
+    # process per track (see SubtitleConverter). The tracks it cannot read (other formats, segmented subtitles)
+    # go through yt-dlp instead (convert_subtitles_with_ytdlp). Returns {language: SRT text}.
+    def download_subtitles(self, ydl_opts, info, work_dir, sanitized_title):
+        from yt_dlp.utils import determine_protocol
+        subtitle_opts = dict(ydl_opts)
+        subtitle_opts.update({
+            'skip_download': True,
+            'writesubtitles': True,
+            'writeautomaticsub': True,
+            'subtitlesformat': SubtitleConverter.FORMATS,
+            'subtitleslangs': ['en'],  # Download subtitles. If you want to download a specific subtitle, just add to the list. For example: ["en", "fr", "es", "ja", "cn"] 
+        })
+        subtitles = {}
+        with self.session.use(**subtitle_opts) as ydl:
+            requested = ydl.process_ie_result(ydl.sanitize_info(info), download=False).get('requested_subtitles') or {}
+            for lang, sub in requested.items():
+                rolling = lang not in (info.get('subtitles') or {})  # Automatic captions repeat the previous line
+                cues = None
+                try:
+                    data = sub.get('data')
+                    if data is None and determine_protocol(sub) in ('http', 'https'):
+                        # Subtitle requests are the first to hit HTTP 429, back off instead of failing the video
+                        data = self.retry.call(sub['url'], lambda: ydl.urlopen(sub['url']).read())
+                    if data is not None:
+                        cues = SubtitleConverter.parse(data, sub.get('ext'), rolling)
+                except (ValueError, ElementTree.ParseError) as e:
+                    logging.info(f"Converting the {lang} subtitles with yt-dlp: {str(e)}")
+                if not cues:
+                    try:
+                        srt = self.convert_subtitles_with_ytdlp(ydl, info, lang, sub, work_dir, sanitized_title)
+                        cues = SubtitleConverter.parse(srt, 'srt', rolling)
+                    except Exception as e:
+                        logging.warning(f"Skipping the {lang} subtitles: {str(e)}")
+                        continue
+                if cues:
+                    subtitles[lang] = SubtitleConverter.to_srt(cues)
+                else:
+                    logging.warning(f"Skipping the {lang} subtitles: no cue found.")
+        
+        logging.info(f"Subtitles found: {list(subtitles)}")
+        return subtitles
+
+    # Fallback of download_subtitles: yt-dlp downloads the track with the downloader of its protocol, and what
+    # SubtitleConverter still cannot read goes through FFmpegSubtitlesConvertor (dfxp2srt for TTML, ffmpeg for the
+    # others). Returns the SRT text.
+    @staticmethod
+    def convert_subtitles_with_ytdlp(ydl, info, lang, sub, work_dir, sanitized_title):
+        from yt_dlp.postprocessor import FFmpegSubtitlesConvertorPP
+        path = os.path.join(work_dir, f"{sanitized_title}.{lang}.{sub['ext']}")
+        files = [path]
+        try:
+            if sub.get('data') is not None:
+                with open(path, 'w', encoding='utf-8', newline='') as f:
+                    f.write(sub['data'])
+            else:
+                ydl.dl(path, {**sub, 'http_headers': sub.get('http_headers') or info.get('http_headers')}, subtitle=True)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                try:
+                    cues = SubtitleConverter.parse(data, sub['ext'])  # e.g. WebVTT segments joined by yt-dlp
+                except (ValueError, ElementTree.ParseError):
+                    cues = None
+                if cues:
+                    return SubtitleConverter.to_srt(cues)
+            pp_info = {'requested_subtitles': {lang: {**sub, 'filepath': path}}, '__files_to_move': {path: path}}
+            _, pp_info = FFmpegSubtitlesConvertorPP(ydl, 'srt').run(pp_info)
+            converted = pp_info['requested_subtitles'][lang]
+            files.append(converted.get('filepath'))
+            if converted.get('ext') != 'srt':
+                raise ValueError(f"no conversion from {sub['ext']} to srt")
+            return converted['data']
+        finally:
+            for file in files:
+                if file and os.path.exists(file):
+                    os.remove(file)
+
+    # Format selection only, no network.
+    def select_formats(self, ydl_opts, info):
+        with self.session.use(**ydl_opts) as ydl:
+            return ydl.process_ie_result(ydl.sanitize_info(info), download=False)
+
+    # Download every selected format to its own file (<title>.f<format_id>.<ext>) without letting yt-dlp merge them.
+    def download_streams(self, ydl_opts, info, save_path, sanitized_title, subtitles=None, selected_info=None):
+        selected_info = selected_info or self.select_formats(ydl_opts, info)
+        requested_formats = selected_info.get('requested_formats') or [selected_info]
+        
+        stream_files = [
+            os.path.join(save_path, f"{sanitized_title}.f{f['format_id']}.{f['ext']}")
+            for f in requested_formats
+        ]
+        for f, stream_file in zip(requested_formats, stream_files):
+            stream_opts = dict(ydl_opts)
+            stream_opts.update({
+                'format': f['format_id'],
+                'outtmpl': os.path.join(save_path, f"{sanitized_title}.f{f['format_id']}.%(ext)s"),
+            })
+            if self.needs_remux(stream_files, subtitles):
+                stream_opts['fixup'] = 'never'  # The mux pass rewrites the container anyway
+            with self.session.use(**stream_opts) as ydl:
+                if not self.download_ranges(ydl, f, stream_file, ydl_opts.get('progress_hooks')):
+                    ydl.process_ie_result(ydl.sanitize_info(info), download=True)
+        return selected_info, stream_files
+
+    # Download a progressive format with RangeDownloader when the host settings and the server allow it.
+    # Returns False to let yt-dlp download it over a single connection.
+    def download_ranges(self, ydl, f, stream_file, progress_hooks=None):
+        url = f.get('url')
+        if f.get('protocol') not in ('http', 'https') or f.get('fragments') or not url:
+            return False
+        connections, chunk_size = self.RANGE_DOWNLOADS.get(
+            RetryScheduler.host_key(url), self.RANGE_DOWNLOADS.get('default', (1, 0)))
+        if connections <= 1 or chunk_size <= 0:
+            return False
+        headers = {**ydl.params.get('http_headers', {}), **(f.get('http_headers') or {})}
+        try:
+            size = self.retry.call(url, RangeDownloader.probe_size, ydl.urlopen, url, headers)
+        except Exception as e:
+            logging.warning(f"Range probe failed ({str(e)}), single connection download.")
+            return False
+        if not size or size < 2 * chunk_size:
+            return False
+        
+        downloader = RangeDownloader(ydl.urlopen, url, stream_file, size, connections, chunk_size, headers,
+                                     progress_hooks, self.retry)
+        logging.info(f"Downloading {os.path.basename(stream_file)} ({size / 1024 / 1024:.1f}MB) over "
+                     f"{min(connections, len(downloader.ranges))} connections, {len(downloader.ranges)} ranges.")
+        try:
+            downloader.download()
+            return True
+        except DownloadCancelled:
+            raise  # The finished ranges are kept for a later resume
+        except Exception as e:
+            logging.warning(f"Range download failed ({str(e)}), single connection download.")
+            for path in (downloader.part_path, downloader.state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+
+    # A remux is only needed to merge several streams, embed subtitles or change the container to mp4.
+    def needs_remux(self, stream_files, subtitles):
+        return bool(subtitles) or len(stream_files) != 1 or not stream_files[0].endswith('.mp4')
+
+    # Whether the video stream has to be encoded to TRANSCODE_CODEC / TRANSCODE_MAX_HEIGHT. The source codec and
+    # height come from the downloaded formats, or from ffprobe when the formats do not tell (resumed downloads).
+    def needs_transcode(self, context):
+        if not self.TRANSCODE_CODEC:
+            return False
+        _, source_codecs, _ = self.TRANSCODE_CODECS[self.TRANSCODE_CODEC]
+        downloaded_info = context['downloaded_info'] or {}
+        formats = downloaded_info.get('requested_formats') or [downloaded_info]
+        video = next((f for f in formats if f.get('vcodec') not in (None, 'none')), None)
+        if video is not None:
+            codec, height = video['vcodec'], video.get('height')
+        else:
+            probe = self.probe_media(context['stream_files'][0]) if context['stream_files'] else None
+            codec, height = (probe or {}).get('video_codec'), (probe or {}).get('height')
+        if not codec:
+            return True  # Unknown source, the encode guarantees the target
+        
+        if codec.lower().startswith(source_codecs) and not (self.TRANSCODE_MAX_HEIGHT and height and height > self.TRANSCODE_MAX_HEIGHT):
+            logging.info(f"'{context['video_title']}' is already {codec} {height or ''}p, no transcode needed.")
+            return False
+        return True
+
+    # ffmpeg options of the video encode, using `threads` cores.
+    def transcode_args(self, threads):
+        encoder, _, extra = self.TRANSCODE_CODECS[self.TRANSCODE_CODEC]
+        args = [
+            '-c:v', encoder,
+            '-crf', str(self.TRANSCODE_CRF),
+            '-preset', self.TRANSCODE_PRESET,
+            '-pix_fmt', 'yuv420p',  # 8-bit 4:2:0, what hardware decoders play
+            '-threads', str(threads),
+        ]
+        if encoder == 'libx265':
+            args.extend(['-x265-params', f'pools={threads}'])  # x265 sizes its thread pool itself otherwise
+        if self.TRANSCODE_MAX_HEIGHT:
+            args.extend(['-vf', f'scale=-2:min(ih\\,{self.TRANSCODE_MAX_HEIGHT})'])  # Never upscale, even width
+        return args + extra
+
+    # Build the yt-dlp format selector for a maximum height (0 or None = best quality).
+    # Preferred codecs first (see CODEC_PREFERENCE), then any MP4 video, then fallback.
+    def build_format_code(self, selected_height=None):
+        height = f'[height<={selected_height}]' if selected_height else ''
+        formats = [
+            f'bestvideo{height}[ext=mp4][vcodec^={codec}]+bestaudio[ext=m4a]'
+            for codec in self.codec_preference
+        ]
+        formats.extend([
+            f'bestvideo{height}[ext=mp4]+bestaudio[ext=m4a]',  # Any MP4 video VP9 format: 298
+            f'bestvideo{height}+bestaudio',                    # Fallback to best available
+            'best',
+        ])
+        return '/'.join(formats)
+
     # Download a video with optional re-encoding and subtitle embedding.
-    def download_video(self, url, save_path, selected_height=None):
+    # selected_height=None asks the user for the quality, 0 means best quality, otherwise the maximum height.
+    # Passing the info dict from extract_video_info skips the metadata extraction entirely.
+    def download_video(self, url, save_path, selected_height=None, info=None):
         
         try:
-            # Get video information and available formats
-            info, formats_by_res, video_formats = self.get_video_formats(url)
-            sorted_heights = self.display_formats(formats_by_res)
+            context = self.resume_context(url, save_path) or self.prepare_download(url, save_path, selected_height, info)
+            if context is None:
+                return False  # Cancelled
+            return self.process_context(context)
+
+        except Exception as e:
+            logging.error(f"\nError downloading video: {str(e)}")
+            return False
+
+    # Run the stages following prepare_download on a download context.
+    def process_context(self, context):
+        try:
+            return (
+                self.fetch_media(context)
+                and self.merge_media(context)
+                and self.verify_media(context)
+                and self.finalize_download(context)
+            )
+        finally:
+            self.release_reservations(context)
+
+    # Stage 1: resolve the formats and the quality, and build the download context shared by the next stages.
+    # Returns None if the user cancelled the video.
+    # With a quality policy budget, the policy picks the height (selected_height is then only an upper bound).
+    def prepare_download(self, url, save_path, selected_height=None, info=None, priority=1.0):
+        # Get video information and available formats
+        info, formats_by_res, video_formats = self.get_video_formats(url, info)
+        bandwidth_key = next(self._bandwidth_keys)
 
-            # Let user choose quality
+        if self.quality_policy.enabled:
+            selected_height = self.quality_policy.choose(
+                bandwidth_key, self.estimate_height_sizes(info, formats_by_res), selected_height or 0,
+                self.bandwidth.current_rate(), info.get('title'))
+        # Let user choose quality unless it was already decided (playlist mode)
+        elif selected_height is None:
+            sorted_heights = self.display_formats(formats_by_res)
             while True:
                 choice = input("\nSelect quality (number): ").strip()
                 try:
                     choice_idx = int(choice)
                     if choice_idx == 0:
-                        # Best quality (automatic): Try HEVC first,then AVC, then fallback
-                        format_code = (
-                            'bestvideo[ext=mp4][vcodec^=hevc]+bestaudio[ext=m4a]/'  # HEVC (H.265) format: 313 
-                            'bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/'  # AVC (H.264) format: 137 or 299
-                            'bestvideo[ext=mp4]+bestaudio[ext=m4a]/'                # Any MP4 video VP9 format: 298
-                            'bestvideo+bestaudio/best'                              # Fallback to best available
-                        )
+                        selected_height = 0
                         break
                     elif 1 <= choice_idx <= len(sorted_heights):
-                        
-                        # Specific resolution: Try HEVC first, then AVC, then fallback
                         selected_height = sorted_heights[choice_idx - 1]
-                        format_code = (
-                            f'bestvideo[height<={selected_height}][ext=mp4][vcodec^=hevc]+bestaudio[ext=m4a]/'  # HEVC (H.265) format: 313
-                            f'bestvideo[height<={selected_height}][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/'  # AVC (H.264) format: 137 or 299
-                            f'bestvideo[height<={selected_height}][ext=mp4]+bestaudio[ext=m4a]/'                # Any MP4 video VP9 format: 298
-                            f'bestvideo[height<={selected_height}]+bestaudio/best'                              # Fallback to best available
-                        )
                         break
                     elif choice_idx == len(sorted_heights) + 1:
-                        return False  # Cancelled
+                        return None  # Cancelled
                     else:
                         print("Invalid choice. Please try again.")
                 except ValueError:
                     print("Please enter a valid number.")
-            
-            video_title = info.get('title', 'video')
-            sanitized_title = self.sanitize_filename(video_title)
-            
-            
-            # Configure ydl_opts
-            ydl_opts = self.get_base_ydl_opts() # add base configuration
-            ydl_opts.update({
-                # 'cookiefile': self.COOKIES_NAME, # not needed until issues appear
-                # 'impersonate': ImpersonateTarget('chrome'),  not needed until issues appear
-                'format': format_code,
-                'outtmpl': os.path.join(save_path, f"{sanitized_title}.%(ext)s"),
-                'merge_output_format': 'mp4',
-                'ffmpeg_location': self.ffmpeg_path,
-                'progress_hooks': [self.print_progress],
-                'concurrent_fragment_downloads': 2,  # Enable multithreaded downloads to make the downloading faster. Be cautious of server limit if increasing fragments
-            })
-            
-            if self.DOWNLOAD_SUBTITLES: 
-                ydl_opts.update({
-                    'writesubtitles': True,
-                    'writeautomaticsub': True,
-                    'subtitlesformat': 'ass',
-                    'subtitleslangs': ['en'],  # Download subtitles. If you want to download a specific subtitle, just add to the list. For example: ["en", "fr", "es", "ja", "cn"] 
-                    'postprocessors': [
-                        {
-                            'key': 'FFmpegSubtitlesConvertor',
-                            'format': 'ass',
-                        },
-                    ],
-                })
-                
+        format_code = self.build_format_code(selected_height)
+        
+        video_title = info.get('title', 'video')
+        sanitized_title = self.sanitize_filename(video_title)
+        work_dir = self.get_work_dir(save_path)  # temp files, see SCRATCH_DIR
+        
+        # Fragment concurrency, measured during the download. The adaptive one is set for the media host
+        # once the formats are selected (fetch_media).
+        fragment_probe = FragmentProbe(None, self.FRAGMENT_CONCURRENCY)
+        retry_hook, retry_observer = self.retry.watch_download()
+        
+        # Configure ydl_opts
+        ydl_opts = self.get_base_ydl_opts(bandwidth_key) # add base configuration
+        ydl_opts.update({
+            # 'cookiefile': self.COOKIES_NAME, # not needed until issues appear
+            # 'impersonate': ImpersonateTarget('chrome'),  not needed until issues appear
+            'format': format_code,
+            'outtmpl': os.path.join(work_dir, f"{sanitized_title}.%(ext)s"),
+            'ffmpeg_location': self.ffmpeg_path,
+            'progress_hooks': ydl_opts.get('progress_hooks', []) + [
+                self.progress.progress_hook(bandwidth_key), fragment_probe.hook, retry_hook],
+            'logger': YdlLogger(quiet=not self.interactive, observers=[fragment_probe.observe, retry_observer]),
+            'noprogress': True,  # print_progress shows the progress
+            'concurrent_fragment_downloads': fragment_probe.concurrency,  # Enable multithreaded downloads to make the downloading faster
+        })
 
-            # Download video and subtitles
-            try:
-                with YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-            except Exception as e:
-                logging.error(f"\nError downloading the video: {str(e)}")
-                return False
+        context = {
+            'url': url,
+            'info': info,
+            'save_path': save_path,
+            'work_dir': work_dir,
+            'video_title': video_title,
+            'sanitized_title': sanitized_title,
+            'ydl_opts': ydl_opts,
+            'fragment_probe': fragment_probe,
+            'content_hasher': None,  # set by fetch_media or merge_media, see StreamingHasher
+            'bandwidth_key': bandwidth_key,
+            'priority': priority,
+            'downloaded_info': None,
+            'stream_files': [],
+            'stream_sizes': [],
+            'subtitles': {},
+            'temp_output_file': os.path.join(work_dir, f"{sanitized_title}_with_subs.mp4"),
+            'completed_stage': None,
+        }
+        self.journal_stage(context, 'extracted')
+        return context
 
-            # Verify file integrity
-            video_file = os.path.join(save_path, f"{sanitized_title}.mp4")            
-            if not os.path.exists(video_file):
-                logging.error("Downloaded file not found.")
-                return False
-            
+    # Peak disk usage of the selected formats: the streams, plus the merged copy when a remux is likely, plus the
+    # final file on the output filesystem when the work happens on a scratch directory. None when unknown.
+    def estimate_disk_usage(self, selected_info, info, work_dir, save_path):
+        formats = selected_info.get('requested_formats') or [selected_info]
+        size = 0
+        for f in formats:
+            nbytes = self.estimate_format_size(f, info.get('duration'))
+            if not nbytes:
+                return None
+            size += nbytes
+        remux = self.DOWNLOAD_SUBTITLES or bool(self.TRANSCODE_CODEC) or len(formats) > 1 or selected_info.get('ext') != 'mp4'
+        needs = {work_dir: int(size * (2 if remux else 1))}
+        if os.path.abspath(work_dir) != os.path.abspath(save_path):
+            needs[save_path] = int(size)
+        return needs
+
+    # Admission of a download by the disk space planner. Downloads without any size estimate are admitted.
+    def reserve_disk_space(self, context, selected_info):
+        if not self.CHECK_DISK_SPACE:
+            return True
+        needs = self.estimate_disk_usage(selected_info, context['info'], context['work_dir'], context['save_path'])
+        if needs is None:
+            logging.debug(f"No size estimate for '{context['video_title']}', started without disk space check.")
+            return True
+        return self.disk_planner.reserve(context['bandwidth_key'], needs, context['video_title'])
+
+    # Give back what a job holds in the shared budgets: its disk space reservation and, for a job that ended
+    # before its download settled it (failed format selection, no disk space, cancelled), its quality policy estimate.
+    def release_reservations(self, context):
+        if context and context.get('bandwidth_key') is not None:
+            self.disk_planner.release(context['bandwidth_key'])
+            self.quality_policy.settle(context['bandwidth_key'], 0)
+
+    @staticmethod
+    def is_disk_full(error):
+        return getattr(error, 'errno', None) == errno.ENOSPC or 'No space left on device' in str(error)
+
+    # Write-ahead record of the stage a video just completed, with what the next stages need to resume it.
+    # The journal only keeps what a recovery needs. The subtitles (SRT text) of a 'downloaded' video wait for the
+    # mux in a '.subtitles.json' file next to the merge output, removed once the video is merged.
+    def journal_stage(self, context, stage):
+        context['completed_stage'] = stage
+        info = context['info']
+        subtitles_file = os.path.splitext(context['temp_output_file'])[0] + '.subtitles.json'
+        if stage == 'downloaded' and context['subtitles']:
+            with open(subtitles_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(context['subtitles'], f, ensure_ascii=False)
+            os.replace(subtitles_file + '.tmp', subtitles_file)
+        elif stage == 'merged' and os.path.exists(subtitles_file):
+            os.remove(subtitles_file)
+        self.get_journal(context['save_path']).record(
+            context['url'],
+            stage,
+            id=info.get('id'),
+            extractor_key=info.get('extractor_key'),
+            video_title=context['video_title'],
+            sanitized_title=context['sanitized_title'],
+            format_id=(context['downloaded_info'] or {}).get('format_id'),
+            stream_files=context['stream_files'],
+            stream_sizes=context['stream_sizes'],
+            subtitles_file=subtitles_file if stage == 'downloaded' and context['subtitles'] else None,
+            temp_output_file=context['temp_output_file'],
+        )
+
+    # Stage 2: download subtitles and the selected streams from the already resolved info (no new extraction).
+    # yt-dlp does not merge the streams: merging and subtitle embedding happen in one ffmpeg pass (merge_media).
+    def fetch_media(self, context):
+        if context['completed_stage'] in ('downloaded', 'merged'):
+            return True  # Resumed from the journal
+        info, work_dir, sanitized_title = context['info'], context['work_dir'], context['sanitized_title']
+        try:
+            selected_info = self.select_formats(context['ydl_opts'], info)
+        except Exception as e:
+            logging.error(f"\nError selecting the formats: {str(e)}")
+            return False
+        if not self.reserve_disk_space(context, selected_info):
+            return False
+        if self.ADAPTIVE_FRAGMENTS:
+            context['ydl_opts']['concurrent_fragment_downloads'] = self.fragment_tuner.tune(
+                context['fragment_probe'], selected_info.get('requested_formats') or [selected_info])
+        
+        self.bandwidth.register(context['bandwidth_key'], context['priority'])
+        self.progress.register(context['bandwidth_key'], context['video_title'])
+        downloaded_bytes = None  # as last seen in the progress for a failed download
+        try:
             if self.DOWNLOAD_SUBTITLES:
-                # Get subtitle paths
-                subtitle_files = glob.glob(os.path.join(save_path, f"{glob.escape(sanitized_title)}.*.ass"))
-                logging.info(f"Subtitles found: {subtitle_files}")
+                with self.metrics.stage('subtitles', context['url'], context['video_title']) as timer:
+                    context['subtitles'] = self.download_subtitles(context['ydl_opts'], info, work_dir, sanitized_title)
+                    timer.bytes = sum(len(srt.encode('utf-8')) for srt in context['subtitles'].values())
+            # The stream is hashed while it downloads only when it becomes the final file as is. A remuxed or
+            # transcoded output is hashed while ffmpeg writes it (merge_media).
+            requested_formats = selected_info.get('requested_formats') or [selected_info]
+            stream_files = [f"{sanitized_title}.f{f['format_id']}.{f['ext']}" for f in requested_formats]
+            if not self.TRANSCODE_CODEC and not self.needs_remux(stream_files, context['subtitles']):
+                context['content_hasher'] = StreamingHasher()
+                context['ydl_opts']['progress_hooks'].append(context['content_hasher'].hook)
+            with self.metrics.stage('download', context['url'], context['video_title']) as timer:
+                context['downloaded_info'], context['stream_files'] = self.download_streams(
+                    context['ydl_opts'], info, work_dir, sanitized_title, context['subtitles'], selected_info)
+                timer.bytes = downloaded_bytes = sum(os.path.getsize(f) for f in context['stream_files'] if os.path.exists(f))
+        except Exception as e:
+            if self.is_disk_full(e):
+                logging.error(f"\nNo space left on the disk of {work_dir} while downloading '{context['video_title']}'.")
             else:
-                subtitle_files = None
-            
-            # Re-encode video and embed subtitles
-            temp_output_file = os.path.join(save_path, f"{sanitized_title}_with_subs.mp4")
-            if not self.reencode_video(video_file, temp_output_file, subtitle_files):
+                logging.error(f"\nError downloading the video: {str(e)}")
+            return False
+        finally:
+            self.bandwidth.unregister(context['bandwidth_key'])
+            self.progress.unregister(context['bandwidth_key'])
+            self.quality_policy.settle(context['bandwidth_key'], downloaded_bytes)
+            if self.ADAPTIVE_FRAGMENTS:
+                self.fragment_tuner.report(context['fragment_probe'])
+
+        # Verify file integrity
+        missing_files = [f for f in context['stream_files'] if not os.path.exists(f)]
+        if missing_files:
+            logging.error(f"Downloaded file not found: {missing_files}")
+            return False
+        context['stream_sizes'] = [os.path.getsize(f) for f in context['stream_files']]
+        self.journal_stage(context, 'downloaded')
+        return True
+
+    # Stage 3: merge the streams and embed the subtitles, or skip the remux when there is nothing to do.
+    def merge_media(self, context):
+        if context['completed_stage'] == 'merged':
+            return True  # Resumed from the journal
+        stream_files, subtitles = context['stream_files'], context['subtitles']
+        temp_output_file = context['temp_output_file']
+        stream_bytes = sum(os.path.getsize(f) for f in stream_files)
+        
+        transcode = self.needs_transcode(context)
+        if transcode or self.needs_remux(stream_files, subtitles):
+            # Merge streams and embed subtitles (and encode the video) in one pass
+            context['content_hasher'] = StreamingHasher(temp_output_file, rewrites_head=True)
+            with self.metrics.stage('transcode' if transcode else 'remux', context['url'], context['video_title']) as timer:
+                if transcode:
+                    with self.transcode_pool.slot() as threads:
+                        timer.ok = self.reencode_video(stream_files, temp_output_file, subtitles,
+                                                       context['content_hasher'], self.transcode_args(threads))
+                else:
+                    timer.ok = self.reencode_video(stream_files, temp_output_file, subtitles, context['content_hasher'])
+                timer.bytes = os.path.getsize(temp_output_file) if os.path.exists(temp_output_file) else 0
+            if not timer.ok:
                 logging.error("Failed to re-encode video with subtitles.")
                 return False
-        
-            time.sleep(1) # give some time to process (optional can be removed if not created issues)
             
             # Check if the re-encoded file exists
             if not os.path.exists(temp_output_file):
                 logging.error(f"Re-encoded file not found: {temp_output_file}")
                 return False
             
-            # Replace the original video with the new one
-            os.remove(video_file)
-            final_output_file = os.path.join(save_path, f"{video_title}.mp4")
-            
-            if self.DOWNLOAD_SUBTITLES and not self.GET_SUBTITLE_LEFTOVER:
-                # Clean up leftover subtitle files
-                for sub_file in subtitle_files:
-                    if os.path.exists(sub_file):
-                        os.remove(sub_file)
-                        logging.info(f"Deleted leftover subtitle file: {sub_file}")
-            
-            # Attempt to keep the original name (sometime won't work due to Window special character restriction)
+            # Replace the original streams with the new one
+            for stream_file in stream_files:
+                os.remove(stream_file)
+            bytes_written = stream_bytes + os.path.getsize(temp_output_file)
+        else:
+            # Single mp4 file and no subtitles: nothing to merge or embed, skip the remux entirely
+            logging.info("No subtitles and a single mp4 stream, skipping the remux.")
+            os.replace(stream_files[0], temp_output_file)
+            bytes_written = stream_bytes
+        
+        # Previous pipeline: download + yt-dlp merge (multiple streams only) + full re-encode pass
+        final_size = os.path.getsize(temp_output_file)
+        previous_bytes = stream_bytes + (final_size if len(stream_files) > 1 else 0) + final_size
+        logging.info(
+            f"Bytes written: {bytes_written / 1024 / 1024:.1f}MB "
+            f"(merge + re-encode pipeline: {previous_bytes / 1024 / 1024:.1f}MB)"
+        )
+        self.journal_stage(context, 'merged')
+        return True
+
+    # Stage 4: verify the merged file before it gets its final name.
+    def verify_media(self, context):
+        if not self.VERIFY_INTEGRITY:
+            return True
+        with self.metrics.stage('verify', context['url'], context['video_title']) as timer:
+            timer.ok = self.check_media_integrity(context)
+            timer.bytes = (context.get('integrity') or {}).get('size', 0)
+        return timer.ok
+
+    # The received bytes are compared with the announced sizes, ffprobe checks the duration and the streams,
+    # and the content hash computed while the file was written is collected.
+    # A failed file is deleted so the next run downloads it again.
+    def check_media_integrity(self, context):
+        output_file = context['temp_output_file']
+        info = context['info']
+        downloaded_info = context['downloaded_info'] or {}
+        formats = downloaded_info.get('requested_formats') or [downloaded_info]
+        problems = []
+        
+        # Received bytes of every stream
+        for f, stream_file, size in zip(formats, context['stream_files'], context['stream_sizes']):
+            if f.get('filesize') and not self.verify_file_integrity(size, f['filesize']):
+                problems.append(f"{os.path.basename(stream_file)}: {size} bytes received, {f['filesize']} expected")
+            elif f.get('filesize_approx') and not self.verify_file_integrity(
+                    size, f['filesize_approx'], self.APPROX_SIZE_TOLERANCE):
+                logging.warning(f"{os.path.basename(stream_file)}: {size} bytes received, about {f['filesize_approx']} announced")
+        
+        # Container probe: the file must open, with the expected duration and number of streams
+        probe = self.probe_media(output_file)
+        if probe is None:
+            pass  # No ffprobe, see __init__
+        elif 'error' in probe:
+            problems.append(f"unreadable container: {probe['error']}")
+        else:
+            expected_streams = sum(
+                max(1, (f.get('vcodec') not in (None, 'none')) + (f.get('acodec') not in (None, 'none')))
+                for f in formats
+            ) + len(context['subtitles'])
+            if len(probe['streams']) < expected_streams:
+                problems.append(f"{len(probe['streams'])} streams found, {expected_streams} expected")
+            duration = info.get('duration')
+            if duration and probe['duration'] is not None and \
+                    abs(probe['duration'] - duration) > max(self.DURATION_TOLERANCE, duration * 0.01):
+                problems.append(f"duration {probe['duration']:.1f}s, {duration:.1f}s expected")
+        
+        if problems:
+            logging.error(f"Integrity check failed for '{context['video_title']}': {'; '.join(problems)}")
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            return False
+        
+        hasher = context['content_hasher']
+        context['integrity'] = {
+            'size': os.path.getsize(output_file),
+            'duration': probe and probe.get('duration'),
+            'streams': probe and probe.get('streams'),
+            'hash': hasher.hexdigest(output_file) if hasher else StreamingHasher.hash_file(output_file),
+            'hash_algorithm': StreamingHasher.ALGORITHM,
+            'verified_at': time.time(),
+        }
+        logging.info(f"Integrity verified: {os.path.basename(output_file)} ({context['integrity']['hash'][:16]}...)")
+        return True
+
+    # Stage 5: save the subtitle files if wanted, give the file its final name and record it in the manifest.
+    def finalize_download(self, context):
+        save_path, video_title, info = context['save_path'], context['video_title'], context['info']
+        temp_output_file = context['temp_output_file']
+        final_output_file = os.path.join(save_path, f"{video_title}.mp4")
+        
+        if self.DOWNLOAD_SUBTITLES and self.GET_SUBTITLE_LEFTOVER:
+            # The embedded subtitles also as .ass files next to the video
+            with self.metrics.stage('subtitle_files', context['url'], video_title) as timer:
+                for lang, srt in context['subtitles'].items():
+                    sub_file = os.path.join(save_path, f"{context['sanitized_title']}.{lang}.ass")
+                    with open(sub_file, 'w', encoding='utf-8') as f:
+                        timer.bytes += f.write(SubtitleConverter.to_ass(SubtitleConverter.parse(srt, 'srt')))
+        
+        # Attempt to keep the original name (sometime won't work due to Window special character restriction)
+        stored_file = temp_output_file
+        with self.metrics.stage('rename', context['url'], video_title) as timer:
             try:
-                os.rename(temp_output_file, final_output_file)
-                print(f"'{os.path.basename(temp_output_file)}' was rename to '{os.path.basename(final_output_file)}'")
+                self.move_file(temp_output_file, final_output_file)
+                stored_file = final_output_file
+                if self.interactive:
+                    print(f"'{os.path.basename(temp_output_file)}' was rename to '{os.path.basename(final_output_file)}'")
             except OSError as e: # This is the best practice!
+                timer.ok = False
                 # Check for specific error numbers if necessary, like file not found (ENOENT)
                 if e.errno == errno.EACCES: # Permission denied error
                     error_message = "Permission denied while renaming."
@@ -372,23 +3168,269 @@ class VideoDownloader:
                     error_message = f"OS Error renaming video: {e}"
 
                 logging.error(f"Error renaming video title. {error_message}")
-            
-            return True
+        
+        # Record the download so later runs can skip it without any network call
+        self.get_manifest(save_path).record(
+            DownloadManifest.make_key(info.get('extractor_key'), info.get('id')),
+            'complete',
+            path=os.path.abspath(stored_file),
+            size=os.path.getsize(stored_file),
+            format_id=(context['downloaded_info'] or {}).get('format_id'),
+            title=video_title,
+            integrity=context.get('integrity'),
+        )
+        self.journal_stage(context, 'finalized')
+        self.release_reservations(context)
+        self.metrics.flush()
+        return True
 
-        except Exception as e:
-            logging.error(f"\nError downloading video: {str(e)}")
-            return False
+    # Rename, or a single copy to a temp name next to the destination then a rename when they are on different
+    # filesystems (scratch directory): the final name never points to a partial file.
+    def move_file(self, source, destination):
+        try:
+            os.rename(source, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            temp_destination = destination + '.moving'
+            try:
+                shutil.copyfile(source, temp_destination)
+                os.replace(temp_destination, destination)
+            except OSError:
+                if os.path.exists(temp_destination):
+                    os.remove(temp_destination)
+                raise
+            os.remove(source)
+
+    # Ask once for the maximum quality applied to every video of a concurrent playlist download.
+    def ask_playlist_quality(self):
+        while True:
+            choice = input("\nMaximum quality for the whole playlist (e.g. 1080, 720, Enter for best): ").strip().lower()
+            if not choice:
+                return 0
+            try:
+                return int(choice.rstrip('p'))
+            except ValueError:
+                print("Please enter a valid height.")
+
+    # Extract the info of a playlist entry (unless already prefetched) and check whether it is already downloaded.
+    # downloaded_files: DownloadManifest.untracked_files() of save_dir. Returns the info dict, or None when the
+    # entry can be skipped.
+    def extract_playlist_entry(self, job, save_dir, downloaded_files, info=None):
+        manifest = self.get_manifest(save_dir)
+        key = DownloadManifest.key_from_url(job.url)
+        if manifest.is_complete(key):
+            job.title = manifest.get(key).get('title') or job.title
+            logging.info(f"\nVideo '{job.title}' already downloaded according to the manifest. Skipping...")
+            return None
+        
+        # Extract the video info once, it is reused for the download itself
+        if info is None:
+            info = self.extract_video_info(job.url)
+        job.title = info.get('title', 'Unknown')
+        filename = f"{job.title}.mp4"
+        if key is None and manifest.is_complete(DownloadManifest.make_key(info.get('extractor_key'), info.get('id'))):
+            logging.info(f"\nVideo '{job.title}' already downloaded according to the manifest. Skipping...")
+            return None  # A URL of the generic extractor, its ID is only known now
+        
+        # Fallback for the files downloaded before the manifest existed, only known by their name
+        if filename in downloaded_files:
+            logging.info(f"\nVideo '{job.title}' already downloaded. Skipping...")
+            manifest.record(
+                DownloadManifest.make_key(info.get('extractor_key'), info.get('id')),
+                'complete',
+                path=os.path.abspath(os.path.join(save_dir, filename)),
+                size=os.path.getsize(os.path.join(save_dir, filename)),
+                title=job.title,
+            )
+            return None
+        return info
+
+    # Extract, skip-check and download a single playlist entry. Returns the final job state.
+    def process_playlist_job(self, job, save_dir, downloaded_files, selected_height=None):
+        context = self.resume_context(job.url, save_dir)
+        if context is not None:
+            if job.info is not None:
+                self.prefetcher.discard(job.info)
+            job.title = context['video_title']
+            success = self.process_context(context)
+            return 'done' if success else 'failed'
+        
+        prefetched = self.prefetcher.take(job.info) if job.info is not None else None
+        info = self.extract_playlist_entry(job, save_dir, downloaded_files, prefetched)
+        if info is None:
+            return 'skipped'
+        
+        logging.info(f"\nDownloading video {job.index}: {job.title}")
+        success = self.download_video(job.url, save_dir, selected_height, info)
+        return 'done' if success else 'failed'
+
+    # Pipeline stage: extraction + skip check + download context.
+    def extract_stage(self, job, save_dir, downloaded_files, selected_height):
+        job.context = self.resume_context(job.url, save_dir, job.priority)
+        if job.context is not None:
+            if job.info is not None:
+                self.prefetcher.discard(job.info)
+            job.title = job.context['video_title']
+            return True  # Already downloaded or merged before an interruption, no new extraction
+        prefetched = self.prefetcher.take(job.info) if job.info is not None else None
+        info = self.extract_playlist_entry(job, save_dir, downloaded_files, prefetched)
+        if info is None:
+            return 'skipped'
+        if job.max_height is not None:
+            selected_height = job.max_height
+        job.context = self.prepare_download(job.url, save_dir, selected_height, info, job.priority)
+        job.context['ydl_opts']['progress_hooks'].append(job.progress_hook)  # Aborts the download on cancel()
+        return True
+
+    # Build the extraction -> download -> merge/embed -> verify -> finalize pipeline of a playlist.
+    # on_finished: optional callable(job) receiving every job in its final state.
+    def build_playlist_pipeline(self, save_dir, downloaded_files, selected_height=0, on_finished=None):
+        return PlaylistScheduler(
+            [
+                PipelineStage('extract', lambda job: self.extract_stage(job, save_dir, downloaded_files, selected_height),
+                              self.EXTRACT_WORKERS),
+                PipelineStage('download', lambda job: self.fetch_media(job.context),
+                              self.MAX_CONCURRENT_DOWNLOADS, queue_size=self.MAX_CONCURRENT_DOWNLOADS),
+                PipelineStage('merge', lambda job: self.merge_media(job.context),
+                              max(self.MERGE_WORKERS, self.transcode_pool.jobs if self.TRANSCODE_CODEC else 0),
+                              queue_size=self.MAX_CONCURRENT_DOWNLOADS * 2),
+                PipelineStage('verify', lambda job: self.verify_media(job.context), 1),
+                PipelineStage('finalize', lambda job: self.finalize_download(job.context), 1),
+            ],
+            on_failed=lambda job: self.release_reservations(job.context),
+            on_finished=on_finished,
+        )
 
-    # If downloading failed, attempt to delete any left over
-    def cleanup_subtitles(self, save_dir, video_title):
+    # Download the playlist entries through the staged pipeline: video N+1 downloads while video N is merged.
+    # priorities: optional {url: weight} giving some videos a bigger share of the bandwidth budget.
+    def download_playlist(self, video_urls, save_dir, downloaded_files, selected_height=0, priorities=None,
+                          on_finished=None):
+        def finished(job):
+            if job.info is not None:
+                self.prefetcher.discard(job.info)  # Cancelled before its extraction
+            if on_finished:
+                on_finished(job)
+        
+        scheduler = self.build_playlist_pipeline(save_dir, downloaded_files, selected_height, finished)
+        logging.info(f"Downloading playlist with {self.MAX_CONCURRENT_DOWNLOADS} concurrent downloads.")
+        if self.quality_policy.enabled:
+            video_urls = self.quality_policy.track(video_urls)  # The videos sharing the budget
         try:
-            subtitle_files = glob.glob(os.path.join(save_dir, f"{video_title}.*.ass"))
-            for file in subtitle_files:
-                if os.path.exists(file):
-                    os.remove(file)
-                    logging.info(f"Deleted leftover subtitle file: {file}")
-        except Exception as e:
-            logging.error(f"Error deleting leftover subtitle files: {str(e)}")
+            jobs = scheduler.run(self.prefetch_jobs(video_urls, save_dir, priorities), priorities)
+        finally:
+            self.prefetcher.close()
+            self.session.close()  # The instances belong to the pipeline threads of this run
+        self.get_journal(save_dir).sync()
+        scheduler.log_stats()
+        logging.info(f"Playlist finished: {scheduler.summary()}")
+        logging.info(f"Stage times | {self.metrics.summary()}")
+        self.metrics.flush()
+        return jobs
+
+    # Playlist entries (URLs or DownloadJob) as DownloadJob objects carrying the future of their metadata, resolved
+    # ahead by the prefetcher. Entries that resume after their download stage are not extracted again.
+    def prefetch_jobs(self, entries, save_dir, priorities=None):
+        priorities = priorities or {}
+        journal = self.get_journal(save_dir)
+        
+        manifest = self.get_manifest(save_dir)
+        
+        def extract(url):
+            if (journal.get(url) or {}).get('stage') in ('downloaded', 'merged'):
+                return None
+            if manifest.is_complete(DownloadManifest.key_from_url(url)):
+                return None  # Skipped by the extraction stage without any network call
+            return self.extract_video_info(url)
+        
+        for entry, info in self.prefetcher.prefetch(entries, extract):
+            job = entry if isinstance(entry, DownloadJob) else DownloadJob(0, entry, priorities.get(entry, 1.0))
+            job.info = info
+            yield job
+
+    # Skip the videos recorded in the manifest straight from the flat listing (no network call).
+    # video_urls maps each URL to its manifest key (None when unknown). Returns the URLs left to download.
+    def skip_downloaded(self, entries, save_dir, stats=None):
+        manifest = self.get_manifest(save_dir)
+        stats = stats if stats is not None else defaultdict(int)
+        for url, key in entries:
+            stats['listed'] += 1
+            if manifest.is_complete(key):
+                stats['already_downloaded'] += 1
+                continue
+            yield url
+        if stats['already_downloaded']:
+            logging.info(f"{stats['already_downloaded']} videos already downloaded according to the manifest. Skipping...")
+
+    # Non-interactive download of every video or playlist URL listed in url_file (one per line, '#' comments).
+    # A line may end with a priority weight for the bandwidth sharing: "<url> 2".
+    # Returns a JSON-serializable summary of the run.
+    def run_batch(self, url_file, save_dir, selected_height=0):
+        started = time.time()
+        os.makedirs(save_dir, exist_ok=True)
+        
+        lines = []
+        with open(url_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                lines.append((fields[0], float(fields[1]) if len(fields) > 1 else 1.0))
+        
+        priorities = {}
+        playlists = {}
+        stats = defaultdict(int)
+        
+        # Videos of every line in file order, playlists listed page by page while the first videos download
+        def entries():
+            seen = set()
+            for url, priority in lines:
+                if 'list=' in url:
+                    listed = playlists.setdefault(url, {}) if self.SYNC_PLAYLISTS else None
+                    line_entries = self.list_playlist(url, save_dir, listed)
+                else:
+                    line_entries = [(url, DownloadManifest.key_from_url(url))]
+                for entry_url, key in line_entries:
+                    if entry_url not in seen:
+                        seen.add(entry_url)
+                        priorities[entry_url] = priority
+                        yield entry_url, key
+        
+        self.recover_journal(save_dir)
+        downloaded_files = self.get_manifest(save_dir).untracked_files()
+        pending_urls = self.skip_downloaded(entries(), save_dir, stats)
+        jobs = self.download_playlist(pending_urls, save_dir, downloaded_files, selected_height, priorities)
+        self.update_sync_state(save_dir, playlists)
+        
+        counts = defaultdict(int)
+        for job in jobs:
+            counts[job.state] += 1
+        summary = {
+            'output_dir': os.path.abspath(save_dir),
+            'total': stats['listed'],
+            'already_downloaded': stats['already_downloaded'],
+            'done': counts['done'],
+            'skipped': counts['skipped'],
+            'failed': counts['failed'],
+            'cancelled': counts['cancelled'],
+            'duration_s': round(time.time() - started, 1),
+            'stages': {
+                stage: {**totals, 'seconds': round(totals['seconds'], 3)} for stage, totals in self.metrics.totals.items()
+            },
+            'jobs': [
+                {
+                    'url': job.url,
+                    'title': job.title,
+                    'state': job.state,
+                    'error': job.error,
+                    'duration_s': round(job.duration, 1),
+                }
+                for job in jobs
+            ],
+        }
+        if self.quality_policy.enabled:
+            summary['quality_policy'] = self.quality_policy.summary()
+        return summary
 
     def run(self):
         "Main loop for downloading videos."
@@ -398,53 +3440,44 @@ class VideoDownloader:
                 if video_url.lower() == 'q':
                     break
                 
+                from tkinter import filedialog
                 save_dir = filedialog.askdirectory(title="Select Download Location", parent=self.root)
                 if not save_dir:
                     logging.error("Error: No directory selected")
                     continue
+                self.recover_journal(save_dir)
                 
                 if 'list=' in video_url:  # Check if the URL contains a playlist identifier
                     logging.info("\nDetected a playlist URL. Extracting video links...")
-                    video_urls = self.get_playlist_videos(video_url)
-                    if not video_urls:
-                        logging.error("No videos found in the playlist.")
-                        continue
-                    
-                    logging.info(f"Found {len(video_urls)} videos in the playlist.")
+                    # The videos are downloaded while the next pages of the playlist are listed
+                    playlist_entries = {}
+                    stats = defaultdict(int)
+                    video_urls = self.skip_downloaded(self.list_playlist(video_url, save_dir, playlist_entries), save_dir, stats)
                     
-                    # Get a set of already downloaded videos (by filename)
-                    downloaded_files = {f for f in os.listdir(save_dir) if f.endswith('.mp4')}
+                    # Files from before the manifest, only recognized by their name
+                    downloaded_files = self.get_manifest(save_dir).untracked_files()
                     
-                    for idx, url in enumerate(video_urls, 1):
-                        # Extract the video title (used as filename)
-                        ydl_opts = {
-                            'quiet': True,
-                            'ffmpeg_location': self.ffmpeg_path,
-                        }
-                        
-                        with YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(url, download=False)
-                            video_title = info.get('title', 'Unknown')
-                            filename = f"{video_title}.mp4"
-                            
-                        if filename in downloaded_files:
-                            logging.info(f"\nVideo '{video_title}' already downloaded. Skipping...")
-                            continue
-                        
-                        logging.info(f"\nDownloading video {idx}/{len(video_urls)}: {video_title}")
-                        success = self.download_video(url, save_dir)
-                        
-                        if self.DOWNLOAD_SUBTITLES and not success:
-                            self.cleanup_subtitles(save_dir, video_title)
-                            logging.error(f"Failed to download video {idx}. Continuing with the next one...")  
+                    if self.MAX_CONCURRENT_DOWNLOADS > 1:
+                        selected_height = 0 if self.quality_policy.enabled else self.ask_playlist_quality()
+                        self.download_playlist(video_urls, save_dir, downloaded_files, selected_height)
+                    else:
+                        # One video at a time, the metadata of the next ones is resolved during the download
+                        try:
+                            for idx, job in enumerate(self.prefetch_jobs(video_urls, save_dir), 1):
+                                job.index = idx
+                                if self.process_playlist_job(job, save_dir, downloaded_files) == 'failed':
+                                    logging.error(f"Failed to download video {idx}. Continuing with the next one...")
+                        finally:
+                            self.prefetcher.close()
+                    if not stats['listed']:
+                        logging.error("No new videos since the last sync." if self.SYNC_PLAYLISTS else "No videos found in the playlist.")
+                    self.update_sync_state(save_dir, {video_url: playlist_entries})
                 else:
                     # Single video download
-                    success = self.download_video(video_url, save_dir)
-                    if self.DOWNLOAD_SUBTITLES and not success:
-                        with YoutubeDL({'quiet': True}) as ydl:
-                            info = ydl.extract_info(video_url, download=False)
-                            video_title = info.get('title', 'Unknown')
-                        self.cleanup_subtitles(save_dir, video_title)
+                    job = DownloadJob(1, video_url)
+                    info = self.extract_playlist_entry(job, save_dir, set())  # Only the manifest, no title match
+                    if info is not None:
+                        self.download_video(video_url, save_dir, info=info)
                 
                 another = input("\nDownload another video or playlist? (y/n): ").strip().lower()
                 if another != 'y':
@@ -455,8 +3488,443 @@ class VideoDownloader:
             except Exception as e:
                 logging.error(f"\nAn unexpected error occurred: {str(e)}")
                 continue
+        self.session.close()
+
+
+class DownloadDaemon:
+    "Long-running VideoDownloader taking its jobs from a local JSON API, over TCP on localhost or a Unix socket."
+
+    # A submit only writes the job to the JobQueue, the API never waits for a download. One pipeline runs for the
+    # whole life of the daemon and pulls the queued videos by priority, only as many as it can start soon
+    # (extraction workers + concurrent downloads): a job submitted later with a higher priority overtakes the
+    # queued ones. Playlists are listed into video jobs by a separate thread.
+    #   POST /jobs {"url": ..., "priority": 2, "max_height": 720}   GET /jobs[?state=queued]   GET /jobs/<id>
+    #   DELETE /jobs/<id> (cancel)   GET /status
+    POLL_INTERVAL = 1.0  # seconds between two looks at an empty queue, a submit wakes the pipeline at once
+    JOURNAL_COMPACT_EVERY = 50  # finished jobs between two compactions of the job journal (recover_journal at start)
+
+    def __init__(self, downloader, save_dir, address, max_height=0):
+        self.downloader = downloader
+        self.save_dir = os.path.abspath(save_dir)
+        self.address = address  # 'host:port' or 'unix:/path/to/socket'
+        self.max_height = max_height
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.queue = JobQueue(self.save_dir)
+        self.running = {}  # job id -> DownloadJob in the pipeline
+        self.job_ids = {}  # DownloadJob -> job id
+        self.listed = {}   # playlist job id -> {video URL: manifest key}, for the sync state
+        self.server = None
+        self._slots = threading.Semaphore(downloader.EXTRACT_WORKERS + downloader.MAX_CONCURRENT_DOWNLOADS)
+        self._videos_queued = threading.Event()
+        self._playlists_queued = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._finished_count = 0
+
+    # Run the API and the pipeline until stop() (or Ctrl+C).
+    def serve_forever(self):
+        self.server = self.make_server(self.address, self.make_handler())
+        threading.Thread(target=self.server.serve_forever, name='api', daemon=True).start()
+        threading.Thread(target=self._list_playlists, name='lister', daemon=True).start()
+        logging.info(f"Daemon listening on {self.address}, downloading to {self.save_dir}")
+        try:
+            self.downloader.recover_journal(self.save_dir)
+            downloaded_files = self.downloader.get_manifest(self.save_dir).untracked_files()
+            self.downloader.download_playlist(self._videos(), self.save_dir, downloaded_files, self.max_height,
+                                              on_finished=self._finished)
+        finally:
+            self._stopping.set()
+            self.server.shutdown()
+            self.server.server_close()
+            if self.address.startswith('unix:') and os.path.exists(self.address[5:]):
+                os.remove(self.address[5:])
+            self.queue.close()
+
+    # Stop taking new videos; the pipeline ends once the videos in progress are finished.
+    def stop(self):
+        logging.info("Daemon stopping after the videos in progress, the queued jobs are kept for the next start.")
+        self._stopping.set()
+        self._videos_queued.set()
+
+    def submit(self, url, priority=1.0, max_height=None):
+        job_id = self.queue.submit(url, priority, max_height)
+        (self._playlists_queued if 'list=' in url else self._videos_queued).set()
+        return self.queue.get(job_id)
+
+    # Returns the job, or None when it does not exist or is already finished.
+    def cancel(self, job_id):
+        with self._lock:
+            running = self.queue.cancel(job_id)
+            if running is None:
+                return None
+            for video_id in running:
+                if video_id in self.running:
+                    self.running[video_id].cancel()
+        return self.queue.get(job_id)
+
+    # Pipeline feed: the queued videos by priority, as the pipeline has room for them.
+    def _videos(self):
+        while not self._stopping.is_set():
+            if not self._slots.acquire(timeout=self.POLL_INTERVAL):
+                continue
+            with self._lock:  # A cancel sees the job either queued or in self.running
+                row = self.queue.claim('video')
+                if row is not None:
+                    job = DownloadJob(0, row['url'], row['priority'], row['max_height'])
+                    self.running[row['id']] = job
+                    self.job_ids[job] = row['id']
+            if row is None:
+                self._slots.release()
+                self._videos_queued.wait(self.POLL_INTERVAL)
+                self._videos_queued.clear()
+                continue
+            yield job
+
+    # PlaylistScheduler on_finished callback.
+    def _finished(self, job):
+        with self._lock:
+            job_id = self.job_ids.pop(job, None)
+            self.running.pop(job_id, None)
+        if job_id is None:
+            return
+        self._slots.release()
+        playlist_id = self.queue.finish(job_id, job.state, job.title, job.error)
+        if playlist_id is not None:
+            self._playlist_finished(playlist_id)
+        self.downloader.metrics.flush()
+        with self._lock:
+            self._finished_count += 1
+            compact = self._finished_count % self.JOURNAL_COMPACT_EVERY == 0
+        if compact:
+            self.downloader.get_journal(self.save_dir).compact()  # Drops the finalized videos
+
+    # Lister thread: queue the entries of the playlists as they are listed, by playlist priority.
+    def _list_playlists(self):
+        while not self._stopping.is_set():
+            row = self.queue.claim('playlist')
+            if row is None:
+                self._playlists_queued.wait(self.POLL_INTERVAL)
+                self._playlists_queued.clear()
+                continue
+            listed = self.listed.setdefault(row['id'], {})
+            error = None
+            try:
+                entries = self.downloader.list_playlist(row['url'], self.save_dir, listed)
+                for url in self.downloader.skip_downloaded(entries, self.save_dir):
+                    if self._stopping.is_set() or not self.queue.add_entry(row['id'], url):
+                        break  # Listed again at the next start / cancelled
+                    self._videos_queued.set()
+            except Exception as e:
+                error = str(e)
+                logging.error(f"Error listing the playlist {row['url']}: {error}")
+            if self._stopping.is_set():
+                break
+            playlist_id = self.queue.listed(row['id'], error)
+            if playlist_id is not None:
+                self._playlist_finished(playlist_id)
+
+    def _playlist_finished(self, playlist_id):
+        playlist = self.queue.get(playlist_id)
+        logging.info(f"Playlist job {playlist_id} {playlist['state']}: {playlist['entries']}")
+        self.downloader.update_sync_state(self.save_dir, {playlist['url']: self.listed.pop(playlist_id, {})})
+
+    # API request -> (HTTP status, JSON payload).
+    def handle(self, method, path, params=None, body=None):
+        params = params or {}
+        parts = [part for part in path.split('/') if part]
+        if parts == ['status'] and method == 'GET':
+            with self._lock:
+                running = sorted(self.running.items())
+            return 200, {
+                'save_dir': self.save_dir,
+                'videos': self.queue.counts(),
+                'running': [
+                    {'id': job_id, 'url': job.url, 'title': job.title, 'state': job.state} for job_id, job in running
+                ],
+                'stages': {name: totals for name, totals in self.downloader.metrics.totals.items()},
+            }
+        if parts == ['jobs'] and method == 'GET':
+            return 200, {'jobs': self.queue.list(params.get('state'), int(params.get('limit', 100)))}
+        if parts == ['jobs'] and method == 'POST':
+            if not isinstance(body, dict) or not isinstance(body.get('url'), str) or not body['url'].strip():
+                return 400, {'error': "expected a JSON object with a 'url'"}
+            try:
+                priority = float(body.get('priority', 1.0))
+                max_height = int(body['max_height']) if body.get('max_height') is not None else None
+            except (TypeError, ValueError):
+                return 400, {'error': "'priority' and 'max_height' must be numbers"}
+            return 201, self.submit(body['url'].strip(), priority, max_height)
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job_id = int(parts[1])
+            if method == 'GET':
+                job = self.queue.get(job_id)
+                return (200, job) if job else (404, {'error': f"no job {job_id}"})
+            if method == 'DELETE':
+                job = self.cancel(job_id)
+                if job is not None:
+                    return 200, job
+                job = self.queue.get(job_id)
+                return (409, {'error': f"job {job_id} already {job['state']}"}) if job else (404, {'error': f"no job {job_id}"})
+        return 404, {'error': f"unknown endpoint {method} {path}"}
+
+    def make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug(f"API {format % args}")  # client_address is empty on a Unix socket
+
+            def dispatch(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                body = None
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    if length:
+                        body = json.loads(self.rfile.read(length))
+                    status, payload = daemon.handle(method, url.path, params, body)
+                except ValueError as e:
+                    status, payload = 400, {'error': f"invalid request: {e}"}
+                except Exception as e:
+                    logging.error(f"API error on {method} {self.path}: {str(e)}")
+                    status, payload = 500, {'error': str(e)}
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def do_DELETE(self):
+                self.dispatch('DELETE')
+
+        return Handler
+
+    # 'host:port' (keep it on localhost, the API has no authentication) or 'unix:/path' (owner only).
+    @staticmethod
+    def make_server(address, handler):
+        from http.server import ThreadingHTTPServer
+        if address.startswith('unix:'):
+            import socketserver
+            path = address[5:]
+            if os.path.exists(path):
+                os.remove(path)  # Left by a daemon that did not stop cleanly
+
+            class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            old_umask = os.umask(0o177)
+            try:
+                return UnixHTTPServer(path, handler)
+            finally:
+                os.umask(old_umask)
+        host, port = address.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), handler)
+        server.daemon_threads = True
+        return server
+
+
+# Send a request to a running daemon. Returns (HTTP status, JSON payload).
+def call_daemon(address, method, path, payload=None, timeout=10):
+    import http.client
+    if address.startswith('unix:'):
+        import socket
+
+        class UnixConnection(http.client.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(timeout)
+                self.sock.connect(address[5:])
+
+        connection = UnixConnection('localhost', timeout=timeout)
+    else:
+        host, port = address.rsplit(':', 1)
+        connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    try:
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        connection.request(method, path, body, {'Content-Type': 'application/json'} if body else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download videos and playlists. Without --batch, starts the interactive mode.")
+    parser.add_argument('--batch', metavar='URL_FILE',
+                        help="text file with one video or playlist URL per line; runs without any window or prompt "
+                             "and prints a JSON summary on stdout")
+    parser.add_argument('-o', '--output', default='.',
+                        help="output directory for --batch and --daemon (default: current directory)")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and download the jobs submitted to the API (queue kept in the output directory)")
+    parser.add_argument('--listen', default=VideoDownloader.DAEMON_ADDRESS, metavar='ADDRESS',
+                        help="API address of the daemon, host:port or unix:/path/to/socket (default: %(default)s)")
+    parser.add_argument('--submit', action='append', default=[], metavar='URL',
+                        help="queue a video or playlist URL on the running daemon (repeatable)")
+    parser.add_argument('--priority', type=float, default=1.0, help="priority of the --submit jobs (default: 1)")
+    parser.add_argument('--status', nargs='?', const='', metavar='JOB_ID',
+                        help="print the daemon status, or the state of one job")
+    parser.add_argument('--cancel', type=int, metavar='JOB_ID', help="cancel a queued or running job of the daemon")
+    parser.add_argument('--max-height', type=int, default=0, help="maximum video height, e.g. 720 (default: best quality)")
+    parser.add_argument('--codec', help="comma separated codec preference, e.g. avc1,hevc (default: hevc,avc1)")
+    parser.add_argument('--jobs', type=int, help="number of videos downloaded at the same time")
+    parser.add_argument('--limit-rate', type=parse_rate, metavar='RATE',
+                        help="total bandwidth for all downloads, e.g. 500K or 4M (bytes/s)")
+    parser.add_argument('--limit-window', action='append', default=[], metavar='HH:MM-HH:MM=RATE',
+                        help="bandwidth during a time-of-day window, e.g. 09:00-18:00=2M (repeatable, 0 = unlimited)")
+    parser.add_argument('--sync', action='store_true',
+                        help="only download the playlist entries that are new since the previous --sync to the same output")
+    parser.add_argument('--sync-stop-after', type=int, metavar='N',
+                        help="with --sync, stop listing after N already downloaded entries in a row; only for "
+                             "newest-first lists such as channel uploads (default: 0 = list everything)")
+    parser.add_argument('--connections', type=int, metavar='N',
+                        help="connections per progressive video download, 1 = single connection (default: 4)")
+    parser.add_argument('--range-size', type=parse_rate, metavar='SIZE',
+                        help="byte range fetched per request by the multi-connection downloads (default: 8M)")
+    parser.add_argument('--transcode', choices=sorted(VideoDownloader.TRANSCODE_CODECS), metavar='CODEC',
+                        help="encode the video to h264 or hevc (sources already in that codec are copied)")
+    parser.add_argument('--transcode-height', type=int, help="maximum height of the transcoded videos, e.g. 720")
+    parser.add_argument('--crf', type=int, help="quality of the transcode (default: 23)")
+    parser.add_argument('--preset', help="x264/x265 preset of the transcode, e.g. veryfast (default: medium)")
+    parser.add_argument('--cpu-cores', type=int, help="cores shared by the concurrent transcodes (default: all)")
+    parser.add_argument('--transcode-jobs', type=int, help="videos transcoded at the same time (default: 1)")
+    parser.add_argument('--time-budget', type=parse_time_budget, metavar='DURATION',
+                        help="pick for every video the best quality that lets the run finish in time, "
+                             "e.g. 6h, 90m or a clock time such as 06:00 (see --max-height for a cap)")
+    parser.add_argument('--byte-budget', type=parse_rate, metavar='SIZE',
+                        help="pick for every video the best quality that keeps the run within SIZE, e.g. 50G")
+    parser.add_argument('--throughput', type=parse_rate, metavar='RATE',
+                        help="link throughput assumed by --time-budget until one is measured, e.g. 5M (bytes/s)")
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help="download and merge in DIR (e.g. a tmpfs or a local SSD), then move each video to the output")
+    parser.add_argument('--min-free', type=parse_rate, metavar='SIZE',
+                        help="disk space always left free, e.g. 2G (default: 512M); 0 disables the disk space check")
+    parser.add_argument('--metrics-events', metavar='FILE', help="append one JSON line per download stage to FILE")
+    parser.add_argument('--prometheus-textfile', metavar='FILE',
+                        help="write the stage totals to FILE (.prom) for the node_exporter textfile collector")
+    return parser.parse_args(argv)
+
+# "500K", "4M", "1.5G" or plain bytes/s.
+def parse_rate(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+# "6h", "90m", "3600" (seconds) or a clock time "06:00" (the next one) -> seconds from now.
+def parse_time_budget(value):
+    value = value.strip().lower()
+    if ':' in value:
+        now = datetime.now()
+        end = datetime.combine(now.date(), datetime.strptime(value, '%H:%M').time())
+        seconds = (end - now).total_seconds()
+        return seconds if seconds > 0 else seconds + 86400
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+# "09:00-18:00=2M" -> ('09:00', '18:00', 2097152)
+def parse_rate_window(value):
+    period, rate = value.split('=', 1)
+    start, end = period.split('-', 1)
+    return start.strip(), end.strip(), parse_rate(rate)
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.submit or args.status is not None or args.cancel is not None:
+        # Client of a running daemon: no downloader, no yt-dlp import
+        try:
+            if args.submit:
+                replies = [
+                    call_daemon(args.listen, 'POST', '/jobs',
+                                {'url': url, 'priority': args.priority, 'max_height': args.max_height or None})
+                    for url in args.submit
+                ]
+            elif args.cancel is not None:
+                replies = [call_daemon(args.listen, 'DELETE', f'/jobs/{args.cancel}')]
+            else:
+                replies = [call_daemon(args.listen, 'GET', f'/jobs/{args.status}' if args.status else '/status')]
+        except OSError as e:
+            print(json.dumps({'error': f"daemon not reachable at {args.listen}: {e}"}))
+            exit(2)
+        for status, payload in replies:
+            print(json.dumps(payload, ensure_ascii=False))
+        exit(0 if all(status < 400 for status, _ in replies) else 1)
+
+    if args.batch or args.daemon:
+        try:
+            downloader = VideoDownloader(interactive=False)
+            if args.codec:
+                downloader.codec_preference = [codec.strip() for codec in args.codec.split(',') if codec.strip()]
+            if args.jobs:
+                downloader.MAX_CONCURRENT_DOWNLOADS = args.jobs
+            if args.sync:
+                downloader.SYNC_PLAYLISTS = True
+            if args.sync_stop_after is not None:
+                downloader.SYNC_STOP_AFTER_KNOWN = args.sync_stop_after
+            if args.scratch_dir:
+                downloader.SCRATCH_DIR = args.scratch_dir
+            if args.connections or args.range_size:
+                connections, range_size = downloader.RANGE_DOWNLOADS.get('default', (4, 8 * 1024 * 1024))
+                downloader.RANGE_DOWNLOADS = {
+                    **downloader.RANGE_DOWNLOADS, 'default': (args.connections or connections, args.range_size or range_size)}
+            if args.transcode:
+                downloader.TRANSCODE_CODEC = args.transcode
+            if args.transcode_height is not None:
+                downloader.TRANSCODE_MAX_HEIGHT = args.transcode_height
+            if args.crf is not None:
+                downloader.TRANSCODE_CRF = args.crf
+            if args.preset:
+                downloader.TRANSCODE_PRESET = args.preset
+            if args.cpu_cores or args.transcode_jobs:
+                downloader.transcode_pool = TranscodePool(
+                    args.cpu_cores or downloader.TRANSCODE_CPU_CORES, args.transcode_jobs or downloader.TRANSCODE_JOBS)
+            if args.min_free is not None:
+                downloader.CHECK_DISK_SPACE = args.min_free > 0
+                downloader.disk_planner.margin = args.min_free
+            if args.limit_rate is not None or args.limit_window:
+                downloader.bandwidth = BandwidthLimiter(
+                    args.limit_rate if args.limit_rate is not None else downloader.BANDWIDTH_LIMIT,
+                    [parse_rate_window(window) for window in args.limit_window] or downloader.BANDWIDTH_WINDOWS,
+                )
+            if args.time_budget or args.byte_budget or args.throughput:
+                downloader.quality_policy = QualityPolicy(
+                    args.time_budget or downloader.QUALITY_TIME_BUDGET,
+                    args.byte_budget or downloader.QUALITY_BYTE_BUDGET,
+                    args.throughput or downloader.QUALITY_THROUGHPUT,
+                    downloader.QUALITY_THROUGHPUT_FILE,
+                )
+            if args.metrics_events or args.prometheus_textfile:
+                downloader.metrics = StageMetrics(
+                    args.metrics_events or downloader.METRICS_EVENTS_FILE,
+                    args.prometheus_textfile or downloader.PROMETHEUS_TEXTFILE,
+                )
+            if args.daemon:
+                daemon = DownloadDaemon(downloader, args.output, args.listen, args.max_height)
+                signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+                try:
+                    daemon.serve_forever()
+                except KeyboardInterrupt:
+                    logging.info("Daemon interrupted, the running jobs are queued again at the next start.")
+                exit(0)
+            summary = downloader.run_batch(args.batch, args.output, args.max_height)
+        except Exception as e:
+            logging.error(f"\nFatal error: {str(e)}")
+            print(json.dumps({'error': str(e)}))
+            exit(2)
+        print(json.dumps(summary, ensure_ascii=False))
+        exit(1 if summary['failed'] else 0)
+    
     try:
         downloader = VideoDownloader()
         downloader.run()
@@ -1,16 +1,36 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
-import vlc
 import random
 from pathlib import Path
-import cv2
-from PIL import Image, ImageTk, ImageDraw, ImageFont
 from functools import lru_cache
 import ast
 import time
 import sys
 
+# Heavy modules are loaded on first use so the window shows up as early as possible:
+# vlc right after the window is mapped, cv2 and Pillow on the first hover preview.
+vlc = None
+class VlcNotLoaded(Exception):
+    "Never raised: stands for the python-vlc exception class in except clauses until vlc is loaded."
+
+VlcError = VlcNotLoaded
+cv2 = None
+Image = ImageTk = ImageDraw = ImageFont = None
+
+def load_vlc():
+    global vlc, VlcError
+    if vlc is None:
+        import vlc
+        VlcError = vlc.VLCException
+    return vlc
+
+def load_preview_modules():
+    global cv2, Image, ImageTk, ImageDraw, ImageFont
+    if cv2 is None:
+        import cv2
+        from PIL import Image, ImageTk, ImageDraw, ImageFont
+
 class VideoPlayer:
     
     PREVIEW_WIDTH = 200 # Preview video Width
@@ -48,10 +68,10 @@ class VideoPlayer:
             '--no-video-title-show', 
         ]
         
-        # Initialize VLC instance and media player
-        self.instance = vlc.Instance(vlc_args)
-        
-        self.player = self.instance.media_player_new()
+        # VLC instance and media player are created once the window is shown (see init_vlc)
+        self.vlc_args = vlc_args
+        self.instance = None
+        self.player = None
         
         # Initialize playlist attributes
         self.playlist = []
@@ -64,11 +84,8 @@ class VideoPlayer:
         self.last_hover_time = 0
         self.hover_cooldown = 0.1  # 10ms cooldown between hover events to reduce `computational consumption`.
         
-        # Try to use a default font
-        try:
-            self.font = ImageFont.truetype("arial.ttf", 16)
-        except IOError:
-            self.font = ImageFont.load_default()
+        # Default font, loaded with the first preview
+        self.font = None
 
         # Setup the user interface
         self.setup_ui()
@@ -76,6 +93,27 @@ class VideoPlayer:
         
         # Bind close window event to stop playback
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.root.bind("<Map>", self._on_first_map, add="+")
+        
+    def _on_first_map(self, event=None):
+        """Load VLC once the window is on screen"""
+        if self.instance is None and event.widget is self.root:
+            self.root.after_idle(self.init_vlc)
+    
+    def init_vlc(self):
+        """Initialize VLC instance and media player"""
+        if self.instance is not None:
+            return
+        load_vlc()
+        self.instance = vlc.Instance(self.vlc_args)
+        self.player = self.instance.media_player_new()
+    
+    def _load_font(self):
+        """Try to use a default font"""
+        try:
+            self.font = ImageFont.truetype("arial.ttf", 16)
+        except IOError:
+            self.font = ImageFont.load_default()
         
     def setup_ui(self):
         
@@ -184,6 +222,7 @@ class VideoPlayer:
     def load_folder(self):
         folder = filedialog.askdirectory()
 
+        self.init_vlc()
         if sys.platform.startswith("win"):
             self.player.set_hwnd(self.video_frame.winfo_id())
         else:
@@ -248,6 +287,8 @@ class VideoPlayer:
         self.subtitle_tracks = self.get_subtitle_tracks()
         
     def toggle_play(self, event=None):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.is_playing():
             self.player.pause()
             self.play_button.config(text="Play")
@@ -274,6 +315,8 @@ class VideoPlayer:
     
     def duration_bar_click(self, event):
         "Handle clicks on the duration bar."
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.get_length() > 0 :
             slider_width = self.duration_slider.winfo_width()
             if slider_width > 0:
@@ -284,7 +327,8 @@ class VideoPlayer:
                 self.update_duration_slider() 
             
     def set_volume(self, value):
-        self.player.audio_set_volume(self.volume_var.get())
+        if self.player is not None:  # Otherwise applied by load_folder
+            self.player.audio_set_volume(self.volume_var.get())
 
     def toggle_shuffle(self):
         self.is_shuffle = not self.is_shuffle ## apply "not" and change the boolean value
@@ -295,8 +339,9 @@ class VideoPlayer:
         if hasattr(self, 'media'):
             self.media.release() 
             del self.media 
-        self.player.stop()
-        self.player.release()
+        if self.player is not None:
+            self.player.stop()
+            self.player.release()
         del self.player
         self.root.destroy()
 
@@ -328,6 +373,8 @@ class VideoPlayer:
     
    
     def on_duration_change(self, value):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.is_playing and self.player.get_length() > 0:
             try:
                 position = int(float(value)) * 1000
@@ -336,7 +383,7 @@ class VideoPlayer:
                 print(f"Error seeking: {e}")
 
     def update_duration_slider(self):
-        if not self.is_playing:
+        if self.player is None or not self.is_playing:
             return
     
         try:
@@ -356,7 +403,7 @@ class VideoPlayer:
                     self.duration_var.set(position) #Correct the slider if there is a jump
                     self.update_timer_label(position, length)
                 self.root.after(250, self.update_duration_slider)
-        except (vlc.VlcError, AttributeError, ZeroDivisionError) as e:
+        except (VlcError, AttributeError, ZeroDivisionError) as e:
             print(f"Error updating duration: {e}")
             self.root.after(1000, self.update_duration_slider)
     
@@ -382,6 +429,7 @@ class VideoPlayer:
                 mouse_relative_pos = event.x / slider_width
                 preview_time = int(mouse_relative_pos * total_duration)
 
+                self._ensure_preview_ready()
                 preview_image = self.generate_video_preview(current_media, preview_time)
 
                 if preview_image is not None:
@@ -410,6 +458,12 @@ class VideoPlayer:
             
         self.last_hover_time = current_time
     
+    def _ensure_preview_ready(self):
+        """Load cv2, Pillow and the font on the first preview"""
+        load_preview_modules()
+        if self.font is None:
+            self._load_font()
+    
     @lru_cache(maxsize=32)  # Cache up to 32 recent previews
     def generate_video_preview(self, video_path, timestamp):
         "Generate a preview frame from the video at the specified timestamp."
@@ -491,11 +545,15 @@ class VideoPlayer:
         
 
     def skip_forward(self, event=None):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.is_playing():
             current_time = self.player.get_time()
             self.player.set_time(min(current_time + self.SKIP_TIME, self.player.get_length()))
 
     def skip_back(self, event=None):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.is_playing():
             current_time = self.player.get_time()
             self.player.set_time(max(current_time - self.SKIP_TIME, 0))
@@ -503,11 +561,14 @@ class VideoPlayer:
     def set_speed(self, value):
         speed = min(self.speed_var.get(), self.MAX_PLAYBACK_SPEED)
         self.speed_var.set(speed)
-        self.player.set_rate(speed)
+        if self.player is not None:
+            self.player.set_rate(speed)
         self.speed_label.config(text=f"Speed: {speed:.1f}x")
 
     # Deceleration video    
     def décélération_lecture(self, event=None):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.is_playing() and self.playback_speed > 0.5:
             self.playback_speed -= 0.1  # décélère
             self.player.set_rate(self.playback_speed)
@@ -516,6 +577,8 @@ class VideoPlayer:
         
     # Acceleration video
     def accélération_lecture(self, event=None):
+        if self.player is None:  # VLC not loaded yet
+            return
         if self.player.is_playing() and self.playback_speed < self.MAX_PLAYBACK_SPEED:
             self.playback_speed = min(self.playback_speed + 0.1, self.MAX_PLAYBACK_SPEED)
             self.player.set_rate(self.playback_speed)
@@ -526,6 +589,8 @@ class VideoPlayer:
     def get_subtitle_tracks(self):
         """Get a list of available subtitle tracks"""
         tracks = []
+        if self.player is None:
+            return tracks
         spu_count = self.player.video_get_spu_count()
         print(f"Total subtitle tracks: {spu_count}")
         
@@ -0,0 +1,332 @@
+"""End-to-end downloader benchmark against a local stand-in for a video site, without any network access.
+
+Synthetic test media is generated with ffmpeg (test pattern + tone) and served by a local HTTP server as:
+  - progressive MP4 (with HTTP range support),
+  - HLS (MPEG-TS segments),
+  - DASH (fragmented MP4 segments).
+The server can inject a latency on every request, HTTP 429 responses on media requests, a total bandwidth cap and
+a per-connection cap (the throttling the multi-connection range downloads work around).
+
+Every (format, --jobs) combination runs VideoDownloader.run_batch in a fresh interpreter on a fresh directory
+and reports the throughput (MB/s), the time spent in each stage and the peak RSS of the downloader process.
+
+    python benchmarks/bench_download.py --videos 4 --jobs 1,2,4
+    python benchmarks/bench_download.py --formats hls --latency 0.05 --error-rate 0.05 --rate 5M --json
+    python benchmarks/bench_download.py --formats progressive --jobs 1 --connections 1,4 --connection-rate 1M
+    python benchmarks/bench_download.py --media-dir ./media   # reuse media generated by a previous run (--keep-media)
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOWNLOADER_PATH = os.path.join(ROOT, 'VideoDownloader')
+sys.path.insert(0, DOWNLOADER_PATH)
+
+from video_downloader import parse_rate  # noqa: E402  (the runs themselves use a fresh interpreter each)
+
+# Media of each format inside the media directory, and the URL template of the i-th video.
+# Every video URL serves the same file under its own name, so each download gets its own title.
+FORMATS = {
+    'progressive': ('video.mp4', '/video{index}.mp4'),
+    'hls': ('hls/index.m3u8', '/hls/video{index}.m3u8'),
+    'dash': ('dash/manifest.mpd', '/dash/video{index}.mpd'),
+}
+VIDEO_URL_PATTERN = re.compile(r'^/(?:(hls|dash)/)?video\d+\.(mp4|m3u8|mpd)$')
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+
+# Runs in a fresh interpreter for each configuration and prints the run_batch summary on its last line.
+DRIVER = """
+import json, logging, sys
+sys.path.insert(0, {path!r})
+logging.disable(logging.CRITICAL)
+import video_downloader
+video_downloader.VideoDownloader.FRAGMENT_TUNING_FILE = {tuning_file!r}
+video_downloader.VideoDownloader.MAX_CONCURRENT_DOWNLOADS = {jobs}
+video_downloader.VideoDownloader.RANGE_DOWNLOADS = {{'default': ({connections}, {range_size})}}
+downloader = video_downloader.VideoDownloader(interactive=False)
+summary = downloader.run_batch({url_file!r}, {output!r})
+print(json.dumps(summary))
+"""
+
+
+def run_ffmpeg(ffmpeg, *args):
+    subprocess.run([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', *args], check=True)
+
+
+# Test pattern and tone encoded with codecs every ffmpeg build has, then packaged as HLS and DASH.
+def generate_media(ffmpeg, media_dir, duration, bitrate):
+    video = os.path.join(media_dir, 'video.mp4')
+    run_ffmpeg(
+        ffmpeg,
+        '-f', 'lavfi', '-i', f'testsrc=size=1280x720:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'mpeg4', '-b:v', bitrate, '-g', '60',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-shortest', '-movflags', '+faststart', video,
+    )
+    os.makedirs(os.path.join(media_dir, 'hls'), exist_ok=True)
+    run_ffmpeg(
+        ffmpeg, '-i', video, '-c', 'copy', '-f', 'hls', '-hls_time', '2', '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(media_dir, 'hls', 'seg%04d.ts'),
+        os.path.join(media_dir, 'hls', 'index.m3u8'),
+    )
+    os.makedirs(os.path.join(media_dir, 'dash'), exist_ok=True)
+    run_ffmpeg(
+        ffmpeg, '-i', video, '-c', 'copy', '-f', 'dash', '-seg_duration', '2',
+        os.path.join(media_dir, 'dash', 'manifest.mpd'),
+    )
+
+
+class FaultInjector:
+    "Latency, HTTP 429 and bandwidth cap applied by the media server, with counters for the report."
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate=0, connection_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate = rate  # bytes/s shared by all the connections (0 = unlimited)
+        self.connection_rate = connection_rate  # bytes/s of each response (0 = unlimited)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._next_send = 0.0
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    # Wait for the chunk's slot in the shared bandwidth budget, then in the budget of its response.
+    # pace: {'started': monotonic time, 'sent': bytes} of the response.
+    def send(self, wfile, data, pace=None):
+        with self._lock:
+            self.bytes_sent += len(data)
+            if self.rate <= 0:
+                wait = 0
+            else:
+                now = time.monotonic()
+                start = max(now, self._next_send)
+                self._next_send = start + len(data) / self.rate
+                wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+        if self.connection_rate and pace is not None:
+            pace['sent'] += len(data)
+            wait = pace['started'] + pace['sent'] / self.connection_rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        wfile.write(data)
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.errors = self.bytes_sent = 0
+
+
+def make_handler(media_dir, faults):
+    class MediaHandler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=media_dir, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+        def translate_path(self, path):
+            match = VIDEO_URL_PATTERN.match(path.split('?', 1)[0])
+            if match:
+                kind = match.group(1) or 'progressive'
+                return os.path.join(media_dir, FORMATS[kind][0])
+            return super().translate_path(path)
+
+        def do_GET(self):
+            if faults.latency:
+                time.sleep(faults.latency)
+            path = self.translate_path(self.path)
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            if not path.endswith(MANIFEST_EXTENSIONS) and faults.should_fail():
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            range_match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            if range_match and (range_match.group(1) or range_match.group(2)):
+                if range_match.group(1):
+                    start = int(range_match.group(1))
+                    end = min(int(range_match.group(2) or end), size - 1)
+                else:
+                    start = max(0, size - int(range_match.group(2)))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            pace = {'started': time.monotonic(), 'sent': 0}
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                try:
+                    while remaining > 0:
+                        data = f.read(min(FaultInjector.CHUNK, remaining))
+                        if not data:
+                            break
+                        faults.send(self.wfile, data, pace)
+                        remaining -= len(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+    return MediaHandler
+
+
+# Run the downloader on one configuration. Returns the summary with the wall time and the peak RSS.
+def run_downloader(base_url, fmt, videos, jobs, ffmpeg, work_dir, connections=4, range_size=8 * 1024 * 1024):
+    run_dir = tempfile.mkdtemp(prefix=f'{fmt}-{jobs}-{connections}-', dir=work_dir)
+    url_file = os.path.join(run_dir, 'urls.txt')
+    with open(url_file, 'w', encoding='utf-8') as f:
+        for index in range(1, videos + 1):
+            f.write(base_url + FORMATS[fmt][1].format(index=index) + '\n')
+
+    code = DRIVER.format(
+        path=DOWNLOADER_PATH, jobs=jobs, connections=connections, range_size=range_size, url_file=url_file,
+        output=os.path.join(run_dir, 'out'), tuning_file=os.path.join(run_dir, 'fragment_tuning.json'),
+    )
+    env = dict(os.environ, FFMPEG_PATH=ffmpeg)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+    output = process.stdout.read()
+    peak_rss_mb = None
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+    wall = time.perf_counter() - started
+
+    lines = output.decode('utf-8', 'replace').strip().splitlines()
+    if process.returncode not in (0, 1) or not lines:
+        return {'error': f"downloader exited with {process.returncode}"}
+    summary = json.loads(lines[-1])
+    stages = summary.get('stages', {})
+    downloaded = stages.get('download', {}).get('bytes', 0)
+    return {
+        'wall_s': round(wall, 2),
+        'downloaded_mb': round(downloaded / 1024 / 1024, 1),
+        'mb_per_s': round(downloaded / 1024 / 1024 / wall, 2) if wall else None,
+        'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb else None,
+        'done': summary.get('done'),
+        'failed': summary.get('failed'),
+        'stage_s': {stage: round(totals['seconds'], 2) for stage, totals in stages.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the downloader end to end against a local media server.")
+    parser.add_argument('--formats', default='progressive,hls,dash', help="comma separated: progressive,hls,dash")
+    parser.add_argument('--jobs', default='1,2,4', help="comma separated MAX_CONCURRENT_DOWNLOADS values to compare")
+    parser.add_argument('--videos', type=int, default=4, help="videos per run")
+    parser.add_argument('--duration', type=int, default=30, help="length of the synthetic video in seconds")
+    parser.add_argument('--bitrate', default='4M', help="video bitrate of the synthetic video")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability of a 429 on media requests")
+    parser.add_argument('--rate', type=parse_rate, default=0, help="total bandwidth of the server, e.g. 10M (bytes/s)")
+    parser.add_argument('--connection-rate', type=parse_rate, default=0, help="bandwidth of each connection, e.g. 1M")
+    parser.add_argument('--connections', default='4',
+                        help="comma separated connections per progressive download to compare (1 = single connection)")
+    parser.add_argument('--range-size', type=parse_rate, default=8 * 1024 * 1024, help="byte range per request, e.g. 2M")
+    parser.add_argument('--media-dir', help="use the media already in this directory instead of generating it")
+    parser.add_argument('--keep-media', metavar='DIR', help="copy the generated media to DIR for later runs")
+    parser.add_argument('--ffmpeg', default=os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg'), help="ffmpeg path")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.ffmpeg or not os.path.exists(args.ffmpeg):
+        parser.error("ffmpeg not found, use --ffmpeg or FFMPEG_PATH")
+
+    work_dir = tempfile.mkdtemp(prefix='bench_download_')
+    try:
+        media_dir = args.media_dir
+        if not media_dir:
+            media_dir = os.path.join(work_dir, 'media')
+            os.makedirs(media_dir)
+            generate_media(args.ffmpeg, media_dir, args.duration, args.bitrate)
+            if args.keep_media:
+                shutil.copytree(media_dir, args.keep_media, dirs_exist_ok=True)
+
+        faults = FaultInjector(args.latency, args.error_rate, args.rate, args.connection_rate)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(os.path.abspath(media_dir), faults))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        results = []
+        for fmt in [f.strip() for f in args.formats.split(',') if f.strip()]:
+            if not os.path.exists(os.path.join(media_dir, FORMATS[fmt][0])):
+                results.append({'format': fmt, 'error': f"{FORMATS[fmt][0]} not found in the media directory"})
+                continue
+            connection_counts = [int(c) for c in args.connections.split(',') if c.strip()]
+            if fmt != 'progressive':
+                connection_counts = connection_counts[:1]  # Only progressive formats use range downloads
+            for jobs in [int(j) for j in args.jobs.split(',') if j.strip()]:
+                for connections in connection_counts:
+                    faults.reset_counters()
+                    result = run_downloader(base_url, fmt, args.videos, jobs, args.ffmpeg, work_dir,
+                                            connections, args.range_size)
+                    result.update({'format': fmt, 'jobs': jobs, 'connections': connections,
+                                   'requests': faults.requests, 'injected_429': faults.errors})
+                    results.append(result)
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.videos} videos per run, latency {args.latency}s, 429 rate {args.error_rate}, "
+          f"server rate {'unlimited' if not args.rate else f'{args.rate / 1024 / 1024:.1f}MB/s'}, "
+          f"per connection {'unlimited' if not args.connection_rate else f'{args.connection_rate / 1024 / 1024:.1f}MB/s'}")
+    for r in results:
+        if 'error' in r:
+            print(f"\n{r['format']} jobs={r.get('jobs', '-')}: {r['error']}")
+            continue
+        print(f"\n{r['format']} jobs={r['jobs']} connections={r['connections']}: {r['mb_per_s']} MB/s ({r['downloaded_mb']}MB in {r['wall_s']}s), "
+              f"peak RSS {r['peak_rss_mb']}MB, {r['done']} done, {r['failed']} failed, "
+              f"{r['requests']} requests, {r['injected_429']} x 429")
+        print("  " + " | ".join(f"{stage} {seconds}s" for stage, seconds in r['stage_s'].items()))
+
+
+if __name__ == '__main__':
+    main()
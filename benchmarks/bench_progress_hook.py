@@ -0,0 +1,131 @@
+"""Micro-benchmark of the yt-dlp progress hooks installed on every download.
+
+yt-dlp calls the hooks for every block or fragment received, so their cost is paid many times per second per
+download. For each hook it reports the mean time per call over synthetic 'downloading' callbacks:
+  - print_every_call: the former behaviour, formatting and printing the progress on every callback,
+  - aggregator: ProgressAggregator hook alone, then with the terminal listener (rendering at most 4 times per second),
+  - fragment_probe, content_hasher, bandwidth: the other hooks of a download (content_hasher includes the
+    SHA-256 of the bytes received, work that has to be done once per byte anyway),
+  - full_chain: every hook of a download as configured by VideoDownloader.prepare_download.
+
+Printed output goes to os.devnull.
+
+    python benchmarks/bench_progress_hook.py --calls 200000
+    python benchmarks/bench_progress_hook.py --json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'VideoDownloader'))
+os.environ.setdefault('FFMPEG_PATH', sys.executable)  # any existing file, ffmpeg is not run here
+
+import video_downloader  # noqa: E402
+
+BLOCK = 16 * 1024  # bytes between two callbacks, like a fragment or an HTTP read
+
+
+def make_events(calls, filename, total):
+    events = []
+    for i in range(1, calls + 1):
+        downloaded = min(i * BLOCK, total)
+        events.append({
+            'status': 'downloading',
+            'filename': filename,
+            'tmpfilename': filename,
+            'downloaded_bytes': downloaded,
+            'total_bytes': total,
+            'speed': 5 * 1024 * 1024,
+            'eta': (total - downloaded) / (5 * 1024 * 1024),
+            'elapsed': i * 0.003,
+        })
+    return events
+
+
+# The progress printing of previous versions, run on every callback.
+def print_every_call(d):
+    if d['status'] == 'downloading':
+        try:
+            if 'total_bytes' in d:
+                percentage = d['downloaded_bytes'] / d['total_bytes'] * 100
+                downloaded_mb = d['downloaded_bytes'] / 1024 / 1024
+                total_mb = d['total_bytes'] / 1024 / 1024
+                print(f"\rProgress: {percentage:.1f}% ({downloaded_mb:.1f}MB of {total_mb:.1f}MB)", end='')
+            elif 'downloaded_bytes' in d:
+                downloaded_mb = d['downloaded_bytes'] / 1024 / 1024
+                print(f"\rDownloaded: {downloaded_mb:.1f}MB", end='')
+        except:
+            print("\rDownloading...", end='')
+
+
+def time_hooks(hooks, events):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for d in events:
+            for hook in hooks:
+                hook(d)
+        elapsed = time.perf_counter() - start
+    return elapsed / len(events) * 1e6  # microseconds per callback
+
+
+def benchmark(calls):
+    logging.disable(logging.CRITICAL)
+    downloader = video_downloader.VideoDownloader(interactive=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'video.mp4.part')
+        total = calls * BLOCK
+        with open(filename, 'wb') as f:
+            f.truncate(total)  # sparse file, the hasher reads it as if it was being written
+        events = make_events(calls, filename, total)
+
+        def aggregator(listener=None):
+            progress = video_downloader.ProgressAggregator(downloader.PROGRESS_RATE)
+            if listener:
+                progress.add_listener(listener)
+            progress.register(1, 'video')
+            return progress.progress_hook(1)
+
+        def bandwidth():
+            limiter = video_downloader.BandwidthLimiter()
+            limiter.register(1)
+            return limiter.progress_hook(1)
+
+        cases = {
+            'print_every_call': lambda: [print_every_call],
+            'aggregator': lambda: [aggregator()],
+            'aggregator_terminal': lambda: [aggregator(downloader.print_progress)],
+            'fragment_probe': lambda: [video_downloader.FragmentProbe('generic', 2).hook],
+            'content_hasher': lambda: [video_downloader.StreamingHasher().hook],
+            'bandwidth': lambda: [bandwidth()],
+            'full_chain': lambda: [
+                bandwidth(), aggregator(downloader.print_progress),
+                video_downloader.FragmentProbe('generic', 2).hook, video_downloader.StreamingHasher().hook,
+            ],
+        }
+        return {name: round(time_hooks(make_hooks(), events), 3) for name, make_hooks in cases.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cost per call of the download progress hooks.")
+    parser.add_argument('--calls', type=int, default=100000, help="callbacks per measurement")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = benchmark(max(1, args.calls))
+    if args.json:
+        print(json.dumps({'calls': args.calls, 'us_per_call': results}, indent=2))
+        return
+    print(f"{args.calls} callbacks, mean time per callback:")
+    for name, us in results.items():
+        print(f"  {name:<20} {us:>8.3f} us")
+
+
+if __name__ == '__main__':
+    main()
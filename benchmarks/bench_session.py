@@ -0,0 +1,102 @@
+"""Per-video overhead of the yt-dlp instances, with and without the session reused across a run.
+
+Small progressive videos are served by the local media server of bench_download.py (optionally with a latency
+per request, to stand in for the TLS handshake of a real site) and downloaded one after the other with
+VideoDownloader.extract_video_info + download_video, first with a new YoutubeDL for every call (previous
+behaviour), then with the YdlSession shared by the whole run. For each mode it reports the mean time per video,
+the YoutubeDL instances created and the TCP connections opened on the server.
+
+    python benchmarks/bench_session.py --videos 20
+    python benchmarks/bench_session.py --videos 20 --latency 0.02 --json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'VideoDownloader'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('FFMPEG_PATH', sys.executable)  # any existing file, a single mp4 is never remuxed
+
+import video_downloader  # noqa: E402
+from bench_download import FaultInjector, FORMATS, make_handler  # noqa: E402
+
+
+def start_server(media_dir, faults):
+    handler = make_handler(media_dir, faults)
+    connections = [0]
+
+    class CountingHandler(handler):
+        def setup(self):
+            connections[0] += 1  # one handler per TCP connection
+            super().setup()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CountingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, connections
+
+
+def benchmark(videos, size, latency):
+    logging.disable(logging.CRITICAL)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        media_dir = os.path.join(tmp, 'media')
+        os.makedirs(media_dir)
+        with open(os.path.join(media_dir, FORMATS['progressive'][0]), 'wb') as f:
+            f.write(os.urandom(size))
+
+        server, connections = start_server(media_dir, FaultInjector(latency=latency))
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+        try:
+            for mode, reuse in (('fresh_per_call', False), ('session', True)):
+                downloader = video_downloader.VideoDownloader(interactive=False)
+                downloader.session.reuse = reuse
+                save_dir = os.path.join(tmp, mode)
+                os.makedirs(save_dir)
+                connections[0] = 0
+                started = time.perf_counter()
+                done = 0
+                for index in range(1, videos + 1):
+                    url = base_url + FORMATS['progressive'][1].format(index=index)
+                    info = downloader.extract_video_info(url)
+                    done += bool(downloader.download_video(url, save_dir, selected_height=0, info=info))
+                elapsed = time.perf_counter() - started
+                downloader.session.close()
+                results[mode] = {
+                    'ms_per_video': round(elapsed / videos * 1000, 1),
+                    'ydl_instances': downloader.session.created,
+                    'connections': connections[0],
+                    'done': done,
+                }
+        finally:
+            server.shutdown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the per-video overhead of the yt-dlp session.")
+    parser.add_argument('--videos', type=int, default=10, help="videos downloaded in each mode")
+    parser.add_argument('--size', type=int, default=64 * 1024, help="bytes per video")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = benchmark(max(1, args.videos), args.size, args.latency)
+    if args.json:
+        print(json.dumps({'videos': args.videos, 'latency_s': args.latency, 'results': results}, indent=2))
+        return
+    print(f"{args.videos} videos of {args.size // 1024}KB, latency {args.latency}s per request:")
+    for mode, r in results.items():
+        print(f"  {mode:<16} {r['ms_per_video']:>8.1f} ms/video  {r['ydl_instances']:>4} YoutubeDL  "
+              f"{r['connections']:>4} connections  ({r['done']} done)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Cold-start benchmark for the downloader and the playlist players.
+
+For every entry point it reports, in a fresh interpreter each time:
+  - the module import time,
+  - the heavy modules (yt_dlp, tkinter, vlc, cv2, PIL) already loaded after the import,
+  - the time until the first window is mapped (players) or the downloader is ready.
+
+Window timings need a display; they are reported as skipped otherwise.
+
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('yt_dlp', 'tkinter', 'vlc', 'cv2', 'PIL')
+
+ENTRY_POINTS = {
+    'video_downloader': os.path.join(ROOT, 'VideoDownloader'),
+    'playlist_auto': os.path.join(ROOT, 'VideoPlaylistPlayer'),
+    'playlist_auto_linux_mac': os.path.join(ROOT, 'VideoPlaylistPlayer'),
+}
+
+# Each probe runs in its own interpreter and prints a JSON result on its last line.
+IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'import_s': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+PLAYER_WINDOW_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+import tkinter as tk
+try:
+    root = tk.Tk()
+except tk.TclError as e:
+    print(json.dumps({{'skipped': str(e)}}))
+    sys.exit(0)
+import {module}
+app = {module}.VideoPlayer(root)
+result = {{}}
+
+def on_map(event):
+    if event.widget is root and not result:
+        result['window_s'] = time.perf_counter() - start
+        root.after_idle(root.destroy)
+
+root.bind('<Map>', on_map, add='+')
+root.after(10000, root.destroy)  # never hang the benchmark
+root.mainloop()
+print(json.dumps(result or {{'skipped': 'window never mapped'}}))
+"""
+
+DOWNLOADER_READY_PROBE = """
+import json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+os.environ.setdefault('FFMPEG_PATH', sys.executable)  # any existing file, ffmpeg is not run here
+import logging
+import video_downloader
+logging.disable(logging.CRITICAL)
+result = {{}}
+video_downloader.VideoDownloader(interactive=False)
+result['batch_ready_s'] = time.perf_counter() - start
+try:
+    video_downloader.VideoDownloader(interactive=True)
+    result['interactive_ready_s'] = time.perf_counter() - start
+except Exception as e:
+    result['interactive_skipped'] = str(e)
+print(json.dumps(result))
+"""
+
+
+def run_probe(code):
+    completed = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True, text=True, cwd=ROOT, timeout=60,
+    )
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        error = (completed.stderr.strip().splitlines() or ['no output'])[-1]
+        return {'error': error}
+    return json.loads(lines[-1])
+
+
+def median_of(results, key):
+    values = [r[key] for r in results if key in r]
+    return round(statistics.median(values) * 1000, 1) if values else None
+
+
+def first_of(results, key):
+    for r in results:
+        if key in r:
+            return r[key]
+    return None
+
+
+def benchmark(module, path, repeat):
+    imports = [run_probe(IMPORT_PROBE.format(path=path, module=module, heavy=HEAVY_MODULES)) for _ in range(repeat)]
+    if module == 'video_downloader':
+        ready = [run_probe(DOWNLOADER_READY_PROBE.format(path=path)) for _ in range(repeat)]
+        ready_ms = {
+            'batch_ready_ms': median_of(ready, 'batch_ready_s'),
+            'interactive_ready_ms': median_of(ready, 'interactive_ready_s'),
+        }
+        skipped = first_of(ready, 'interactive_skipped') or first_of(ready, 'error')
+    else:
+        ready = [run_probe(PLAYER_WINDOW_PROBE.format(path=path, module=module)) for _ in range(repeat)]
+        ready_ms = {'first_window_ms': median_of(ready, 'window_s')}
+        skipped = first_of(ready, 'skipped') or first_of(ready, 'error')
+
+    return {
+        'entry_point': module,
+        'import_ms': median_of(imports, 'import_s'),
+        'loaded_at_import': first_of(imports, 'loaded'),
+        'import_error': first_of(imports, 'error'),
+        **ready_ms,
+        'window_note': skipped,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import time and time-to-first-window of each entry point.")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the median is reported")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = [benchmark(module, path, max(1, args.repeat)) for module, path in ENTRY_POINTS.items()]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for r in results:
+        print(f"\n{r['entry_point']}")
+        print(f"  import:            {r['import_ms']} ms" + (f"  ({r['import_error']})" if r['import_error'] else ''))
+        print(f"  loaded at import:  {', '.join(r['loaded_at_import'] or []) or 'none'}")
+        for key in ('batch_ready_ms', 'interactive_ready_ms', 'first_window_ms'):
+            if key in r:
+                value = f"{r[key]} ms" if r[key] is not None else 'n/a'
+                print(f"  {key[:-3].replace('_', ' ') + ':':<18} {value}")
+        if r['window_note']:
+            print(f"  note:              {r['window_note']}")
+
+
+if __name__ == '__main__':
+    main()